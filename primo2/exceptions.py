@@ -28,3 +28,8 @@ class PrimoError(Exception):
 class StructureError(PrimoError):
 	"""An error in the structure of a Bayesian network."""
 	pass
+
+
+class MemoryBudgetError(PrimoError):
+	"""An inference whose estimated memory exceeds the configured budget."""
+	pass
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of PRIMO2 -- Probabilistic Inference Modules.
+# Copyright (C) 2013-2017 Social Cognitive Systems Group,
+#                         Faculty of Technology, Bielefeld University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the Lesser GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+import itertools
+import math
+
+import numpy as np
+
+from ..networks import BayesianNetwork
+from .cost import CostEstimate, table_size
+from .factor import Factor
+from .order import Orderer
+
+
+def _log_size(scope, cardinalities):
+    """
+        Returns the logarithm of the number of instantiations of the given
+        variables, which all need to have at least one value.
+    """
+    return sum(math.log(cardinalities[v]) for v in scope)
+
+
+class _DtreeNode(object):
+    """
+        Node of a decomposition tree (dtree). Leaves hold the family of a
+        single network node, inner nodes have exactly two children.
+    """
+
+    def __init__(self, family=None, variables=(), left=None, right=None):
+        self.family = family
+        self.left = left
+        self.right = right
+        if left is not None:
+            self.variables = left.variables.union(right.variables)
+        else:
+            self.variables = frozenset(variables)
+
+
+class RecursiveConditioning(object):
+    """
+        Exact inference by recursive conditioning over a decomposition tree
+        (dtree), see "Modeling and Reasoning with Bayesian Networks" - Adnan
+        Darwiche Chapter 12. The dtree splits the network's cpds
+        recursively into two parts, which become independent once the
+        variables they share (the cutset) are instantiated. Each part is
+        solved for every instantiation of its cutset, so that no table
+        larger than a single cpd is ever multiplied.
+
+        The results of a dtree node only depend on the instantiation of its
+        context and are cached for it. With unlimited caching, the inference
+        takes time and space exponential in the width of the dtree, just
+        like a jointree. With a smaller cache size, fewer results are cached
+        and recomputed instead, down to linear space if nothing is cached.
+    """
+
+    def __init__(self, bn, order=None, cacheSize=None):
+        """
+            Creates the dtree of the given network.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network that is supposed to be queried.
+            order : [String,], optional
+                Elimination order the dtree is created from. The width of
+                the dtree equals the width of the order. If order is not
+                given, the min degree order is computed automatically.
+            cacheSize : int, optional
+                Maximal number of results that are cached during a query.
+                Each result takes up the item size of the network's dtype.
+                If None, all results that are worth caching are cached. If
+                0, nothing is cached and the inference only needs space
+                linear in the size of the network.
+        """
+        if not isinstance(bn, BayesianNetwork):
+            raise TypeError("Only Bayesian Networks are currently supported.")
+        self.bn = bn
+        self.cacheSize = cacheSize
+        if not order:
+            order = Orderer.get_min_degree_order(bn)
+        self.root = self._create_dtree(bn, order)
+        self.cardinalities = {n.name: len(n.values) for n in bn.get_all_nodes()}
+
+    @staticmethod
+    def _create_dtree(bn, order):
+        """
+            Creates a balanced dtree. First, a dtree is created from the 
+            elimination order: for each eliminated variable, all trees 
+            containing it are composed into one. This dtree can be as deep 
+            as the network, e.g. for chains, so its leaves are split 
+            recursively instead, in the order in which they appear in it. 
+            Each split keeps at least a third of the leaves on either side
+            and shares the fewest instantiations between both sides, so 
+            that the depth of the dtree is logarithmic in the size of the 
+            network.
+
+            Returns
+            -------
+                _DtreeNode
+                The root of the dtree or None if the network is empty.
+        """
+        def compose(trees):
+            while len(trees) > 1:
+                trees = [_DtreeNode(left=trees[i], right=trees[i+1])
+                         if i+1 < len(trees) else trees[i]
+                         for i in range(0, len(trees), 2)]
+            return trees[0]
+
+        trees = [_DtreeNode(n.name, [n.name] + list(n.parentOrder))
+                 for n in bn.get_all_nodes()]
+        if not trees:
+            return None
+        for v in order:
+            containing = [t for t in trees if v in t.variables]
+            if len(containing) > 1:
+                trees = [t for t in trees if v not in t.variables]
+                trees.append(compose(containing))
+        leaves = []
+        stack = [compose(trees)]
+        while stack:
+            node = stack.pop()
+            if node.family is not None:
+                leaves.append(node)
+            else:
+                stack.append(node.right)
+                stack.append(node.left)
+
+        cardinalities = {n.name: len(n.values) for n in bn.get_all_nodes()}
+        built = []
+        stack = [(leaves, False)]
+        while stack:
+            part, join = stack.pop()
+            if join:
+                right = built.pop()
+                built.append(_DtreeNode(left=built.pop(), right=right))
+            elif len(part) == 1:
+                built.append(part[0])
+            else:
+                split = RecursiveConditioning._best_split(part, cardinalities)
+                stack.append((None, True))
+                stack.append((part[split:], False))
+                stack.append((part[:split], False))
+        return built[0]
+
+    @staticmethod
+    def _best_split(leaves, cardinalities):
+        """
+            Returns the index splitting the given leaves into two parts of 
+            at least a third of the leaves each, so that the variables 
+            shared by both parts have the fewest instantiations.
+        """
+        total = {}
+        for leaf in leaves:
+            for v in leaf.variables:
+                total[v] = total.get(v, 0) + 1
+        lower = max(1, len(leaves) // 3)
+        upper = len(leaves) - lower
+        left = {}
+        # Logarithm of the number of instantiations of the shared variables
+        score = 0.0
+        best = None
+        for i in range(1, upper+1):
+            for v in leaves[i-1].variables:
+                count = left.get(v, 0)
+                left[v] = count + 1
+                shared = (count + 1 < total[v]) - (0 < count < total[v])
+                score += shared * math.log(cardinalities[v])
+            if i >= lower and (best is None or score < best[0] - 1e-9):
+                best = (score, i)
+        return best[1]
+
+    def _plan(self, variables, domains):
+        """
+            Determines the cutset and context of each dtree node for the
+            given query variables, which are instantiated at the root, and
+            selects the nodes whose results are cached.
+
+            Parameter
+            ---------
+            variables : [String,]
+                The queried variables.
+            domains : dict
+                Dictionary containing the indices of the values each
+                variable can take given the evidence.
+
+            Returns
+            -------
+                (dict, CostEstimate)
+                Dictionary containing the cutset, context and whether the
+                results are cached for each inner dtree node, and the
+                estimated cost of the query.
+        """
+        domainSizes = {v: len(domains[v]) for v in domains}
+        plan = {}
+        candidates = []
+        stack = [(self.root, frozenset(variables))]
+        while stack:
+            node, acutset = stack.pop()
+            if node is None or node.family is not None:
+                continue
+            cutset = sorted(node.left.variables.intersection(node.right.variables)
+                            .difference(acutset))
+            context = sorted(node.variables.intersection(acutset))
+            plan[node] = [cutset, context, False]
+            # Caching only helps if the node can be called more often than 
+            # it has context instantiations
+            instantiations = table_size(context, domainSizes)
+            if table_size(acutset, domainSizes) > instantiations:
+                # Compared in log space, since the sizes can exceed floats
+                candidates.append((_log_size(acutset, domainSizes) - 
+                                   _log_size(context, domainSizes), id(node), node))
+            childAcutset = acutset.union(cutset)
+            stack.append((node.left, childAcutset))
+            stack.append((node.right, childAcutset))
+
+        # The caches avoiding the most calls per entry are selected first
+        res = CostEstimate()
+        entries = 0
+        for ratio, _, node in sorted(candidates, reverse=True):
+            size = table_size(plan[node][1], self.cardinalities)
+            if self.cacheSize is None or entries + size <= self.cacheSize:
+                plan[node][2] = True
+                entries += size
+                res.largestTable = max(res.largestTable, size)
+        res.peakBytes = entries * np.dtype(self.bn.dtype).itemsize
+
+        # Number of calls of each node given the selected caches
+        stack = [(self.root, 1)]
+        while stack:
+            node, calls = stack.pop()
+            if node is None:
+                continue
+            res.operations += calls
+            if node.family is not None:
+                continue
+            cutset, context, cached = plan[node]
+            if cached:
+                calls = min(calls, table_size(context, domainSizes))
+            calls *= table_size(cutset, domainSizes)
+            stack.append((node.left, calls))
+            stack.append((node.right, calls))
+        return plan, res
+
+    def _domains(self, evidence):
+        """
+            Returns the evidence likelihood of each variable with evidence and
+            the indices of the values each variable can take given the
+            evidence.
+        """
+        likelihoods = {}
+        domains = {}
+        for n in self.bn.get_all_nodes():
+            if n.name in evidence:
+                likelihood = Factor.as_evidence(n.name, n.values,
+                                                evidence[n.name]).potentials
+                likelihoods[n.name] = likelihood
+                domains[n.name] = list(np.flatnonzero(likelihood))
+            else:
+                domains[n.name] = list(range(len(n.values)))
+        return likelihoods, domains
+
+    def estimate_cost(self, variables, evidence=None):
+        """
+            Estimates the cost of computing the marginals of the given
+            variables with the configured cache size.
+
+            Parameter
+            ---------
+            variables : [String,]
+                The names of the queried variables.
+            evidence : dict, optional
+                Dictionary containing the given evidence (see marginals).
+                Hard evidence reduces the number of instantiations.
+
+            Returns
+            -------
+                CostEstimate
+                The largest cache, the approximate number of recursive calls
+                and the bytes of all caches.
+        """
+        return self._plan(variables, self._domains(evidence or {})[1])[1]
+
+    def marginals(self, variables, evidence=None):
+        """
+            Computes the joint marginals of the given variables given the
+            evidence.
+
+            Parameter
+            ---------
+            variables : [String,]
+                The names of the queried variables.
+            evidence : dict, optional
+                Dictionary containing the given evidence. The keys are the
+                variable names, the values are either the observed value or
+                an np.array of likelihoods for soft evidence (see
+                Factor.as_evidence).
+
+            Returns
+            -------
+                Factor
+                A factor containing the desired marginals, the same as
+                VariableElimination.bucket_marginals would return.
+        """
+        if not evidence:
+            evidence = {}
+        variables = list(variables)
+        for v in variables:
+            if v not in self.cardinalities:
+                raise ValueError("The variable {} is not part of the "
+                                 "network.".format(v))
+        likelihoods, domains = self._domains(evidence)
+        plan, cost = self._plan(variables, domains)
+        caches = {}
+        for node, (cutset, context, cached) in plan.items():
+            if cached:
+                caches[node] = np.full([self.cardinalities[v] for v in context], 
+                                       np.nan, dtype=self.bn.dtype)
+
+        # The cpd of each leaf is weighted by the evidence on its variable,
+        # which is summed out at the leaf if it is not instantiated there
+        leaves = {}
+        stack = [(self.root, frozenset(variables))]
+        while stack:
+            node, acutset = stack.pop()
+            if node is None:
+                continue
+            if node.family is None:
+                childAcutset = acutset.union(plan[node][0])
+                stack.append((node.left, childAcutset))
+                stack.append((node.right, childAcutset))
+                continue
+            n = self.bn.get_node(node.family)
+            cpd = n.cpd
+            if node.family in likelihoods:
+                shape = (-1,) + (1,) * (np.ndim(cpd) - 1)
+                cpd = cpd * likelihoods[node.family].reshape(shape)
+            if node.family not in acutset:
+                cpd = np.sum(cpd, axis=0)
+                leaves[node] = (cpd, list(n.parentOrder))
+            else:
+                leaves[node] = (cpd, [n.name] + list(n.parentOrder))
+
+        instantiation = {}
+        def condition(node):
+            if node.family is not None:
+                cpd, order = leaves[node]
+                return cpd[tuple(instantiation[v] for v in order)]
+            cutset, context, cached = plan[node]
+            if cached:
+                key = tuple(instantiation[v] for v in context)
+                res = caches[node][key]
+                if not np.isnan(res):
+                    return res
+            res = 0.0
+            for values in itertools.product(*[domains[v] for v in cutset]):
+                instantiation.update(zip(cutset, values))
+                left = condition(node.left)
+                if left != 0:
+                    res += left * condition(node.right)
+            if cached:
+                caches[node][key] = res
+            return res
+
+        res = Factor.zero_factor(variables, {v: self.bn.get_node(v).values for v in variables})
+        for values in itertools.product(*[domains[v] for v in variables]):
+            instantiation.update(zip(variables, values))
+            res.potentials[values] = condition(self.root) if self.root is not None else 1.0
+        return res.normalize()
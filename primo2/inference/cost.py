@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of PRIMO2 -- Probabilistic Inference Modules.
+# Copyright (C) 2013-2017 Social Cognitive Systems Group,
+#                         Faculty of Technology, Bielefeld University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the Lesser GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+from .. import exceptions
+
+def table_size(scope, cardinalities):
+    """
+        Returns the number of entries of a table over the given variables.
+        Python integers are used, so that the size of huge tables does not
+        overflow.
+
+        Parameters
+        ----------
+        scope : [String,] or set(String,)
+            The variables of the table.
+        cardinalities : dict
+            Dictionary containing the number of values of each variable.
+
+        Returns
+        -------
+            int
+            The number of entries.
+    """
+    res = 1
+    for v in scope:
+        res *= cardinalities[v]
+    return res
+
+
+class CostEstimate(object):
+    """
+        Estimated cost of an exact inference, which is computed from the
+        elimination order or the clique structure before any table is
+        allocated. All tables are assumed to be dense, so that sparse
+        factors can only make the inference cheaper.
+    """
+
+    def __init__(self, largestTable=0, operations=0, peakBytes=0):
+        """
+            Parameters
+            ----------
+            largestTable : int, optional
+                The number of entries of the largest table.
+            operations : int, optional
+                The approximate number of floating point operations.
+            peakBytes : int, optional
+                The approximate number of bytes of all tables that are
+                allocated at the same time.
+        """
+        self.largestTable = largestTable
+        self.operations = operations
+        self.peakBytes = peakBytes
+
+    def fits(self, memoryBudget):
+        """
+            Returns True if the peak memory does not exceed the given budget
+            (in bytes). A budget of None is unlimited.
+        """
+        return memoryBudget is None or self.peakBytes <= memoryBudget
+
+    def check(self, memoryBudget, engine):
+        """
+            Raises a MemoryBudgetError if the peak memory exceeds the given
+            budget.
+
+            Parameters
+            ----------
+            memoryBudget : int
+                The budget in bytes or None if the memory is unlimited.
+            engine : String
+                The name of the inference engine used in the error message.
+        """
+        if not self.fits(memoryBudget):
+            raise exceptions.MemoryBudgetError(
+                    "The estimated peak memory of {} ({} bytes, largest table"
+                    " with {} entries) exceeds the memory budget of {} bytes."
+                    .format(engine, self.peakBytes, self.largestTable, memoryBudget))
+
+    def __repr__(self):
+        return "CostEstimate(largestTable={}, operations={}, peakBytes={})" \
+                .format(self.largestTable, self.operations, self.peakBytes)
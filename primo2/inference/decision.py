@@ -64,7 +64,7 @@ class VariableElimination(object):
                 A joint factor with the given variable marginalized out.
         """
         tmp = factor[0].marginalize(variable)
-        return (tmp, (factor[0]*factor[1]).marginalize(variable)/tmp)
+        return (tmp, factor[0].multiply_marginalize(factor[1], variable)/tmp)
 
     def generalized_VE(self, joint_factors, elimination_variables):
         """
@@ -21,16 +21,32 @@
 
 from __future__ import division 
 
+import hashlib
+import heapq
+import json
+import os
+from collections import OrderedDict
+
 import networkx as nx
+import numpy as np
 
-from .factor import Factor
+from .. import exceptions
+from .cost import CostEstimate, table_size
+from .factor import Factor, ScratchSpace, SparseFactor
 from .order import Orderer
+from .relevance import Pruner
 
 class VariableElimination(object):
     
+    # Maximal number of elimination plans that are cached (see get_plan)
+    planCacheSize = 64
+    _plans = OrderedDict()
+    # Default memory budget in bytes of all queries, None is unlimited
+    memoryBudget = None
     
     @staticmethod
-    def naive_marginals(bn, variables, evidence=None):
+    def naive_marginals(bn, variables, evidence=None, logspace=False, prune=False,
+                        memoryBudget=None):
         """
             Function to compute the prior or posterior marginals given evidence
             from a given Bayesian Network for the variables and their 
@@ -51,6 +67,23 @@ class VariableElimination(object):
                 the strength of the evidence for each outcome, e.g.:
                 For the binary evidence node E
                 evidence = {"E": "True"} is equivalent to {"E": np.array([1.0,0.0])}
+            logspace : bool, optional
+                If True, all computations are performed on factors in log 
+                space, which avoids underflows for long evidence streams.
+                The returned (normalized) marginals are converted back to 
+                linear space. (Default: False)
+            prune : bool, optional
+                If True, only the nodes that are requisite for the query are
+                considered (see relevance.Pruner.get_requisite_nodes), i.e.
+                barren nodes and nodes that are d-separated from the 
+                variables by the evidence are removed. (Default: False)
+            memoryBudget : int, optional
+                Maximal number of bytes the query may allocate according to
+                its cost estimate (see estimate_naive_cost). If the joint 
+                distribution exceeds the budget, the query is answered by 
+                bucket_marginals with pruning instead, which raises a 
+                MemoryBudgetError if it exceeds the budget as well. Defaults
+                to VariableElimination.memoryBudget.
                 
             Returns
             -------
@@ -60,30 +93,102 @@ class VariableElimination(object):
         
         if not evidence:
             evidence = {}
+        if memoryBudget is None:
+            memoryBudget = VariableElimination.memoryBudget
+        if memoryBudget is not None:
+            cost = VariableElimination.estimate_naive_cost(bn, variables, evidence, prune)
+            if not cost.fits(memoryBudget):
+                return VariableElimination.bucket_marginals(bn, variables, evidence, 
+                                                            logspace=logspace, prune=True,
+                                                            memoryBudget=memoryBudget)
         
-        order = bn.get_all_node_names()
+        order = VariableElimination._naive_nodes(bn, variables, evidence, prune)
         # Compute joint probability distribution of all variables
-        resFactor = Factor.get_trivial()            
+        resFactor = Factor.get_trivial(logspace=logspace)            
         for v in order:
-            resFactor = resFactor * Factor.from_node(bn.get_node(v))
+            resFactor = resFactor * Factor.from_node(bn.get_node(v), logspace=logspace).sparsify()
             #Add evidence as additional factors
             if v in evidence:
-                resFactor = resFactor * Factor.as_evidence(v, bn.get_node(v).values, evidence[v])
+                resFactor = resFactor * Factor.as_evidence(v, bn.get_node(v).values, evidence[v], logspace=logspace)
+        #Observed parents of pruned networks are not part of the order
+        for e in evidence:
+            if e in resFactor and e not in order:
+                resFactor = resFactor * Factor.as_evidence(e, bn.get_node(e).values, evidence[e], logspace=logspace)
                 
         
         # Marginalise unwated variables
-        for v in order:
+        for v in list(resFactor.variableOrder):
             if v not in variables:
                 resFactor = resFactor.marginalize(v)
                 
         # Normalize to get conditional probability for the evidence
         resFactor.normalize()
                 
-        return resFactor
+        return resFactor.to_linear() if logspace else resFactor
+        
+    @staticmethod
+    def estimate_naive_cost(bn, variables, evidence=None, prune=False):
+        """
+            Estimates the cost of naive_marginals for the given query without
+            allocating any table. The joint distribution built by the naive
+            approach is usually the largest table.
+            
+            See naive_marginals for the parameters.
+            
+            Returns
+            -------
+                CostEstimate
+                The estimated cost.
+        """
+        if not evidence:
+            evidence = {}
+        order = VariableElimination._naive_nodes(bn, variables, evidence, prune)
+        cardinalities = {}
+        res = CostEstimate(largestTable=1)
+        scope = set()
+        def grow(newScope, multiplications):
+            # Accounts for multiplying factors over the new scope into the 
+            # current table, which keeps the old table until the new one 
+            # has been computed
+            old = table_size(scope, cardinalities)
+            scope.update(newScope)
+            new = table_size(scope, cardinalities)
+            res.largestTable = max(res.largestTable, new)
+            res.operations += new * multiplications
+            res.peakBytes = max(res.peakBytes, old + new)
+        for v in order:
+            family = [v] + list(getattr(bn.get_node(v), "parentOrder", []))
+            for n in family:
+                cardinalities[n] = len(bn.get_node(n).values)
+            grow(family, 2 if v in evidence else 1)
+        for e in evidence:
+            if e in scope and e not in order:
+                grow([e], 1)
+        for v in list(scope):
+            if v not in variables:
+                old = table_size(scope, cardinalities)
+                scope.remove(v)
+                res.operations += old
+                res.peakBytes = max(res.peakBytes, old + table_size(scope, cardinalities))
+        res.peakBytes *= np.dtype(getattr(bn, "dtype", np.float64)).itemsize
+        return res
+        
+    @staticmethod
+    def _naive_nodes(bn, variables, evidence, prune):
+        """
+            Returns the names of the nodes whose factors are multiplied by 
+            naive_marginals.
+        """
+        order = bn.get_all_node_names()
+        if prune:
+            requisite = Pruner.get_requisite_nodes(bn, variables, evidence)
+            order = [v for v in order if v in requisite]
+        return order
         
     
     @staticmethod
-    def bucket_marginals(bn, variables, evidence=None, order=None):
+    def bucket_marginals(bn, variables, evidence=None, order=None, logspace=False,
+                         prune=False, memoryBudget=None):
         """
             Function to compute the prior or posterior marginals given evidence
             from a given Bayesian Network for the variables and their 
@@ -91,6 +196,11 @@ class VariableElimination(object):
             in "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche
             Chapter 6.10
             
+            The elimination is planned once per network structure, query 
+            variables and set of evidence variables and cached (see 
+            get_plan), so that repeated queries only differ in the evidence
+            values.
+            
             Parameters
             ----------
             bn : BayesianNetwork
@@ -108,72 +218,900 @@ class VariableElimination(object):
             order : [String,], optional
                 List containing the elimination order of the nodes. If order is not
                 given, this algorithm computes the min degree order automatically.
+            logspace : bool, optional
+                If True, all computations are performed on factors in log 
+                space, which avoids underflows for long evidence streams.
+                The returned (normalized) marginals are converted back to 
+                linear space. (Default: False)
+            prune : bool, optional
+                If True, only the nodes that are requisite for the query are
+                eliminated (see relevance.Pruner.get_requisite_nodes), i.e.
+                barren nodes and nodes that are d-separated from the 
+                variables by the evidence are removed. If no order is given,
+                it is only computed for the requisite nodes. (Default: False)
+            memoryBudget : int, optional
+                Maximal number of bytes the query may allocate according to
+                the cost estimate of its plan (see EliminationPlan.cost). If 
+                the plan exceeds the budget, the query is pruned if it was 
+                not already, and a MemoryBudgetError is raised if it still 
+                exceeds the budget. Defaults to 
+                VariableElimination.memoryBudget.
                 
             Returns
             -------
                 Factor
                 A factor containing the desired marginals
         """
+        if memoryBudget is None:
+            memoryBudget = VariableElimination.memoryBudget
+        plan = VariableElimination.get_plan(bn, variables, evidence, order, prune)
+        if not plan.cost.fits(memoryBudget) and not prune:
+            plan = VariableElimination.get_plan(bn, variables, evidence, order, True)
+        plan.cost.check(memoryBudget, "bucket elimination")
+        return plan.execute(bn, evidence, logspace)
         
-        if not order:
-            order = Orderer.get_min_degree_order(bn)
+    @classmethod
+    def get_plan(cls, bn, variables, evidence=None, order=None, prune=False):
+        """
+            Returns the elimination plan used by bucket_marginals for the 
+            given query. Plans only depend on the structure of the network,
+            the query variables and which variables have hard or soft 
+            evidence, but not on the evidence values. They are kept in a 
+            least recently used cache of at most planCacheSize plans, keyed
+            by the structure fingerprint of the network (see 
+            BayesianNetwork.get_structure_fingerprint), so that repeated
+            queries with new evidence values skip all planning.
+            
+            See bucket_marginals for the parameters.
             
+            Returns
+            -------
+                EliminationPlan
+                The (cached) plan.
+        """
         if not evidence:
             evidence = {}
+        hardVariables, softVariables = _evidence_kinds(variables, evidence)
+        key = (bn.get_structure_fingerprint(), tuple(variables), hardVariables, 
+               softVariables, tuple(order) if order else None, prune)
+        plan = cls._plans.pop(key, None)
+        if plan is None:
+            plan = EliminationPlan(bn, variables, evidence, order, prune)
+        # Reinserting marks the plan as most recently used
+        cls._plans[key] = plan
+        while len(cls._plans) > cls.planCacheSize:
+            cls._plans.popitem(last=False)
+        return plan
         
-        #Move query variables at the end of the order
-        for v in variables:
-            order.remove(v)
-            order.append(v)
+    @classmethod
+    def clear_plans(cls):
+        """
+            Removes all cached elimination plans (see get_plan).
+        """
+        cls._plans.clear()
+        
+    @staticmethod
+    def bucket_mpe(bn, evidence=None, variables=None, order=None, logspace=False, 
+                   k=1, log=False):
+        """
+            Function to compute the most probable explanation (MPE), i.e. 
+            the most probable assignment of all unobserved variables, or the
+            marginal MAP assignment of the given variables given evidence.
+            Uses the max-variant of the bucket elimination strategy, where
+            the variables not contained in the query are summed out first
+            and the query variables are maximised out afterwards. The 
+            maximising assignment is recovered by a traceback through the
+            products of the maximised buckets, see "Modeling and Reasoning
+            with Bayesian Networks" - Adnan Darwiche Chapter 10.
             
-        factors = [Factor.from_node(bn.get_node(v)) for v in order]
+            Parameters
+            ----------
+            bn : BayesianNetwork
+                The network that is supposed to be queried.
+            evidence : dict, optional
+                Dictionary containing the given evidence (see 
+                bucket_marginals). Soft evidence is interpreted as 
+                likelihood ratio.
+            variables : [String,], optional
+                List containing the names of the variables whose marginal 
+                MAP assignment is desired. If not given, the MPE over all
+                variables is computed. Variables with hard evidence are never
+                part of the assignment.
+            order : [String,], optional
+                List containing the elimination order of the nodes. If order is not
+                given, this algorithm computes the min degree order automatically.
+            logspace : bool, optional
+                If True, all computations are performed on factors in log 
+                space, which avoids underflows for long evidence streams.
+                (Default: False)
+            k : int, optional
+                The number of most probable assignments that are returned.
+                (Default: 1)
+            log : bool, optional
+                If True, the natural logarithms of the probabilities are 
+                returned. (Default: False)
+                
+            Returns
+            -------
+                [(dict, float),]
+                List containing up to k pairs of an assignment, given as
+                dictionary mapping the variables to their values, and its
+                joint probability with the evidence, sorted by decreasing 
+                probability. Assignments with probability 0 are omitted.
+        """
+        if not order:
+            order = Orderer.get_min_degree_order(bn)
+        if not evidence:
+            evidence = {}
+        solve = lambda constraints: VariableElimination._bucket_max(bn, 
+                                        variables, constraints, order, logspace)
+        return _k_best(solve, bn, evidence, k, log)
         
-        #Create buckets with trivial factors (one more than variables
-        #for trivial factors later
-        buckets = [Factor.get_trivial() for i in range(len(order)+1)]
+    @staticmethod
+    def _bucket_max(bn, variables, evidence, order, logspace=False):
+        """
+            Helper function computing the most probable assignment of the 
+            given variables (all unobserved variables if None) for the given
+            evidence (see bucket_mpe).
+            
+            Returns
+            -------
+                (dict, float)
+                The maximising assignment and the logarithm of its joint 
+                probability with the evidence or None if the evidence is
+                impossible.
+        """
+        hardEvidence = {e: evidence[e] for e in evidence 
+                        if not isinstance(evidence[e], np.ndarray)}
+        if variables is None:
+            variables = order
+        maxVars = set(v for v in variables if v not in hardEvidence)
+        #Sum out all other variables before the maximised ones
+        order = [v for v in order if v not in hardEvidence and v not in maxVars] \
+                + [v for v in order if v in maxVars]
         
-        #Place factors in the first buckets they correlate to
-        for f in factors:
+        buckets = [[] for i in range(len(order)+1)]
+        for n in bn.get_all_nodes():
+            f = Factor.from_node(n, copy=False, logspace=logspace).reduce(hardEvidence)
             for i in range(len(order)):
                 if order[i] in f:
-                    buckets[i] = buckets[i] *f
-                    break                                        
-
-        # Add evidence to buckets
-        for e in evidence.keys():
-            bucketI = order.index(e)
-            buckets[bucketI] = buckets[bucketI] * Factor.as_evidence(e, bn.get_node(e).values, evidence[e])
-            
-        bucketUntil = len(order)- len(variables)
-        # Process buckets
-        for i in range(bucketUntil):
-            tmpFactor = buckets[i].marginalize(order[i])
+                    buckets[i].append(f)
+                    break
+            else:
+                buckets[-1].append(f)
+        for e in evidence:
+            if e not in hardEvidence:
+                buckets[order.index(e)].append(Factor.as_evidence(e, 
+                            bn.get_node(e).values, evidence[e], logspace=logspace))
+        
+        #The products of the maximised buckets are kept for the traceback
+        maximised = []
+        for i, v in enumerate(order):
+            if v in maxVars:
+                product = VariableElimination._product(buckets[i], logspace)
+                maximised.append((v, product))
+                tmpFactor = product.max_marginalize(v)
+            else:
+                tmpFactor = VariableElimination._sum_product(buckets[i], v, logspace)
             for j in range(i+1, len(order)):
                 if order[j] in tmpFactor:
-                    buckets[j] = buckets[j] * tmpFactor
+                    buckets[j].append(tmpFactor)
                     break
             else:
-                # No suitable bucket found -> factor is trivial
-                buckets[-1] = buckets[-1] * tmpFactor
+                buckets[-1].append(tmpFactor)
+                
+        value = VariableElimination._product(buckets[-1], logspace).potentials
+        with np.errstate(divide="ignore"):
+            logValue = float(value if logspace else np.log(value))
+        if logValue == -np.inf:
+            return None
+        
+        #Traceback: All other variables of a maximised bucket are maximised
+        #later, so that their values are known when the bucket is reached
+        assignment = {}
+        for v, product in reversed(maximised):
+            potentials = np.asarray(product.reduce(assignment).potentials)
+            assignment[v] = product.values[v][int(np.argmax(potentials))]
+        return assignment, logValue
+        
+    @staticmethod
+    def _product(factors, logspace=False):
+        """
+            Helper function to multiply all given factors.
+            
+            Parameters
+            ----------
+            factors : [Factor,]
+                The factors that should be multiplied.
+            logspace : bool, optional
+                Whether the factors are represented in log space.
+                
+            Returns
+            -------
+                Factor
+                The product of all factors (a trivial factor if no factors 
+                were given).
+        """
+        if not factors:
+            return Factor.get_trivial(logspace=logspace)
+        sparse = [f for f in factors if f.sparse]
+        if sparse:
+            #Keep the product sparse by starting with a sparse factor
+            res = sparse[0]
+            for f in factors:
+                if f is not sparse[0]:
+                    res = res * f
+            return res if len(factors) > 1 else res.copy()
+        #Allocate the result once and multiply all factors into it
+        variableOrder = []
+        values = {}
+        for f in factors:
+            for v in f.variableOrder:
+                if v not in values:
+                    variableOrder.append(v)
+                    values[v] = f.values[v]
+        res = Factor.unit_factor(variableOrder, values, logspace=logspace,
+                                 dtype=np.result_type(*[f.dtype for f in factors]))
+        for f in factors:
+            res.imul(f)
+        return res
+        
+    @staticmethod
+    def _sum_product(factors, variable, logspace=False):
+        """
+            Helper function to multiply all given factors and to sum out the
+            given variable. The last product is fused with the summation so 
+            that the full product of the bucket is never materialised.
+            
+            Parameters
+            ----------
+            factors : [Factor,]
+                The factors of a bucket.
+            variable : String
+                The variable that is summed out.
+            logspace : bool, optional
+                Whether the factors are represented in log space.
+                
+            Returns
+            -------
+                Factor
+                The resulting factor without the given variable.
+        """
+        if not factors:
+            return Factor.get_trivial(logspace=logspace)
+        res = VariableElimination._product(factors[:-1], logspace)
+        return res.multiply_marginalize(factors[-1], variable)
+        
+def _evidence_kinds(variables, evidence):
+    """
+        Splits the variables of the given evidence into the ones whose hard
+        evidence is sliced out of the factors during bucket elimination and
+        the ones whose evidence is multiplied as factor, i.e. soft evidence
+        and evidence on queried variables.
+        
+        Returns
+        -------
+            (frozenset(String,), frozenset(String,))
+            The hard and the soft evidence variables.
+    """
+    hardVariables = frozenset(e for e in evidence 
+                              if not isinstance(evidence[e], np.ndarray) 
+                              and e not in variables)
+    return hardVariables, frozenset(evidence).difference(hardVariables)
+
+
+class EliminationPlan(object):
+    """
+        Bucket elimination (see VariableElimination.bucket_marginals) that 
+        has been planned for a network structure, query variables and the 
+        variables having hard or soft evidence. The elimination order, the 
+        bucket of each factor and the bucket receiving the result of each 
+        eliminated bucket are determined once from the scopes of the 
+        factors, so that executing the plan for new evidence values only 
+        multiplies and sums out factors. The factors of the nodes are cached
+        as well and rebuilt once their cpd changes (see 
+        RandomNode.touch). The cost of executing the plan is estimated
+        from the scopes of the buckets (see cost).
+    """
+    
+    def __init__(self, bn, variables, evidence=None, order=None, prune=False):
+        """
+            Plans the elimination for the given query. Only the variables of
+            the given evidence and whether it is hard or soft evidence are
+            used. See VariableElimination.bucket_marginals for the 
+            parameters.
+        """
+        if not evidence:
+            evidence = {}
+        self.variables = list(variables)
+        self.hardVariables, self.softVariables = _evidence_kinds(variables, evidence)
+        if prune:
+            requisite = Pruner.get_requisite_nodes(bn, variables, evidence)
+            if not order:
+                order = Orderer.get_min_degree_order(bn, requisite)
+            order = [v for v in order if v in requisite]
+        elif not order:
+            order = Orderer.get_min_degree_order(bn)
+        for v in self.variables:
+            if v not in order:
+                raise ValueError("The variable {} is not contained in the "
+                                 "elimination order.".format(v))
+        #Query variables are moved to the end of the order. The factors of 
+        #all nodes in the order are used.
+        self.nodes = [v for v in order if v not in self.variables] + self.variables
+        #Hard evidence for variables that are not queried is sliced out of 
+        #the factors, so that these variables do not need to be eliminated
+        self.order = [v for v in self.nodes if v not in self.hardVariables]
+        position = {v: i for i, v in enumerate(self.order)}
+        # Scope of each bucket (one more than variables for trivial factors)
+        scopes = [set() for _ in range(len(self.order)+1)]
+        def place(scope):
+            # Returns the first bucket of a variable of the given scope
+            return min(position[v] for v in scope) if scope else len(self.order)
+        
+        # Bucket of the factor of each node and of each soft evidence
+        self.nodeBuckets = []
+        for name in self.nodes:
+            scope = set([name]).union(getattr(bn.get_node(name), "parentOrder", []))
+            scope.difference_update(self.hardVariables)
+            bucket = place(scope)
+            self.nodeBuckets.append((name, bucket))
+            scopes[bucket].update(scope)
+        self.evidenceBuckets = [(e, position[e]) for e in self.softVariables 
+                                if e in position]
+        # Bucket receiving the result of each eliminated bucket
+        self.bucketUntil = len(self.order) - len(self.variables)
+        self.targets = []
+        for i in range(self.bucketUntil):
+            scope = scopes[i].difference([self.order[i]])
+            bucket = place(scope)
+            self.targets.append(bucket)
+            scopes[bucket].update(scope)
+        self.cost = self._estimate_cost(bn, scopes)
+        # (node, cpdVersion, factor, sparsified factor) for each node name 
+        # and logspace
+        self._factors = {}
+        
+    def execute(self, bn, evidence=None, logspace=False):
+        """
+            Computes the marginals of the planned query variables given the
+            evidence values.
+            
+            Parameters
+            ----------
+            bn : BayesianNetwork
+                A network with the structure the plan was created for.
+            evidence : dict, optional
+                The evidence (see VariableElimination.bucket_marginals), 
+                which needs to contain the same variables with the same kind
+                of evidence as the evidence the plan was created for.
+            logspace : bool, optional
+                If True, all computations are performed on factors in log 
+                space. (Default: False)
+                
+            Returns
+            -------
+                Factor
+                A factor containing the desired marginals
+        """
+        if not evidence:
+            evidence = {}
+        if _evidence_kinds(self.variables, evidence) != (self.hardVariables, self.softVariables):
+            raise ValueError("The evidence does not match the evidence this "
+                             "plan was created for.")
+        hardEvidence = {e: evidence[e] for e in self.hardVariables}
+        
+        #The factors of a bucket are only multiplied when the bucket is 
+        #processed, which allows to fuse the last product with the 
+        #elimination of the bucket's variable.
+        buckets = [[] for i in range(len(self.order)+1)]
+        for name, bucket in self.nodeBuckets:
+            buckets[bucket].append(self._node_factor(bn.get_node(name), 
+                                                     hardEvidence, logspace))
+        for e, bucket in self.evidenceBuckets:
+            buckets[bucket].append(Factor.as_evidence(e, bn.get_node(e).values, 
+                                                      evidence[e], logspace=logspace))
+        for i in range(self.bucketUntil):
+            buckets[self.targets[i]].append(VariableElimination._sum_product(
+                                                buckets[i], self.order[i], logspace))
                 
         #Compute marginals of intended variables
-        for i in range(bucketUntil, len(buckets)-1):
+        buckets = [VariableElimination._product(b, logspace) for b in buckets]
+        for i in range(self.bucketUntil, len(buckets)-1):
             buckets[i+1] = buckets[i+1] * buckets[i]
             
         # Normalize evidence
         buckets[-1].normalize()
 
-        return buckets[-1]
+        return buckets[-1].to_linear() if logspace else buckets[-1]
+        
+    def _estimate_cost(self, bn, scopes):
+        """
+            Estimates the cost of executing this plan from the given scopes 
+            of its buckets. The memory accounts for the product of the 
+            processed bucket, its result and all results waiting in later
+            buckets, while the node factors are views on the cpds.
+            
+            Returns
+            -------
+                CostEstimate
+                The estimated cost.
+        """
+        cardinalities = {}
+        for scope in scopes:
+            for v in scope:
+                if v not in cardinalities:
+                    cardinalities[v] = len(bn.get_node(v).values)
+        numFactors = [0] * len(scopes)
+        for name, bucket in self.nodeBuckets:
+            numFactors[bucket] += 1
+        for e, bucket in self.evidenceBuckets:
+            numFactors[bucket] += 1
+        res = CostEstimate(largestTable=1)
+        waiting = [0] * len(scopes)
+        live = 0
+        for i in range(self.bucketUntil):
+            product = table_size(scopes[i], cardinalities)
+            result = table_size(scopes[i].difference([self.order[i]]), cardinalities)
+            res.largestTable = max(res.largestTable, product)
+            res.operations += product * max(1, numFactors[i])
+            res.peakBytes = max(res.peakBytes, live + product + result)
+            live += result - waiting[i]
+            waiting[self.targets[i]] += result
+            numFactors[self.targets[i]] += 1
+        # The remaining buckets are multiplied into the joint of the query
+        joint = table_size(set().union(*scopes[self.bucketUntil:]), cardinalities)
+        res.largestTable = max(res.largestTable, joint)
+        res.operations += joint * max(1, sum(numFactors[self.bucketUntil:]))
+        res.peakBytes = max(res.peakBytes, live + 2 * joint)
+        res.peakBytes *= np.dtype(getattr(bn, "dtype", np.float64)).itemsize
+        return res
         
+    def _node_factor(self, node, hardEvidence, logspace):
+        """
+            Returns the (sparsified) factor of the given node reduced by the
+            given hard evidence, using the cached factor of the node unless
+            its cpd changed.
+        """
+        cached = self._factors.get((node.name, logspace))
+        if cached is None or cached[0] is not node or cached[1] != node.cpdVersion:
+            factor = Factor.from_node(node, copy=False, logspace=logspace)
+            cached = (node, node.cpdVersion, factor, factor.sparsify())
+            self._factors[node.name, logspace] = cached
+        reduced = cached[2].reduce(hardEvidence)
+        return cached[3] if reduced is cached[2] else reduced.sparsify()
+        
+
+def _jointree_graph():
+    """
+        Creates an empty graph for a jointree, which provides the same
+        interface for all supported networkx versions.
+    """
+    tree = nx.Graph(messagesValid=False)
+    #Monkey patch networkx 1.x versions to still user iterator functions:
+    if int(nx.__version__[0]) < 2:
+        tree.nodes = tree.nodes_iter
+        tree.neighbors = tree.neighbors_iter
+    #and networkx >= 2.4 versions to still provide the node attribute
+    if not hasattr(tree, "node"):
+        tree.node = tree.nodes
+    return tree
+
+def _cpd_fingerprint(bn):
+    """
+        Computes a fingerprint of the cpds of all nodes of the given network,
+        which is used to check whether saved clique potentials are still up
+        to date (see FactorTree.load).
+    """
+    sha = hashlib.sha1()
+    for n in sorted(bn.get_all_nodes(), key=lambda n: n.name):
+        cpd = np.ascontiguousarray(n.cpd)
+        sha.update(n.name.encode("utf-8"))
+        sha.update(cpd.dtype.str.encode("utf-8"))
+        sha.update(str(cpd.shape).encode("utf-8"))
+        sha.update(cpd.view(np.uint8) if cpd.ndim else cpd.tobytes())
+    return sha.hexdigest()
+
+def _same_evidence(old, new):
+    """
+        Returns True if the two given evidence values (see 
+        FactorTree.set_evidence) are equal. None denotes missing evidence.
+    """
+    if isinstance(old, np.ndarray) or isinstance(new, np.ndarray):
+        return isinstance(old, np.ndarray) and isinstance(new, np.ndarray) \
+                and np.array_equal(old, new)
+    return old == new
+
+def _k_best(solve, bn, evidence, k, log=False):
+    """
+        Finds the k most probable assignments by partitioning the space of
+        assignments (see Nilsson, "An efficient algorithm for finding the M
+        most probable configurations in probabilistic expert systems"): 
+        Once the best assignment of a subspace is found, the rest of the
+        subspace is split into disjoint subspaces, the i-th of which fixes 
+        the first i-1 variables to their values in the best assignment and
+        excludes the value of the i-th variable. These constraints are 
+        expressed as soft evidence, so that any function computing the best
+        assignment for given evidence can be used.
+        
+        Parameters
+        ----------
+        solve : function
+            Function mapping an evidence dictionary to the most probable 
+            assignment and the logarithm of its probability, or to None if
+            the evidence is impossible.
+        bn : BayesianNetwork
+            The network the assignments belong to.
+        evidence : dict
+            The evidence of the query.
+        k : int
+            The maximal number of returned assignments.
+        log : bool, optional
+            If True, the logarithms of the probabilities are returned.
+            
+        Returns
+        -------
+            [(dict, float),]
+            The assignments and their (log) probabilities, sorted by 
+            decreasing probability.
+    """
+    res = []
+    best = solve(evidence)
+    if best is None:
+        return res
+    # The counter avoids comparing the assignments of equally likely entries
+    heap = [(-best[1], 0, best[0], evidence)]
+    counter = 1
+    while heap and len(res) < k:
+        negLogValue, _, assignment, constraints = heapq.heappop(heap)
+        res.append((assignment, -negLogValue if log else float(np.exp(-negLogValue))))
+        if len(res) == k:
+            break
+        prefix = dict(constraints)
+        for v in sorted(assignment):
+            node = bn.get_node(v)
+            values = node.values
+            likelihood = np.ones(len(values)) if prefix.get(v) is None \
+                            else np.array(prefix[v], dtype=float)
+            index = node.value_index(assignment[v])
+            excluded = np.copy(likelihood)
+            excluded[index] = 0
+            if np.any(excluded > 0):
+                subspace = dict(prefix)
+                subspace[v] = excluded
+                candidate = solve(subspace)
+                if candidate is not None:
+                    heapq.heappush(heap, (-candidate[1], counter, candidate[0], subspace))
+                    counter += 1
+            fixed = np.zeros(len(values))
+            fixed[index] = likelihood[index]
+            prefix[v] = fixed
+    return res
+
+class CompiledJointree(object):
+    """
+        Array based view of a jointree used for message passing. Cliques and
+        separators are addressed by integer IDs and stored in flat lists 
+        which share their data dictionaries with the networkx graph, so that
+        factors updated through either view stay consistent. The collect and
+        distribute schedules are computed iteratively once, so that message
+        passing neither recurses nor queries networkx. Queries and evidence
+        are routed to cliques using an index from the variables to the 
+        cliques containing them, so that no clique needs to be scanned.
+    """
+    
+    # Maximal number of variable sets whose covering clique is memoized
+    coveringCacheSize = 1024
+    
+    def __init__(self, tree):
+        """
+            Compiles the given jointree.
+            
+            Parameters
+            ----------
+            tree : nx.Graph
+                The jointree whose nodes hold the clique data and whose edges
+                hold the separator data.
+        """
+        # Clique names, IDs and data dictionaries
+        self.cliqueNames = list(tree.nodes())
+        self.cliqueIds = {name: i for i, name in enumerate(self.cliqueNames)}
+        self.cliques = [tree.node[name] for name in self.cliqueNames]
+        # Separator data dictionaries and the IDs of their two cliques
+        self.separators = []
+        self.sepEnds = []
+        # List of (neighbor, separator) IDs for each clique
+        self.neighbors = [[] for _ in self.cliqueNames]
+        for u, v, edgeData in tree.edges(data=True): # was edges_iter
+            sepId = len(self.separators)
+            a, b = self.cliqueIds[u], self.cliqueIds[v]
+            self.separators.append(edgeData)
+            self.sepEnds.append((a, b))
+            self.neighbors[a].append((b, sepId))
+            self.neighbors[b].append((a, sepId))
+        # IDs of the cliques containing each variable, smallest cliques 
+        # first, and the covering cliques of previously queried variable sets
+        self.variableCliques = {}
+        for clique, cliqueData in enumerate(self.cliques):
+            for v in cliqueData["variables"]:
+                self.variableCliques.setdefault(v, []).append(clique)
+        for cliques in self.variableCliques.values():
+            cliques.sort(key=lambda clique: len(self.cliques[clique]["variables"]))
+        self._coveringCliques = OrderedDict()
+        # Variables the sender sums out for each (sender, separator) pair,
+        # which depend on the current layout of the factors
+        self.sumOut = {}
+        self._collectSchedules = {}
+        self._levels = None
+        
+        # The first clique of each connected part acts as its root
+        self.roots = []
+        self.collectSchedule = []
+        self.distributeSchedule = []
+        visited = set()
+        for root in range(len(self.cliques)):
+            if root in visited:
+                continue
+            self.roots.append(root)
+            collect = self.collect_schedule(root)
+            visited.add(root)
+            visited.update(sender for sender, _, _ in collect)
+            self.collectSchedule.extend(collect)
+            self.distributeSchedule.extend((receiver, sender, sep) for 
+                                           sender, receiver, sep in reversed(collect))
+            
+    def collect_schedule(self, root):
+        """
+            Returns the messages that need to be passed so that the given 
+            clique receives the information of all cliques connected to it.
+            Schedules are cached per root.
+            
+            Parameters
+            ----------
+            root : int
+                The ID of the clique collecting the messages.
+                
+            Returns
+            -------
+                [(int, int, int),]
+                List of (sender, receiver, separator) IDs in which every 
+                clique sends its message only after it received the messages
+                of all its other neighbors. Reversing the list and swapping
+                senders and receivers yields the distribute schedule.
+        """
+        try:
+            return self._collectSchedules[root]
+        except KeyError:
+            pass
+        parents = {root: None}
+        preorder = []
+        stack = [root]
+        while stack:
+            clique = stack.pop()
+            preorder.append(clique)
+            for neighbor, sep in self.neighbors[clique]:
+                if neighbor not in parents:
+                    parents[neighbor] = (clique, sep)
+                    stack.append(neighbor)
+        # In reversed preorder every clique comes after all its descendants
+        schedule = [(clique,) + parents[clique] for clique in reversed(preorder) 
+                        if clique != root]
+        self._collectSchedules[root] = schedule
+        return schedule
+        
+    def branch_schedule(self, clique, parent=None):
+        """
+            Returns the inward messages of the branch of the given clique
+            that faces away from the given neighbor, ending with the message
+            from the clique to that neighbor.
+            
+            Parameters
+            ----------
+            clique : int
+                The ID of the clique collecting the messages of its branch.
+            parent : int, optional
+                The ID of the neighbor the branch faces away from. If None,
+                the branch contains all cliques connected to the clique.
+                
+            Returns
+            -------
+                [(int, int, int),]
+                List of (sender, receiver, separator) IDs in the order of 
+                collect_schedule.
+        """
+        if parent is None:
+            return self.collect_schedule(clique)
+        sep = [s for neighbor, s in self.neighbors[clique] if neighbor == parent][0]
+        preorder = []
+        stack = [(clique, parent, sep)]
+        while stack:
+            message = stack.pop()
+            preorder.append(message)
+            for neighbor, s in self.neighbors[message[0]]:
+                if neighbor != message[1]:
+                    stack.append((neighbor, message[0], s))
+        return list(reversed(preorder))
+        
+    def parallel_schedule(self):
+        """
+            Groups the collect and distribute schedules into levels of 
+            messages that can be passed concurrently. Within a level, no two
+            groups write to the same clique or separator, and all messages 
+            that a level depends on are part of earlier levels. The messages
+            of a group have to be passed sequentially, since they all update
+            the same receiver.
+            
+            Returns
+            -------
+                [[[(int, int, int),],],]
+                The collect levels, ordered by the height of the senders 
+                with one group per receiver.
+                [[[(int, int, int),],],]
+                The distribute levels, ordered by the depth of the senders
+                with one group per message.
+        """
+        if self._levels is not None:
+            return self._levels
+        height = [0] * len(self.cliques)
+        for sender, receiver, sep in self.collectSchedule:
+            height[receiver] = max(height[receiver], height[sender] + 1)
+        collectLevels = {}
+        for message in self.collectSchedule:
+            groups = collectLevels.setdefault(height[message[0]], {})
+            groups.setdefault(message[1], []).append(message)
+        depth = [0] * len(self.cliques)
+        distributeLevels = {}
+        for message in self.distributeSchedule:
+            depth[message[1]] = depth[message[0]] + 1
+            distributeLevels.setdefault(depth[message[0]], []).append([message])
+        self._levels = ([list(collectLevels[h].values()) for h in sorted(collectLevels)],
+                        [distributeLevels[d] for d in sorted(distributeLevels)])
+        return self._levels
+        
+    def variable_clique(self, variable):
+        """
+            Returns the ID of the smallest clique containing the given 
+            variable or None if no clique contains it.
+        """
+        cliques = self.variableCliques.get(variable)
+        return cliques[0] if cliques else None
+        
+    def covering_clique(self, variables):
+        """
+            Returns the ID of the smallest clique containing all given
+            variables or None if there is no such clique. Only the cliques 
+            containing the variable occurring in the fewest cliques are 
+            checked and the result is memoized for repeated queries. The 
+            least recently used results are evicted once more than 
+            coveringCacheSize variable sets are memoized.
+            
+            Parameters
+            ----------
+            variables : [String,] or set(String,)
+                The variables that need to be contained in the clique.
+                
+            Returns
+            -------
+                int
+                The ID of the clique.
+        """
+        key = frozenset(variables)
+        try:
+            res = self._coveringCliques.pop(key)
+        except KeyError:
+            res = self._find_covering_clique(key)
+            if len(self._coveringCliques) >= self.coveringCacheSize:
+                self._coveringCliques.popitem(last=False)
+        self._coveringCliques[key] = res
+        return res
+        
+    def _find_covering_clique(self, variables):
+        """
+            Helper function finding the smallest clique containing all given
+            variables without memoizing the result (see covering_clique).
+        """
+        if not variables:
+            return 0 if self.cliques else None
+        candidates = min((self.variableCliques.get(v, []) for v in variables), key=len)
+        for clique in candidates:
+            if variables.issubset(self.cliques[clique]["variables"]):
+                return clique
+        return None
+        
+    def message_id(self, sender, sep):
+        """
+            Returns the ID of the message that the given clique sends over
+            the given separator. Each separator has two messages, one per
+            direction.
+        """
+        return 2 * sep + (sender != self.sepEnds[sep][0])
+        
+    def update_layout(self):
+        """
+            Recomputes the variables that have to be summed out for each 
+            message from the current clique and separator factors. Needs to
+            be called whenever their variables change, e.g. after hard 
+            evidence has been sliced out of them.
+        """
+        self.sumOut = {}
+        for sep, ends in enumerate(self.sepEnds):
+            sepVars = set(self.separators[sep]["factor"].variableOrder)
+            for clique in ends:
+                self.sumOut[clique, sep] = [v for v in 
+                                            self.cliques[clique]["factor"].variableOrder
+                                            if v not in sepVars]
+
 class FactorTree(object):
     
-    def __init__(self, tree, bn):
+    # Default memory budget in bytes of create_jointree (None is unlimited)
+    memoryBudget = None
+    # Supported propagation architectures (see create_jointree)
+    architectures = ("hugin", "shafer-shenoy")
+    
+    def __init__(self, tree, bn, logspace=False, dtype=None, storage=None,
+                 incremental=False, lazy=False, architecture=None):
+        if architecture is None:
+            architecture = "shafer-shenoy" if incremental or lazy else "hugin"
+        if architecture not in self.architectures:
+            raise ValueError("Unknown propagation architecture {}, expected "
+                             "one of {}.".format(architecture, list(self.architectures)))
+        if architecture == "hugin" and (incremental or lazy):
+            raise ValueError("Incremental and lazy propagation require the "
+                             "shafer-shenoy architecture.")
         self.tree = tree
         self.bn = bn
+        self.logspace = logspace
+        # Floating point type of all clique and separator potentials
+        self.dtype = np.dtype(dtype if dtype is not None 
+                              else getattr(bn, "dtype", np.float64)).type
+        # The evidence that was last set (see set_evidence)
+        self.evidence = {}
+        self.softPosteriors = False
+        # Hard evidence that is currently sliced out of the clique and 
+        # separator factors (see reset_factors)
+        self.hardEvidence = {}
+        # ScratchSpace allocating the clique and separator potentials, if 
+        # they are memory-mapped (see create_jointree)
+        self.storage = storage
+        # Array based view of the tree used for message passing
+        self.compiled = CompiledJointree(tree)
+        # The propagation architecture (see create_jointree)
+        self.architecture = architecture
+        # State of the incremental (Shafer-Shenoy) propagation, which
+        # is (re)built lazily: the initial potential of each clique, the 
+        # evidence factors assigned to it, one message per directed 
+        # separator and validity flags for messages and clique beliefs.
+        self.incremental = architecture == "shafer-shenoy"
+        # If True, messages are only computed when a query needs them
+        self.lazy = lazy
+        self._initial = None
+        self._cliqueEvidence = None
+        self._messages = None
+        self._messageValid = None
+        self._messageScales = None
+        self._beliefValid = None
+        self._priorMessages = None
+        # Sum of the logarithms of the constants the separators were
+        # normalized with during the last inward pass (see 
+        # get_evidence_probability)
+        self._logNormalizer = 0.0
+        # Names of the nodes whose factors are assigned to each clique and
+        # the immutable initial clique potentials (see reset_factors), 
+        # together with the cpd version of the network they were built from
+        self._assignment = None
+        self._snapshot = None
+        self._snapshotVersion = None
+        # Executor passing independent messages concurrently (see 
+        # set_executor) and whether it was created by this jointree
+        self.executor = None
+        self._ownsExecutor = False
         
     
     @classmethod
-    def create_jointree(cls, bn, order=None):
+    def create_jointree(cls, bn, order=None, logspace=False, dtype=None, 
+                        scratchDir=None, incremental=False, lazy=False, 
+                        executor=None, relevantVariables=None,
+                        memoryBudget=None, architecture=None):
         """
             Creates a jointree according to 
             "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche
@@ -188,6 +1126,84 @@ class FactorTree(object):
                 Elimination order used to create the jointree. If order is not
                 given, this algorithm computes the min degree order automatically.
                 
+            logspace : bool, optional
+                If True, all clique and separator potentials as well as the 
+                evidence are represented in log space, so that long evidence 
+                streams can be propagated without underflows. Marginals are
+                still returned in linear space. (Default: False)
+                
+            dtype : np.dtype, optional
+                Floating point type of the clique and separator potentials.
+                Using np.float32 halves the memory and bandwidth required
+                for propagation (see compare_precision to check the 
+                resulting accuracy). Defaults to the dtype of the network.
+                
+            scratchDir : String or ScratchSpace, optional
+                If given, the clique and separator potentials are stored in
+                np.memmap files within this directory, so that jointrees 
+                whose cliques exceed the available memory can still be 
+                propagated. Large potentials are multiplied and marginalised
+                in chunks (see Factor.chunkBytes). Call close() to remove 
+                the files. Combine with BayesianNetwork.memmap_cpds to also
+                keep the CPTs out of memory.
+                
+            incremental : bool, optional
+                If True, set_evidence only re-initializes the cliques whose
+                evidence changed and only recomputes the messages depending
+                on them, so that adding or retracting single observations 
+                does not propagate the entire tree again. To allow this, 
+                hard evidence is multiplied into the cliques instead of 
+                being sliced out, and a message is kept per direction of 
+                each separator. (Default: False)
+                
+            lazy : bool, optional
+                If True, no messages are propagated when the evidence 
+                changes. Instead, marginals only collects the missing 
+                messages towards the clique containing the query variables,
+                and the messages are cached for later queries. Implies 
+                incremental. (Default: False)
+                
+            executor : concurrent.futures.Executor or int, optional
+                Thread pool used to pass independent messages concurrently
+                (see set_executor).
+                
+            relevantVariables : [String,], optional
+                If given, the jointree is only compiled for queries and 
+                evidence on these variables: Nodes that are barren for them
+                (see relevance.Pruner.get_ancestral_nodes) are removed 
+                before compilation, which does not change any marginal or 
+                probability of evidence. Since the evidence values are not
+                known yet, nodes are not pruned based on d-separation. 
+                Setting evidence on other variables raises a ValueError. 
+                The jointree's network (bn) is the pruned subnetwork, which
+                shares its nodes with the given network.
+                
+            memoryBudget : int, optional
+                Maximal number of bytes the clique and separator potentials
+                may take up according to estimate_cost. If the jointree 
+                exceeds the budget, a MemoryBudgetError is raised before any
+                potential is allocated. Defaults to FactorTree.memoryBudget.
+                
+            architecture : String, optional
+                The propagation architecture, either "hugin" or 
+                "shafer-shenoy". Hugin keeps the calibrated clique and 
+                separator potentials and updates them by dividing each new
+                separator by the old one. Shafer-Shenoy never divides: it 
+                keeps a message per direction of each separator, computed 
+                from the clique's initial potential and all other incoming
+                messages, and clique beliefs are only multiplied when a 
+                query needs them. This is numerically safer with zeros and 
+                cheaper if only some cliques are queried, while Hugin 
+                needs fewer multiplications for a full propagation. Hard
+                evidence is multiplied into the cliques by Shafer-Shenoy
+                instead of being sliced out, so its factors keep the 
+                observed variables, and its messages cannot be passed
+                concurrently (combining it with an executor raises a 
+                ValueError). 
+                Incremental and lazy propagation use Shafer-Shenoy, which 
+                is the default if either is set, otherwise Hugin is used.
+                Batch, MPE and max-product queries always use Hugin.
+                
             Returns
             -------
                 FactorTree
@@ -195,14 +1211,80 @@ class FactorTree(object):
                 efficiently.
         """
         
+        bn, order = cls._prepare_network(bn, order, relevantVariables)
+        clusterSeq = cls._cluster_sequence(bn, order)
+        if dtype is None:
+            dtype = getattr(bn, "dtype", np.float64)
+        if memoryBudget is None:
+            memoryBudget = cls.memoryBudget
+        if memoryBudget is not None:
+            cost = cls._estimate_clusters(bn, clusterSeq, dtype)
+            cost.check(memoryBudget, "the jointree")
+            
+        # Construct jointree
+        tree = _jointree_graph()
+        
+        storage = scratchDir
+        if scratchDir is not None and not isinstance(scratchDir, ScratchSpace):
+            storage = ScratchSpace(scratchDir)
+        values = {n.name: n.values for n in bn.get_all_nodes()}
+        # Clique names are the concatenated variable names, which are made
+        # unique since e.g. ["ab", "c"] and ["a", "bc"] would collide.
+        names = []
+        for cl in clusterSeq:
+            name = "".join(cl)
+            suffix = 1
+            while name in names:
+                name = "{}#{}".format("".join(cl), suffix)
+                suffix += 1
+            names.append(name)
+        # Separators get preallocated factors which are reused for every 
+        # propagation. Dense clique factors are allocated on the first reset
+        # (see _initialize_clique), sparse cliques never need them.
+        for i in range(len(clusterSeq)-1,-1,-1):
+            tree.add_node(names[i], 
+                          variables=set(clusterSeq[i]), 
+                          order=list(clusterSeq[i]),
+                          factor=None, buffer=None)
+        for i, j, jointreeProp in cls._cluster_edges(clusterSeq):
+            sepOrder = [v for v in clusterSeq[i] if v in jointreeProp]
+            tree.add_edge(names[i], names[j], 
+                          sep=jointreeProp, order=sepOrder,
+                          factor=Factor.unit_factor(sepOrder, values, logspace, 
+                                                    dtype, storage),
+                          buffer=Factor.unit_factor(sepOrder, values, logspace, 
+                                                    dtype, storage))
+                    
+        res = cls(tree, bn, logspace, dtype, storage, incremental, lazy, 
+                  architecture)
+        res.set_executor(executor)
+        # Assign factors to clusters
+        res.reset_factors()
+        return res
+        
+    @staticmethod
+    def _prepare_network(bn, order, relevantVariables):
+        """
+            Returns the (pruned) network and the elimination order the 
+            jointree is compiled from (see create_jointree).
+        """
+        if relevantVariables is not None:
+            bn = Pruner.prune_barren_nodes(bn, relevantVariables)
+            if order:
+                order = [v for v in order if v in bn.get_all_node_names()]
         if not order:
             order = Orderer.get_min_degree_order(bn)
-            
+        return bn, order
+        
+    @staticmethod
+    def _cluster_sequence(bn, order):
+        """
+            Returns the maximal clusters induced by the given elimination 
+            order, in the order in which they are connected to the jointree.
+        """
         moralG = bn.graph.to_undirected()
-        factors = []
         #Add edges between parents
         for n in bn.get_all_nodes():
-            factors.append(Factor.from_node(n))
             for p in n.parents:
                 for p2 in n.parents:
                     if p != p2:
@@ -227,67 +1309,266 @@ class FactorTree(object):
             clusterSeq.remove(rem)
             clusterSeq.insert(idx, move)
             clusterSeq.remove(move)
-            
-        # Construct jointree
-        tree = nx.Graph(messagesValid=False)
-        
-        
-        #Monkey patch networkx 1.x versions to still user iterator functions:
-        if int(nx.__version__[0]) < 2:
-            tree.nodes = tree.nodes_iter
-            tree.neighbors = tree.neighbors_iter
-            
-        
-        if len(clusterSeq) > 0:
-            tree.add_node("".join(clusterSeq[-1]), 
-                          variables=set(clusterSeq[-1]), 
-                          factor=Factor.get_trivial())
-            for i in range(len(clusterSeq)-2,-1,-1):
-                tree.add_node("".join(clusterSeq[i]), 
-                              variables=set(clusterSeq[i]), 
-                              factor=Factor.get_trivial())
-                jointreeProp = set(clusterSeq[i]).intersection(
-                                                set().union(*clusterSeq[i+1:]))
-                for cl in clusterSeq[i+1:]:
-                    if len(jointreeProp) != 0 and  jointreeProp.issubset(set(cl)):
-                        tree.add_edge("".join(clusterSeq[i]), "".join(cl), 
-                                      sep=jointreeProp, 
-                                      factor=Factor.get_trivial())
-                        break
-                    
-                    
-        # Assign factors to clusters
-        for f in factors:
-            for treeNode, treeData in tree.nodes(data=True): #was nodes_iter in networkx 1.x
-                if set(f.values).issubset(treeData["variables"]):
-                    treeData["factor"] = treeData["factor"] * f
+        return clusterSeq
+        
+    @staticmethod
+    def _cluster_edges(clusterSeq):
+        """
+            Returns the edges of the jointree of the given cluster sequence
+            as tuples (i, j, separator) of cluster indices, where cluster i 
+            is connected to the later cluster j.
+        """
+        res = []
+        for i in range(len(clusterSeq)-2,-1,-1):
+            jointreeProp = set(clusterSeq[i]).intersection(
+                                            set().union(*clusterSeq[i+1:]))
+            for j in range(i+1, len(clusterSeq)):
+                if len(jointreeProp) != 0 and  jointreeProp.issubset(set(clusterSeq[j])):
+                    res.append((i, j, jointreeProp))
                     break
-        return cls(tree,bn)
+        return res
+        
+    @classmethod
+    def estimate_cost(cls, bn, order=None, dtype=None, relevantVariables=None):
+        """
+            Estimates the cost of the jointree that create_jointree would 
+            compile for the given arguments, without allocating any 
+            potential.
+            
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network that is used to create the jointree
+            order : [String,], optional
+                Elimination order used to create the jointree.
+            dtype : np.dtype, optional
+                Floating point type of the potentials.
+            relevantVariables : [String,], optional
+                Variables the jointree is compiled for (see create_jointree).
+                
+            Returns
+            -------
+                CostEstimate
+                The size of the largest clique, the number of operations of 
+                one full propagation and the bytes of all clique and 
+                separator potentials.
+        """
+        bn, order = cls._prepare_network(bn, order, relevantVariables)
+        if dtype is None:
+            dtype = getattr(bn, "dtype", np.float64)
+        return cls._estimate_clusters(bn, cls._cluster_sequence(bn, order), dtype)
+        
+    @classmethod
+    def _estimate_clusters(cls, bn, clusterSeq, dtype):
+        """
+            Returns the CostEstimate of a jointree over the given clusters
+            (see estimate_cost).
+        """
+        cardinalities = {n.name: len(n.values) for n in bn.get_all_nodes()}
+        cliqueSizes = [table_size(cl, cardinalities) for cl in clusterSeq]
+        res = CostEstimate(largestTable=max(cliqueSizes) if cliqueSizes else 0)
+        entries = sum(cliqueSizes)
+        for i, j, sep in cls._cluster_edges(clusterSeq):
+            sepSize = table_size(sep, cardinalities)
+            # Each separator keeps a factor and a buffer. A message is 
+            # marginalized from and multiplied into a clique in both passes.
+            entries += 2 * sepSize
+            res.operations += 2 * (cliqueSizes[i] + cliqueSizes[j]) + 4 * sepSize
+        res.peakBytes = entries * np.dtype(dtype).itemsize
+        return res
         
 
-    def reset_factors(self):
+    def reset_factors(self, hardEvidence=None):
         """
             Resets all the factors in the jointree to the standards given by the
             BayesianNetwork. This is necessary when the evidence changes, or maybe
             some probabilities changed within the BayesianNetwork.
+            
+            The preallocated clique and separator factors are reused, so that
+            this does not allocate new potentials as long as the same 
+            variables are observed. The initial clique potentials are only
+            computed once from the network and kept as snapshot, from which
+            the cliques are restored by copying. The snapshot is rebuilt 
+            automatically once the cpd of any node changes (see 
+            RandomNode.touch).
+            
+            Parameter
+            ---------
+            hardEvidence : dict, optional
+                Dictionary containing observed variables as keys and their
+                values as values. These variables are sliced out of all 
+                clique and separator factors (see Factor.reduce), which 
+                shrinks the factors by the cardinalities of the observed 
+                variables.
         """        
-        
-        #Create new factors
-        factors = []
-        for n in self.bn.get_all_nodes():
-            factors.append(Factor.from_node(n))
-        #Reset factors in nodes and edges of the tree
-        for treeNode, treeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-            treeData["factor"] = Factor.get_trivial()
+        self.hardEvidence = dict(hardEvidence) if hardEvidence else {}
+        #Reset factors in edges of the tree
+        unit = 0.0 if self.logspace else 1.0
         for u,b, edgeData in self.tree.edges(data=True): # was edges_iter
-            edgeData["factor"] = Factor.get_trivial()
+            sepOrder = [v for v in edgeData["order"] if v not in self.hardEvidence]
+            if edgeData["factor"].variableOrder != sepOrder:
+                values = {v: self.bn.get_node(v).values for v in sepOrder}
+                edgeData["factor"] = Factor.unit_factor(sepOrder, values, 
+                                                        self.logspace, self.dtype,
+                                                        self.storage)
+                edgeData["buffer"] = Factor.unit_factor(sepOrder, values, 
+                                                        self.logspace, self.dtype,
+                                                        self.storage)
+            else:
+                edgeData["factor"].potentials.fill(unit)
             
-        for f in factors:
-            for treeNode, treeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-                if set(f.values).issubset(treeData["variables"]):
-                    treeData["factor"] = treeData["factor"] * f
-                    break
+        snapshot = self._get_snapshot()
+        for clique, treeData in enumerate(self.compiled.cliques):
+            self._restore_clique(treeData, snapshot[clique], self.hardEvidence)
+        self.compiled.update_layout()
         self.tree.graph["messagesValid"] = False
+        # The incremental state is rebuilt from the network when needed
+        self._initial = None
+        
+    def _assign_factors(self, hardEvidence=None):
+        """
+            Assigns the factor of each node of the network to the first
+            clique containing all of its variables.
+            
+            Parameter
+            ---------
+            hardEvidence : dict, optional
+                Observed variables and their values that are sliced out of 
+                the factors.
+            
+            Returns
+            -------
+                dict
+                Dictionary containing the clique names as keys and the lists
+                of their assigned factors as values.
+        """
+        if not hardEvidence:
+            hardEvidence = {}
+        if self._assignment is None:
+            # The assignment only depends on the structure of the network
+            self._assignment = {treeNode: [] for treeNode in self.tree.nodes()}
+            for n in self.bn.get_all_nodes():
+                variables = set([n.name]).union(getattr(n, "parentOrder", []))
+                # Families are only looked up once, so they are not memoized
+                clique = self.compiled._find_covering_clique(variables)
+                if clique is not None:
+                    self._assignment[self.compiled.cliqueNames[clique]].append(n.name)
+        assigned = {}
+        for treeNode, names in self._assignment.items():
+            #The node factors are only used as operands, so views suffice
+            assigned[treeNode] = [Factor.from_node(self.bn.get_node(name), copy=False, 
+                                                   logspace=self.logspace).reduce(hardEvidence)
+                                  for name in names]
+        return assigned
+        
+    def _get_snapshot(self):
+        """
+            Returns the initial potential of each clique (indexed by the 
+            clique IDs of the compiled tree), i.e. the product of the factors
+            assigned to it, without any evidence. The snapshot is rebuilt if
+            the cpd of any node changed since it was built.
+            
+            Returns
+            -------
+                [Factor,]
+                The initial clique potentials, which must not be modified.
+        """
+        if self._snapshot is not None and self._snapshot_valid():
+            return self._snapshot
+        self._snapshotVersion = self.bn.cpdVersion
+        assigned = self._assign_factors()
+        self._snapshot = []
+        for treeNode, treeData in zip(self.compiled.cliqueNames, self.compiled.cliques):
+            nodeData = {"order": treeData["order"], "buffer": None}
+            self._initialize_clique(nodeData, assigned[treeNode], storage=self.storage)
+            self._snapshot.append(nodeData["factor"])
+        return self._snapshot
+        
+    def _snapshot_valid(self):
+        """
+            Returns True if no cpd changed since the snapshot was built.
+        """
+        return self._snapshotVersion == self.bn.cpdVersion
+        
+    def _restore_clique(self, treeData, initial, hardEvidence):
+        """
+            Restores the clique's factor from its initial potential, slicing
+            out the given hard evidence. Dense potentials are copied into the
+            clique's preallocated buffer.
+            
+            Parameters
+            ----------
+            treeData : dict
+                The data dictionary of the clique.
+            initial : Factor
+                The initial potential of the clique (see _get_snapshot).
+            hardEvidence : dict
+                Observed variables and their values.
+        """
+        reduced = initial.reduce(hardEvidence)
+        if reduced.sparse:
+            treeData["factor"] = reduced.copy() if reduced is initial else reduced
+            return
+        buffer = treeData["buffer"]
+        if buffer is None or buffer.variableOrder != reduced.variableOrder:
+            buffer = Factor.unit_factor(reduced.variableOrder, reduced.values,
+                                        self.logspace, self.dtype, self.storage)
+            treeData["buffer"] = buffer
+        np.copyto(buffer.potentials, reduced.potentials)
+        treeData["factor"] = buffer
+        
+    def _initialize_clique(self, treeData, factors, hardEvidence=None, 
+                           storage=None):
+        """
+            Sets the clique's factor to the product of the given factors. 
+            If one of the factors is sparse enough (see Factor.sparsify), the
+            product is computed and kept sparsely, as long as the resulting 
+            clique potential stays below the sparsity threshold. Otherwise,
+            the clique's preallocated dense factor is reused. Cliques whose
+            factor is allocated by a scratch space are always kept dense, so 
+            that no product of the size of the clique is built in memory.
+            
+            Parameters
+            ----------
+            treeData : dict
+                The data dictionary of the clique.
+            factors : [Factor,]
+                The factors assigned to this clique.
+            hardEvidence : dict, optional
+                Observed variables which are not contained in the clique's
+                factor.
+            storage : ScratchSpace, optional
+                Scratch space allocating the clique's dense factor.
+        """
+        if not hardEvidence:
+            hardEvidence = {}
+        order = [v for v in treeData["order"] if v not in hardEvidence]
+        if storage is None:
+            factors = [f.sparsify() for f in factors]
+        sparse = [f for f in factors if f.sparse]
+        if sparse:
+            res = sparse[0]
+            for f in factors:
+                if f is not sparse[0]:
+                    res = res * f
+            missing = [v for v in order if v not in res]
+            if missing:
+                res = res * Factor.unit_factor(missing, 
+                            {v: self.bn.get_node(v).values for v in missing})
+            if res.sparse:
+                treeData["factor"] = res.astype(self.dtype)
+                return
+            factors = [res]
+            
+        if treeData["buffer"] is None or treeData["buffer"].variableOrder != order:
+            treeData["buffer"] = Factor.unit_factor(order, 
+                            {v: self.bn.get_node(v).values for v in order},
+                            self.logspace, self.dtype, storage)
+        clique = treeData["buffer"]
+        clique.potentials.fill(0.0 if self.logspace else 1.0)
+        for f in factors:
+            clique.imul(f)
+        treeData["factor"] = clique
         
         
     def set_evidence(self, evidence, softPosteriors=False):
@@ -313,27 +1594,46 @@ class FactorTree(object):
                 likelihood ratio factor can be computed. If softPosterior is
                 not set, any potential soft evidence is considered as likelihood
                 ratio directly.
+                
+            Hard evidence is not multiplied into the cliques, but sliced out
+            of the clique and separator factors instead (see Factor.reduce).
+            For incremental jointrees (see create_jointree), only the changes
+            compared to the previously set evidence are propagated.
         """
-        self.reset_factors()
+        for e in evidence:
+            if self.compiled.variable_clique(e) is None:
+                raise ValueError("No clique containing the variable {} was found."
+                                 .format(e))
+        if self.incremental:
+            self._set_evidence_incremental(evidence, softPosteriors)
+            return
+        self.evidence = dict(evidence)
+        self.softPosteriors = softPosteriors
         #Initialice temporary marginals to None
         oldMarginals = {e: None for e in evidence}
         if softPosteriors:
             #Compute the old/naive marignals for the evidence values which are
             #required to compute the proper likelihood ratio factor below
+            self.reset_factors()
             self.calculate_messages()
             for e in evidence:
                 oldMarginals[e] = self.marginals([e]).potentials
-            self.reset_factors()
         
-        # Add evidence to buckets
+        hardEvidence = {e: evidence[e] for e in evidence 
+                        if not isinstance(evidence[e], np.ndarray)}
+        self.reset_factors(hardEvidence)
+        
+        # Add soft evidence to buckets
         for e in evidence:
+            if e in hardEvidence:
+                continue
             evidenceFactor = Factor.as_evidence(e, 
                                     self.bn.get_node(e).values, 
-                                    evidence[e], oldMarginals=oldMarginals[e])
-            for node, nodeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-                if e in nodeData["variables"]:
-                    nodeData["factor"] = nodeData["factor"] * evidenceFactor
-                    break
+                                    evidence[e], oldMarginals=oldMarginals[e],
+                                    logspace=self.logspace)
+            clique = self.compiled.variable_clique(e)
+            if clique is not None:
+                self.compiled.cliques[clique]["factor"].imul(evidenceFactor)
         self.calculate_messages()
         
     def marginals(self, variables):
@@ -350,88 +1650,1044 @@ class FactorTree(object):
             variables : [String,]
                 List containing the names of the variables whose joint prior
                 or posterior marginals are desired.
-                Joint marginals for multiple variables can only be computed
-                if they are contained in any clique. To compute the joint
-                marginals for a fixed instantiation, this instantiation can
-                be set as evidence and its probability can be queried using
-                get_evidence_probability()                
+                If the variables are not contained in a common clique, the
+                smallest subtree connecting cliques containing them is 
+                determined and its calibrated clique and separator 
+                potentials are combined by variable elimination, summing 
+                out all other variables as early as possible. To compute 
+                the joint marginals for a fixed instantiation, this 
+                instantiation can be set as evidence and its probability 
+                can be queried using get_evidence_probability()                
                 
             Returns
             -------
                 Factor
                 A factor containing the desired marginals
         """
-        if not self.tree.graph["messagesValid"]:
-            self.calculate_messages()
+        if self.incremental:
+            self._ensure_incremental()
+        else:
+            if not self._snapshot_valid():
+                # Some cpd changed, so the evidence is set again
+                self.set_evidence(self.evidence, self.softPosteriors)
+            if not self.tree.graph["messagesValid"]:
+                self.calculate_messages()
             
         # Determine clique containing variables:
         varSet = set(variables)
-        for treeNode, treeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-            if varSet.issubset(treeData["variables"]):
-                resFactor = treeData["factor"].marginalize(treeData["variables"] - varSet)
-                resFactor.normalize()
-                return resFactor
+        cliqueId = self.compiled.covering_clique(varSet)
+        if cliqueId is not None:
+            if self.incremental:
+                # Only the messages towards this clique are required
+                self._update_messages(self.compiled.collect_schedule(cliqueId))
+                self._update_belief(cliqueId)
+            clique = self.compiled.cliques[cliqueId]["factor"]
+            resFactor = clique.marginalize([v for v in clique.variableOrder 
+                                            if v not in varSet])
         else:
+            resFactor = self._subtree_marginals(varSet)
+        # Observed variables have been sliced out of the cliques
+        for v in variables:
+            if v in self.hardEvidence:
+                resFactor = resFactor * Factor.as_evidence(v, 
+                                self.bn.get_node(v).values, 
+                                self.hardEvidence[v], logspace=self.logspace)
+        resFactor.normalize()
+        return resFactor.to_linear() if self.logspace else resFactor
+        
+    def _subtree_marginals(self, variables):
+        """
+            Computes the unnormalized joint marginals of variables that are
+            not contained in a common clique. For each connected part of the
+            jointree, the smallest subtree connecting cliques that contain 
+            the variables is determined. Its cliques are then eliminated from
+            the leaves towards the root: each clique's potential is 
+            multiplied with the results of its children, divided by the
+            separator towards its parent and all variables that are neither
+            queried nor part of that separator are summed out. In the 
+            Shafer-Shenoy architecture, the initial potential of each clique
+            is only multiplied with the messages from outside the subtree 
+            instead, which avoids the division.
+            
+            Parameters
+            ----------
+            variables : set(String,)
+                The variables whose joint marginals are desired. Variables 
+                whose hard evidence has been sliced out of the cliques are
+                ignored.
+                
+            Returns
+            -------
+                Factor
+                The unnormalized joint marginals.
+        """
+        compiled = self.compiled
+        query = set(v for v in variables if v not in self.hardEvidence)
+        terminals = []
+        for v in query:
+            clique = compiled.variable_clique(v)
+            if clique is None:
+                raise ValueError("No clique containing the variable {} was found."
+                                 .format(v))
+            if clique not in terminals:
+                terminals.append(clique)
+        
+        res = Factor.get_trivial(logspace=self.logspace)
+        while terminals:
+            # Root the connected part of the first remaining terminal there
+            root = terminals[0]
+            parents = {root: None}
+            preorder = []
+            stack = [root]
+            while stack:
+                clique = stack.pop()
+                preorder.append(clique)
+                for neighbor, sep in compiled.neighbors[clique]:
+                    if neighbor not in parents:
+                        parents[neighbor] = (clique, sep)
+                        stack.append(neighbor)
+            # The subtree consists of the paths from the terminals to the root
+            subtree = set([root])
+            for clique in terminals:
+                while clique in parents and clique not in subtree:
+                    subtree.add(clique)
+                    clique = parents[clique][0]
+            terminals = [clique for clique in terminals if clique not in parents]
+            
+            if self.incremental:
+                # Only the messages entering the subtree from outside are 
+                # required, i.e. the inward messages sent by other cliques
+                self._update_messages([message for message in compiled.collect_schedule(root)
+                                        if message[0] not in subtree])
+            else:
+                potentials = self._calibrated_potentials(subtree, parents)
+            results = {clique: [] for clique in subtree}
+            for clique in reversed(preorder):
+                if clique not in subtree:
+                    continue
+                if self.incremental:
+                    factor = self._initial[clique]
+                    for neighbor, sep in compiled.neighbors[clique]:
+                        if neighbor not in subtree:
+                            factor = factor * self._messages[compiled.message_id(neighbor, sep)]
+                else:
+                    factor = potentials[clique]
+                for childResult in results.pop(clique):
+                    factor = factor * childResult
+                keep = query
+                if clique != root:
+                    parent, sep = parents[clique]
+                    if not self.incremental:
+                        factor = factor / potentials[parent, sep]
+                    keep = query.union(compiled.separators[sep]["sep"])
+                factor = factor.marginalize([v for v in factor.variableOrder 
+                                             if v not in keep])
+                if clique != root:
+                    results[parent].append(factor)
+            res = res * factor
+        return res
+        
+    def _calibrated_potentials(self, subtree, parents):
+        """
+            Returns the calibrated Hugin potentials of the given cliques and
+            of the separators towards their parents.
+            
+            Parameters
+            ----------
+            subtree : set(int,)
+                IDs of the cliques.
+            parents : dict
+                Dictionary containing (parent, separator) IDs for each clique
+                (None for the root).
+                
+            Returns
+            -------
+                dict
+                Dictionary containing the clique factors with the clique IDs
+                as keys and the separator factors with (parent, separator) 
+                IDs as keys. These factors must not be modified.
+        """
+        compiled = self.compiled
+        res = {}
+        for clique in subtree:
+            res[clique] = compiled.cliques[clique]["factor"]
+            if parents[clique] is not None:
+                parent, sep = parents[clique]
+                res[parent, sep] = compiled.separators[sep]["factor"]
+        return res
+            
+        
+    def _ensure_incremental(self):
+        """
+            Builds the state of the incremental propagation from the network
+            if necessary, i.e. initially, after reset_factors and after the
+            cpd of any node changed. The currently set evidence is applied 
+            again afterwards.
+        """
+        if self._initial is not None and self._snapshot_valid():
+            return
+        self._initial = None
+        compiled = self.compiled
+        self._cliqueEvidence = [{} for _ in compiled.cliques]
+        self._initial = [self._initial_clique(i) for i in range(len(compiled.cliques))]
+        self._messages = []
+        for edgeData in compiled.separators:
+            values = {v: self.bn.get_node(v).values for v in edgeData["order"]}
+            for _ in range(2):
+                self._messages.append(Factor.unit_factor(edgeData["order"], values, 
+                                                         self.logspace, self.dtype,
+                                                         self.storage))
+        self._messageValid = [False] * len(self._messages)
+        self._messageScales = [0.0] * len(self._messages)
+        self._beliefValid = [False] * len(compiled.cliques)
+        # Messages without any evidence, computed if soft posteriors need 
+        # prior marginals
+        self._priorMessages = None
+        evidence = self.evidence
+        self.evidence = {}
+        self._set_evidence_incremental(evidence, self.softPosteriors)
+        
+    def _set_evidence_incremental(self, evidence, softPosteriors):
+        """
+            Updates the evidence of an incremental jointree. Only the cliques
+            holding changed (added, modified or retracted) evidence are 
+            re-initialized and only the messages sent away from them are 
+            recomputed.
+            
+            Parameters
+            ----------
+            evidence : dict
+                The new evidence (see set_evidence).
+            softPosteriors : bool
+                Whether soft evidence is interpreted as desired posteriors
+                (see set_evidence).
+        """
+        self._ensure_incremental()
+        changed = set()
+        for e in set(self.evidence).union(evidence):
+            old, new = self.evidence.get(e), evidence.get(e)
+            soft = isinstance(new, np.ndarray)
+            if _same_evidence(old, new) and \
+                    not (soft and softPosteriors != self.softPosteriors):
+                continue
+            home = self._evidence_clique(e)
+            if e in evidence:
+                values = self.bn.get_node(e).values
+                oldMarginals = self._prior_marginals(e, home) \
+                                    if soft and softPosteriors else None
+                self._cliqueEvidence[home][e] = Factor.as_evidence(e, values, 
+                                                    new, oldMarginals=oldMarginals,
+                                                    logspace=self.logspace)
+            else:
+                del self._cliqueEvidence[home][e]
+            changed.add(home)
+        self.evidence = dict(evidence)
+        self.softPosteriors = softPosteriors
+        for clique in changed:
+            self._initial[clique] = self._initial_clique(clique)
+            self._invalidate_messages(clique)
+        if not self.lazy:
+            self._update_messages()
+        
+    def _evidence_clique(self, variable):
+        """
+            Returns the ID of the clique that the evidence of the given 
+            variable is multiplied into, i.e. the smallest clique containing
+            it.
+        """
+        clique = self.compiled.variable_clique(variable)
+        if clique is not None:
+            return clique
+        raise ValueError("No clique containing the variable {} was found."
+                         .format(variable))
+        
+    def _initial_clique(self, clique):
+        """
+            Computes the initial potential of the given clique, i.e. its 
+            snapshot potential multiplied with its evidence. Cliques without
+            evidence share the (read-only) snapshot potential, otherwise the
+            clique's previous initial factor is reused if possible.
+        """
+        snapshot = self._get_snapshot()[clique]
+        evidence = list(self._cliqueEvidence[clique].values())
+        if not evidence:
+            return snapshot
+        if snapshot.sparse:
+            res = snapshot.copy()
+        else:
+            res = self._initial[clique] if self._initial is not None else None
+            if res is None or res is snapshot or res.sparse:
+                res = Factor.unit_factor(snapshot.variableOrder, snapshot.values,
+                                         self.logspace, self.dtype, self.storage)
+            np.copyto(res.potentials, snapshot.potentials)
+        for f in evidence:
+            res.imul(f)
+        return res
+        
+    def _invalidate_messages(self, clique):
+        """
+            Marks all messages that depend on the initial potential of the
+            given clique, i.e. all messages sent away from it, as invalid,
+            together with all clique beliefs.
+        """
+        compiled = self.compiled
+        stack = [(clique, None)]
+        while stack:
+            sender, parent = stack.pop()
+            for neighbor, sep in compiled.neighbors[sender]:
+                if neighbor != parent:
+                    self._messageValid[compiled.message_id(sender, sep)] = False
+                    stack.append((neighbor, sender))
+        self._beliefValid = [False] * len(compiled.cliques)
+        
+    def _update_messages(self, schedule=None):
+        """
+            Recomputes all invalid messages of the given schedule, which 
+            defaults to all messages of the jointree. The messages are 
+            normalized, while the logarithm of the scale of each message, 
+            i.e. of its normalization constant times the scales of the
+            messages it was computed from, is kept in _messageScales.
+        """
+        compiled = self.compiled
+        if schedule is None:
+            schedule = compiled.collectSchedule + compiled.distributeSchedule
+        for sender, receiver, sep in schedule:
+            message = compiled.message_id(sender, sep)
+            if self._messageValid[message]:
+                continue
+            product = self._clique_product(sender, exclude=receiver)
+            res = product.marginalize_into(compiled.sumOut[sender, sep], 
+                                           out=self._messages[message])
+            self._messageScales[message] = res.log_normalizer() + \
+                        self._incoming_scale(sender, exclude=receiver)
+            res.normalize()
+            self._messageValid[message] = True
+            
+    def _incoming_scale(self, clique, exclude=None):
+        """
+            Returns the sum of the logarithmic scales of the messages the 
+            given clique receives, except the one from the excluded neighbor.
+        """
+        compiled = self.compiled
+        return sum(self._messageScales[compiled.message_id(neighbor, sep)]
+                   for neighbor, sep in compiled.neighbors[clique]
+                   if neighbor != exclude)
+            
+    def _clique_product(self, clique, exclude=None):
+        """
+            Multiplies the initial potential of the given clique with all 
+            its incoming messages, except the one from the excluded neighbor.
+            Dense results are written into the clique's buffer, which is why
+            the clique's belief is marked invalid unless no neighbor was
+            excluded.
+            
+            Returns
+            -------
+                Factor
+                The resulting product.
+        """
+        compiled = self.compiled
+        cliqueData = compiled.cliques[clique]
+        initial = self._initial[clique]
+        if initial.sparse:
+            res = initial.copy()
+        else:
+            res = cliqueData["buffer"]
+            if res is None or res.variableOrder != initial.variableOrder:
+                res = Factor.unit_factor(initial.variableOrder, initial.values,
+                                         self.logspace, self.dtype, self.storage)
+                cliqueData["buffer"] = res
+            np.copyto(res.potentials, initial.potentials)
+            self._beliefValid[clique] = False
+        for neighbor, sep in compiled.neighbors[clique]:
+            if neighbor != exclude:
+                res.imul(self._messages[compiled.message_id(neighbor, sep)])
+        return res
+        
+    def _update_belief(self, clique):
+        """
+            Makes sure that the factor of the given clique holds its belief,
+            i.e. its initial potential multiplied with all incoming messages.
+        """
+        if not self._beliefValid[clique]:
+            self.compiled.cliques[clique]["factor"] = self._clique_product(clique)
+            self._beliefValid[clique] = True
+            
+    def _prior_marginals(self, variable, clique):
+        """
+            Computes the marginals of the given variable without any evidence
+            from the given clique, which is required to interpret soft 
+            evidence as desired posteriors.
+        """
+        compiled = self.compiled
+        if self._priorMessages is None:
+            self._priorMessages = [None] * len(self._messages)
+            for sender, receiver, sep in compiled.collectSchedule + compiled.distributeSchedule:
+                product = self._prior_product(sender, exclude=receiver)
+                self._priorMessages[compiled.message_id(sender, sep)] = \
+                                    product.marginalize(compiled.sumOut[sender, sep])
+        res = self._prior_product(clique)
+        res = res.marginalize([v for v in res.variableOrder if v != variable])
+        res.normalize()
+        return (res.to_linear() if self.logspace else res).potentials
+        
+    def _prior_product(self, clique, exclude=None):
+        """
+            Multiplies the snapshot potential of the given clique with its 
+            incoming prior messages, except the one from the excluded 
+            neighbor.
+        """
+        compiled = self.compiled
+        res = self._get_snapshot()[clique].copy()
+        for neighbor, sep in compiled.neighbors[clique]:
+            if neighbor != exclude:
+                res.imul(self._priorMessages[compiled.message_id(neighbor, sep)])
+        return res
+        
+    def batch_marginals(self, variables, evidenceList):
+        """
+            Computes the marginals for the given variables for many evidence
+            cases at once. Instead of setting the evidence of each case
+            separately, all cases are stacked along a leading batch axis of 
+            the clique and separator potentials and propagated together, so 
+            that the Python overhead of the message passing only occurs once.
+            Only the messages towards a clique containing the query variables
+            are computed.
+            
+            The evidence and messages currently set in this jointree are not
+            modified.
+            
+            Parameters
+            ----------
+            variables : [String,]
+                List containing the names of the variables whose joint 
+                posterior marginals are desired. The variables need to be
+                contained in a common clique (see marginals).
+            evidenceList : [dict,]
+                List of evidence dictionaries, one per case, in the same 
+                format as for set_evidence. Soft evidence is interpreted as
+                likelihood ratio.
+                
+            Returns
+            -------
+                Factor
+                A batched factor (see Factor.batchSize) whose potentials have
+                the shape (len(evidenceList), ...) and contain the desired 
+                marginals of each case.
+        """
+        varSet = set(variables)
+        root = self.compiled.covering_clique(varSet)
+        if root is None:
             # No suitable clique found
             raise ValueError("No clique containing the variables {} was found.".format(variables))
+        root = self.compiled.cliqueNames[root]
+        
+        tree, compiled = self._batched_evidence_tree(evidenceList)
+        self._propagate(compiled, compiled.collect_schedule(compiled.cliqueIds[root]))
+        rootData = tree.node[root]
+        resFactor = rootData["factor"].marginalize(rootData["variables"] - varSet)
+        resFactor.normalize()
+        return resFactor.to_linear() if self.logspace else resFactor
+        
+    def batch_evidence_probability(self, evidenceList, log=False):
+        """
+            Computes the probability of many evidence cases at once, by 
+            propagating them together along a leading batch axis (see 
+            batch_marginals). Only the inward pass is required, since the
+            probability of the evidence is obtained from the normalization
+            constants of the separators and the root cliques.
+            
+            The evidence and messages currently set in this jointree are not
+            modified.
+            
+            Parameters
+            ----------
+            evidenceList : [dict,]
+                List of evidence dictionaries, one per case, in the same 
+                format as for set_evidence. Soft evidence is interpreted as
+                likelihood ratio.
+            log : bool, optional
+                If True, the natural logarithms of the probabilities are 
+                returned, which avoids underflows for unlikely evidence.
+                
+            Returns
+            -------
+                np.array
+                Array of length len(evidenceList) containing the 
+                (log) probability of each case.
+        """
+        tree, compiled = self._batched_evidence_tree(evidenceList)
+        res = self._propagate(compiled, compiled.collectSchedule, normalize=True)
+        res = res + self._roots_log_normalizer(compiled)
+        res = res * np.ones(len(evidenceList))
+        return res if log else np.exp(res)
+        
+    def _batched_evidence_tree(self, evidenceList):
+        """
+            Creates a batched copy of the jointree (see _batched_tree) and 
+            multiplies the evidence of each case into it.
+            
+            Returns
+            -------
+                (networkx.Graph, CompiledJointree)
+                The batched jointree and its compiled form.
+        """
+        tree = self._batched_tree(len(evidenceList))
+        compiled = CompiledJointree(tree)
+        compiled.update_layout()
+        evidenceVars = []
+        for evidence in evidenceList:
+            evidenceVars.extend(e for e in evidence if e not in evidenceVars)
+        for e in evidenceVars:
+            values = self.bn.get_node(e).values
+            unit = Factor.unit_factor([e], {e: values}, self.logspace)
+            evidenceFactor = Factor.stack([
+                    Factor.as_evidence(e, values, evidence[e], 
+                                       logspace=self.logspace)
+                    if e in evidence else unit for evidence in evidenceList])
+            clique = compiled.variable_clique(e)
+            if clique is not None:
+                compiled.cliques[clique]["factor"].imul(evidenceFactor)
+        return tree, compiled
+        
+    def _batched_tree(self, batchSize):
+        """
+            Creates a copy of the jointree structure whose clique factors 
+            are expanded from the initial clique potentials (see 
+            _get_snapshot) for the given number of cases.
+            
+            Parameters
+            ----------
+            batchSize : int
+                The number of cases that are propagated together.
+                
+            Returns
+            -------
+                nx.Graph
+                The jointree containing batched factors.
+        """
+        tree = _jointree_graph()
+        snapshot = self._get_snapshot()
+        for treeNode, treeData, initial in zip(self.compiled.cliqueNames, 
+                                               self.compiled.cliques, snapshot):
+            tree.add_node(treeNode, variables=treeData["variables"], 
+                          order=treeData["order"], 
+                          factor=initial.expand_batch(batchSize), buffer=None)
+        for u, v, edgeData in self.tree.edges(data=True): # was edges_iter
+            unit = Factor.unit_factor(edgeData["order"], 
+                            {v: self.bn.get_node(v).values for v in edgeData["order"]},
+                            self.logspace, self.dtype)
+            tree.add_edge(u, v, sep=edgeData["sep"], 
+                          factor=unit.expand_batch(batchSize),
+                          buffer=unit.expand_batch(batchSize))
+        return tree
+        
+    def save(self, path):
+        """
+            Saves the compiled jointree, i.e. its cliques, separators, the 
+            assignment of the nodes to the cliques and the initial clique
+            potentials, so that it can be loaded without compiling the 
+            network again (see load).
+            
+            Parameters
+            ----------
+            path : String
+                Directory that the jointree is saved to. It is created if it
+                does not exist. The structure is stored in jointree.json, the
+                potentials in .npy files.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        compiled = self.compiled
+        snapshot = self._get_snapshot()
+        cliques = []
+        for i, name in enumerate(compiled.cliqueNames):
+            initial = snapshot[i]
+            entry = {"name": name, "order": compiled.cliques[i]["order"],
+                     "nodes": self._assignment[name],
+                     "variableOrder": initial.variableOrder,
+                     "sparse": initial.sparse}
+            if initial.sparse:
+                entry["shape"] = list(initial.shape)
+                np.save(os.path.join(path, "clique{}_indices.npy".format(i)), 
+                        initial.indices)
+                np.save(os.path.join(path, "clique{}_data.npy".format(i)), 
+                        initial.data)
+            else:
+                np.save(os.path.join(path, "clique{}.npy".format(i)), 
+                        np.asarray(initial.potentials))
+            cliques.append(entry)
+        separators = [{"cliques": list(ends), 
+                       "order": compiled.separators[sep]["order"]}
+                      for sep, ends in enumerate(compiled.sepEnds)]
+        meta = {"format": 1,
+                "fingerprint": self.bn.get_structure_fingerprint(),
+                "cpdFingerprint": _cpd_fingerprint(self.bn),
+                "logspace": self.logspace,
+                "dtype": np.dtype(self.dtype).str,
+                "cliques": cliques,
+                "separators": separators}
+        with open(os.path.join(path, "jointree.json"), "w") as f:
+            json.dump(meta, f)
             
+    @classmethod
+    def load(cls, path, bn, mmap=True, scratchDir=None, incremental=False,
+             lazy=False, executor=None, architecture=None):
+        """
+            Loads a jointree that was saved with save for the given network.
+            
+            Parameters
+            ----------
+            path : String
+                Directory the jointree was saved to.
+            bn : BayesianNetwork
+                The network the jointree was compiled from. 
+            mmap : bool, optional
+                If True, the saved clique potentials are memory-mapped 
+                (read-only) instead of being read into memory. 
+                (Default: True)
+            scratchDir : String or ScratchSpace, optional
+                See create_jointree.
+            incremental : bool, optional
+                See create_jointree.
+            lazy : bool, optional
+                See create_jointree.
+            executor : concurrent.futures.Executor or int, optional
+                See create_jointree.
+            architecture : String, optional
+                See create_jointree.
+                
+            Returns
+            -------
+                FactorTree
+                The loaded jointree. If the cpds of the network changed since
+                the jointree was saved, its clique potentials are recomputed
+                from the network.
+                
+            Raises
+            ------
+            primo2.exceptions.StructureError
+                If the structure of the network differs from the structure
+                of the network the jointree was compiled for.
+        """
+        with open(os.path.join(path, "jointree.json")) as f:
+            meta = json.load(f)
+        if meta["fingerprint"] != bn.get_structure_fingerprint():
+            raise exceptions.StructureError("The jointree at {} was compiled " \
+                            "for a network with a different structure.".format(path))
+        logspace = meta["logspace"]
+        dtype = np.dtype(meta["dtype"]).type
+        storage = scratchDir
+        if scratchDir is not None and not isinstance(scratchDir, ScratchSpace):
+            storage = ScratchSpace(scratchDir)
+        values = {n.name: n.values for n in bn.get_all_nodes()}
+        tree = _jointree_graph()
+        names = [entry["name"] for entry in meta["cliques"]]
+        for entry in meta["cliques"]:
+            tree.add_node(entry["name"], variables=set(entry["order"]),
+                          order=list(entry["order"]), factor=None, buffer=None)
+        for entry in meta["separators"]:
+            sepOrder = list(entry["order"])
+            a, b = entry["cliques"]
+            tree.add_edge(names[a], names[b], sep=set(sepOrder), order=sepOrder,
+                          factor=Factor.unit_factor(sepOrder, values, logspace, 
+                                                    dtype, storage),
+                          buffer=Factor.unit_factor(sepOrder, values, logspace, 
+                                                    dtype, storage))
+        
+        res = cls(tree, bn, logspace, dtype, storage, incremental, lazy, 
+                  architecture)
+        res.set_executor(executor)
+        res._assignment = {entry["name"]: list(entry["nodes"]) 
+                            for entry in meta["cliques"]}
+        if meta["cpdFingerprint"] == _cpd_fingerprint(bn):
+            mode = "r" if mmap else None
+            snapshot = []
+            for i, entry in enumerate(meta["cliques"]):
+                if entry["sparse"]:
+                    initial = SparseFactor()
+                    initial.shape = tuple(entry["shape"])
+                    initial.indices = np.load(os.path.join(path, 
+                                        "clique{}_indices.npy".format(i)), mmap_mode=mode)
+                    initial.data = np.load(os.path.join(path, 
+                                        "clique{}_data.npy".format(i)), mmap_mode=mode)
+                else:
+                    initial = Factor()
+                    initial.potentials = np.load(os.path.join(path, 
+                                        "clique{}.npy".format(i)), mmap_mode=mode)
+                initial.variableOrder = list(entry["variableOrder"])
+                initial.values = {v: tuple(values[v]) for v in initial.variableOrder}
+                initial.logspace = logspace
+                snapshot.append(initial)
+            res._snapshot = snapshot
+            res._snapshotVersion = bn.cpdVersion
+        res.reset_factors()
+        return res
+        
+    def close(self):
+        """
+            Removes the memory-mapped files of the clique and separator 
+            potentials, if the jointree was created with a scratch directory,
+            and shuts down the thread pool created by set_executor.
+            The jointree cannot be used for inference afterwards.
+        """
+        if self.storage is not None:
+            self.storage.close()
+        self.set_executor(None)
         
-    def get_evidence_probability(self):
-         raise NotImplementedError("We still need to implement this...")
+    def compare_precision(self, variables=None, reference=np.float64):
+        """
+            Checks the accuracy of the marginals computed with the dtype of
+            this jointree by comparing them against the marginals of a 
+            jointree of the same network that uses the given reference type,
+            given the evidence currently set in this jointree.
+            
+            Parameters
+            ----------
+            variables : [String,], optional
+                The variables whose marginals are compared. Defaults to all
+                variables of the network.
+            reference : np.dtype, optional
+                The floating point type of the reference computation.
+                (Default: np.float64)
+                
+            Returns
+            -------
+                dict
+                Dictionary containing the variables as keys and the maximum
+                absolute deviation of their marginals from the reference 
+                marginals as values.
+        """
+        if variables is None:
+            variables = [n.name for n in self.bn.get_all_nodes()]
+        refTree = FactorTree.create_jointree(self.bn, logspace=self.logspace, 
+                                             dtype=reference)
+        refTree.set_evidence(self.evidence, self.softPosteriors)
+        res = {}
+        for v in variables:
+            refMarginals = refTree.marginals([v]).get_potential()
+            marginals = np.asarray(self.marginals([v]).get_potential(), dtype=reference)
+            res[v] = float(np.max(np.abs(marginals - refMarginals)))
+        return res
+        
+    def get_evidence_probability(self, log=False):
+        """
+            Computes the probability of the currently set evidence P(e). 
+            The separators are normalized during the inward pass of the 
+            message passing, so that P(e) is obtained from the product of 
+            their normalization constants and the sum of each root clique
+            without any additional propagation. Soft evidence is treated as
+            likelihood ratio, i.e. contributes its likelihood to P(e).
+            
+            Parameters
+            ----------
+            log : bool, optional
+                If True, the natural logarithm log P(e) is returned, which 
+                can be computed even if P(e) underflows.
+                
+            Returns
+            -------
+                float
+                The (log) probability of the evidence.
+        """
+        if self.incremental:
+            self._ensure_incremental()
+            compiled = self.compiled
+            res = 0.0
+            for root in compiled.roots:
+                self._update_messages(compiled.collect_schedule(root))
+                self._update_belief(root)
+                res += compiled.cliques[root]["factor"].log_normalizer() + \
+                            self._incoming_scale(root)
+        else:
+            if not self._snapshot_valid():
+                self.set_evidence(self.evidence, self.softPosteriors)
+            if not self.tree.graph["messagesValid"]:
+                self.calculate_messages()
+            res = self._logNormalizer + self._roots_log_normalizer(self.compiled)
+        res = float(res)
+        return res if log else float(np.exp(res))
+        
+    def mpe(self, variables=None, k=1, log=False):
+        """
+            Computes the most probable explanation (MPE) given the currently
+            set evidence, i.e. the most probable assignment of all 
+            unobserved variables, or the marginal MAP assignment of the 
+            given variables.
+            
+            The MPE is computed by max-product propagation towards the root
+            cliques on a copy of the jointree's initial potentials, followed
+            by a traceback from the roots outwards, in which each clique's
+            variables are maximised given the values already assigned to its
+            separator. The messages set in this jointree are not modified.
+            The k most probable explanations are found by repeating this 
+            for disjoint subspaces of the assignments (see _k_best).
+            
+            Marginal MAP assignments are found in the exact joint marginals
+            of the given variables (see marginals), which is only feasible
+            for a small number of variables, but reuses the propagated 
+            messages.
+            
+            Soft evidence is interpreted as likelihood ratio.
+            
+            Parameters
+            ----------
+            variables : [String,], optional
+                List containing the names of the variables whose marginal 
+                MAP assignment is desired. If not given, the MPE over all
+                variables is computed. Variables with hard evidence are never
+                part of the assignment.
+            k : int, optional
+                The number of most probable assignments that are returned.
+                (Default: 1)
+            log : bool, optional
+                If True, the natural logarithms of the probabilities are 
+                returned. (Default: False)
+                
+            Returns
+            -------
+                [(dict, float),]
+                List containing up to k pairs of an assignment, given as
+                dictionary mapping the variables to their values, and its
+                joint probability with the evidence, sorted by decreasing 
+                probability. Assignments with probability 0 are omitted.
+        """
+        if variables is None:
+            return _k_best(self._max_assignment, self.bn, self.evidence, k, log)
+        variables = [v for v in variables if v not in self.evidence 
+                        or isinstance(self.evidence[v], np.ndarray)]
+        if not variables:
+            return []
+        joint = self.marginals(variables)
+        logEvidence = self.get_evidence_probability(log=True)
+        potentials = np.asarray(joint.potentials).ravel()
+        res = []
+        for index in np.argsort(-potentials, kind="stable")[:k]:
+            if potentials[index] <= 0:
+                break
+            indices = np.unravel_index(index, np.shape(joint.potentials))
+            assignment = {v: joint.values[v][i] 
+                            for v, i in zip(joint.variableOrder, indices)}
+            logValue = float(np.log(potentials[index]) + logEvidence)
+            res.append((assignment, logValue if log else float(np.exp(logValue))))
+        return res
+        
+    def _max_assignment(self, evidence):
+        """
+            Helper function computing the most probable assignment of all
+            unobserved variables for the given evidence by max-product 
+            propagation (see mpe).
+            
+            Returns
+            -------
+                (dict, float)
+                The maximising assignment and the logarithm of its joint 
+                probability with the evidence or None if the evidence is
+                impossible.
+        """
+        hardEvidence = {e: evidence[e] for e in evidence 
+                        if not isinstance(evidence[e], np.ndarray)}
+        snapshot = self._get_snapshot()
+        tree = _jointree_graph()
+        for treeNode, treeData, initial in zip(self.compiled.cliqueNames, 
+                                               self.compiled.cliques, snapshot):
+            factor = initial.reduce(hardEvidence)
+            factor = factor.to_dense() if factor.sparse else factor.copy()
+            tree.add_node(treeNode, variables=treeData["variables"], 
+                          order=treeData["order"], factor=factor, buffer=None)
+        for u, v, edgeData in self.tree.edges(data=True): # was edges_iter
+            sepOrder = [n for n in edgeData["order"] if n not in hardEvidence]
+            values = {n: self.bn.get_node(n).values for n in sepOrder}
+            tree.add_edge(u, v, sep=edgeData["sep"], 
+                          factor=Factor.unit_factor(sepOrder, values, self.logspace, self.dtype),
+                          buffer=Factor.unit_factor(sepOrder, values, self.logspace, self.dtype))
+        compiled = CompiledJointree(tree)
+        compiled.update_layout()
+        for e in evidence:
+            if e in hardEvidence:
+                continue
+            evidenceFactor = Factor.as_evidence(e, self.bn.get_node(e).values, 
+                                                evidence[e], logspace=self.logspace)
+            clique = compiled.variable_clique(e)
+            if clique is not None:
+                compiled.cliques[clique]["factor"].imul(evidenceFactor)
+                    
+        logValue = self._propagate(compiled, compiled.collectSchedule, 
+                                   normalize=True, maximize=True)
+        assignment = {}
+        for root in compiled.roots:
+            factor = compiled.cliques[root]["factor"]
+            best, indices = factor.argmax_marginalize(factor.variableOrder)
+            with np.errstate(divide="ignore"):
+                logValue += float(best.potentials if self.logspace 
+                                  else np.log(best.potentials))
+            for v, index in indices.items():
+                assignment[v] = factor.values[v][int(index)]
+        if logValue == -np.inf:
+            return None
+        # The distribute schedule visits the cliques from the roots outwards
+        for sender, receiver, sep in compiled.distributeSchedule:
+            factor = compiled.cliques[receiver]["factor"].reduce(assignment)
+            if not factor.variableOrder:
+                continue
+            best, indices = factor.argmax_marginalize(factor.variableOrder)
+            for v, index in indices.items():
+                assignment[v] = factor.values[v][int(index)]
+        return assignment, logValue
+        
+    @staticmethod
+    def _roots_log_normalizer(compiled):
+        """
+            Returns the sum of the logarithmic normalization constants of 
+            the root cliques of the given compiled jointree.
+        """
+        return sum(compiled.cliques[root]["factor"].log_normalizer() 
+                   for root in compiled.roots)
         
     def calculate_messages(self):
         """
             Performs the two way (inward and outward) message passing with
-            the first node as root. Is needed to validate the messages in the
-            jointree.
+            the first clique of each connected part of the jointree as root.
+            Is needed to validate the messages in the jointree.
         """
-        try:
-            root = list(self.tree.nodes())[0]
-            self.pull_messages(self.tree, root, None)
-            self.push_messages(self.tree, root, None)
-            self.tree.graph["messagesValid"] = True
-        except IndexError:
-            pass
+        if self.incremental:
+            self._ensure_incremental()
+            self._update_messages()
+            return
+        if self.executor is None:
+            self._logNormalizer = self._propagate(self.compiled, 
+                                                  self.compiled.collectSchedule,
+                                                  normalize=True)
+            self._propagate(self.compiled, self.compiled.distributeSchedule)
+        else:
+            collectLevels, distributeLevels = self.compiled.parallel_schedule()
+            self._logNormalizer = self._propagate_parallel(self.compiled, 
+                                                           collectLevels,
+                                                           normalize=True)
+            self._propagate_parallel(self.compiled, distributeLevels)
+        self.tree.graph["messagesValid"] = True
+        
+    def set_executor(self, executor):
+        """
+            Sets the executor used by calculate_messages to pass independent
+            messages, e.g. of sibling branches, concurrently. Since NumPy 
+            releases the GIL for large array operations, a thread pool 
+            allows to use multiple cores for trees with large cliques. This
+            only applies to the Hugin architecture, the messages of 
+            Shafer-Shenoy jointrees are always passed sequentially.
+            
+            Parameters
+            ----------
+            executor : concurrent.futures.Executor, int or None
+                The executor to use. If an int is given, a 
+                concurrent.futures.ThreadPoolExecutor with that many threads
+                is created, which is shut down by close(). If None, all 
+                messages are passed sequentially.
+                
+            Raises
+            ------
+            ValueError
+                If an executor is set for a Shafer-Shenoy jointree.
+        """
+        if executor is not None and self.architecture == "shafer-shenoy":
+            raise ValueError("Only jointrees using the hugin architecture "
+                             "can pass messages concurrently.")
+        if self._ownsExecutor:
+            self.executor.shutdown()
+        self._ownsExecutor = isinstance(executor, int)
+        if self._ownsExecutor:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(executor)
+        self.executor = executor
+        
+    def _propagate_parallel(self, compiled, levels, normalize=False):
+        """
+            Passes the messages of the given levels (see 
+            CompiledJointree.parallel_schedule) level by level, submitting 
+            the groups of each level to the executor. Returns the summed 
+            logarithmic normalization constants (see _propagate).
+        """
+        res = 0.0
+        for level in levels:
+            if len(level) == 1:
+                res += self._propagate(compiled, level[0], normalize)
+                continue
+            futures = [self.executor.submit(self._propagate, compiled, group,
+                                            normalize)
+                        for group in level]
+            for future in futures:
+                res += future.result()
+        return res
+        
+    def _propagate(self, compiled, schedule, normalize=False, maximize=False):
+        """
+            Passes the messages of the given schedule in order according to
+            Hugin's architecture. All updates are performed in place on the 
+            preallocated separator factors, the separator's buffer factor and
+            the receiver's clique factor.
+            
+            Parameters
+            ----------
+            compiled : CompiledJointree
+                The compiled jointree whose cliques and separators are used.
+            schedule : [(int, int, int),]
+                List of (sender, receiver, separator) IDs.
+            normalize : bool, optional
+                If True, each new separator is normalized before it is 
+                passed on, which keeps the potentials from underflowing.
+            maximize : bool, optional
+                If True, the variables are maximised instead of summed out
+                of the messages (max-product propagation).
+                
+            Returns
+            -------
+                float or np.array
+                The sum of the logarithms of the normalization constants 
+                (an array for batched jointrees), 0 if normalize is False.
+        """
+        cliques = compiled.cliques
+        separators = compiled.separators
+        sumOut = compiled.sumOut
+        res = 0.0
+        for sender, receiver, sep in schedule:
+            res += self._hugin_update(cliques[sender]["factor"], cliques[receiver], 
+                                      separators[sep], sumOut[sender, sep],
+                                      normalize, maximize)
+        return res
         
     def pull_messages(self, tree, curNode, parent):
         """
             Performs the inward message passing from the given node to its
-            parent according to Hugin's architecture.
+            parent according to Hugin's architecture, using the schedule of
+            the compiled jointree (see CompiledJointree.branch_schedule).
             
             Parameters
             ----------
             tree : nx.Graph
-                The underlying jointree. Is only passed as parameter for slight
-                performance improvements.
+                The underlying jointree, which is only kept as parameter for
+                compatibility. The messages are always passed within this 
+                jointree.
             curNode : String
                 Name of the clique node within the jointree that should currently
                 send it's message to the given parent.
             parent : String
                 Name of the parent node the message should be passed to.
         """
-        #Let neighbors collect messages
-        for neighbor in tree.neighbors(curNode): #was neighbors_iter in networkx 1.x
-            if neighbor != parent:
-                self.pull_messages(tree, neighbor, curNode)
-                      
-        # Send message to parent
-        if parent:
-            newSeqFactor = tree.node[curNode]["factor"].marginalize(tree.node[curNode]["variables"]-tree[curNode][parent]["sep"])
-            tree.node[parent]["factor"] = tree.node[parent]["factor"] * (newSeqFactor / tree[curNode][parent]["factor"])
-            tree[curNode][parent]["factor"] = newSeqFactor
-        else:
-            return
+        compiled = self.compiled
+        self._propagate(compiled, compiled.branch_schedule(compiled.cliqueIds[curNode],
+                                                           compiled.cliqueIds.get(parent)))
             
     def push_messages(self, tree, curNode, parent):
         """
             Performs the outwards message passing from the given node to its
-            children other than the given parent according to Hugin's architecture.
+            children other than the given parent according to Hugin's 
+            architecture, using the schedule of the compiled jointree.
             
             Parameters
             ----------
             tree : nx.Graph
-                The underlying jointree. Is only passed as parameter for slight
-                performance improvements.
+                The underlying jointree, which is only kept as parameter for
+                compatibility.
             curNode : String
                 Name of the clique node within the jointree that should currently
                 send it's message to it's children
@@ -439,13 +2695,55 @@ class FactorTree(object):
                 Name of the parent node to avoid sending messages back to the
                 parent.
         """
-        for neighbor in tree.neighbors(curNode): #was neighbors_iter in networkx 1.x
-            if neighbor != parent:
-                #Send message out to neighbor
-                newSeqFactor = tree.node[curNode]["factor"].marginalize(tree.node[curNode]["variables"]-tree[curNode][neighbor]["sep"])
-                tree.node[neighbor]["factor"] = tree.node[neighbor]["factor"] * (newSeqFactor / tree[curNode][neighbor]["factor"])
-                tree[curNode][neighbor]["factor"] = newSeqFactor
-                # Have neighbor pushing out further
-                self.push_messages(tree, neighbor, curNode)
-            
+        compiled = self.compiled
+        parentId = compiled.cliqueIds.get(parent)
+        schedule = compiled.branch_schedule(compiled.cliqueIds[curNode], parentId)
+        self._propagate(compiled, [(receiver, sender, sep) for sender, receiver, sep 
+                                   in reversed(schedule) if receiver != parentId])
         
+    @staticmethod
+    def _hugin_update(senderFactor, receiverData, edgeData, sumOut, normalize=False,
+                      maximize=False):
+        """
+            Updates the separator with the given data and the receiver's 
+            clique factor in place with the message of the sender.
+            
+            Parameters
+            ----------
+            senderFactor : Factor
+                The clique factor of the sender.
+            receiverData : dict
+                The data dictionary of the receiving clique.
+            edgeData : dict
+                The data dictionary of the separator.
+            sumOut : [String,]
+                The variables of the sender's factor that are not part of the
+                separator's factor.
+            normalize : bool, optional
+                If True, the new separator is normalized.
+            maximize : bool, optional
+                If True, the variables are maximised out instead of summed
+                out.
+                
+            Returns
+            -------
+                float or np.array
+                The logarithm of the normalization constant, 0 if normalize
+                is False.
+        """
+        oldSep = edgeData["factor"]
+        if maximize:
+            newSep = senderFactor.max_marginalize(sumOut, out=edgeData["buffer"])
+        else:
+            newSep = senderFactor.marginalize_into(sumOut, out=edgeData["buffer"])
+        logNormalizer = 0.0
+        if normalize:
+            logNormalizer = newSep.log_normalizer()
+            newSep.normalize()
+        # Turn the old separator into the update ratio newSep/oldSep
+        oldSep.iinvert().imul(newSep)
+        receiverData["factor"].imul(oldSep)
+        # The new separator is kept, the old one becomes the next buffer
+        edgeData["factor"] = newSep
+        edgeData["buffer"] = oldSep
+        return logNormalizer
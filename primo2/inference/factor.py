@@ -21,10 +21,263 @@
 
 from __future__ import division
 
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
 import numpy as np
 
 from ..nodes import DiscreteNode, RandomNode, UtilityNode
 
+
+# Lookup tables mapping values to their positions, keyed by the (immutable)
+# value tuples of the factors' variables. The least recently used tables 
+# are evicted once more than _valueIndicesSize tables are cached.
+_valueIndices = OrderedDict()
+_valueIndicesSize = 1024
+
+def _value_indices(values):
+    """
+        Returns a dictionary mapping each of the given values to its index,
+        so that value names can be resolved in constant time.
+    """
+    try:
+        res = _valueIndices.pop(values)
+    except KeyError:
+        res = {v: i for i, v in enumerate(values)}
+        if len(_valueIndices) >= _valueIndicesSize:
+            _valueIndices.popitem(last=False)
+    except TypeError:
+        # Unhashable value containers are not cached
+        return {v: i for i, v in enumerate(values)}
+    _valueIndices[values] = res
+    return res
+
+def _float_dtype(potentials):
+    """
+        Returns the floating point type of the given potentials. Potentials
+        of other types are represented as np.float64.
+    """
+    dtype = np.result_type(potentials)
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+def _logsumexp(logPotentials, axis=None):
+    """
+        Computes log(sum(exp(logPotentials))) over the given axes in a 
+        numerically stable way. Slices that only contain -inf (i.e. zero
+        probability) result in -inf.
+    """
+    logPotentials = np.asarray(logPotentials)
+    maxima = np.max(logPotentials, axis=axis, keepdims=True)
+    # Potentials may be 0-d, e.g. separators whose variables are observed
+    maxima = np.where(np.isfinite(maxima), maxima, 0)
+    with np.errstate(divide="ignore"):
+        res = np.log(np.sum(np.exp(logPotentials - maxima), axis=axis))
+    return res + np.squeeze(maxima, axis=axis)
+
+def _chunk_slices(potentials):
+    """
+        Returns slices along the first axis of the given potentials, so that 
+        each chunk holds at most Factor.chunkBytes bytes. Returns None if the
+        potentials are small enough to be processed in a single pass.
+    """
+    if not isinstance(potentials, np.ndarray) or potentials.ndim == 0 \
+            or potentials.nbytes <= Factor.chunkBytes or len(potentials) < 2:
+        return None
+    rowBytes = max(1, potentials.nbytes // len(potentials))
+    step = max(1, Factor.chunkBytes // rowBytes)
+    return [slice(i, min(i + step, len(potentials))) 
+                for i in range(0, len(potentials), step)]
+
+def _reduce_chunks(potentials, reduce_, accumulate, axes, chunks, target):
+    """
+        Reduces the given axes of the potentials chunk by chunk along their
+        first axis and writes the result into target. If the first axis is 
+        reduced, the partial results are combined with accumulate, otherwise
+        each chunk fills its own slice of target.
+    """
+    if 0 not in axes:
+        for chunk in chunks:
+            np.copyto(target[chunk], reduce_(potentials[chunk], axis=axes))
+        return
+    np.copyto(target, reduce_(potentials[chunks[0]], axis=axes))
+    for chunk in chunks[1:]:
+        accumulate(target, reduce_(potentials[chunk], axis=axes), out=target)
+
+class ScratchSpace(object):
+    """
+        Allocates potentials as np.memmap files within a scratch directory,
+        so that factors larger than the available memory can be paged in and
+        out by the operating system.
+        
+        Arrays below minBytes are still allocated in memory, which avoids
+        creating a file for every small separator.
+    """
+    
+    def __init__(self, directory=None, minBytes=1 << 20):
+        """
+            Creates a new scratch space.
+            
+            Parameters
+            ----------
+            directory: String, optional
+                Existing directory in which the files are created. If not 
+                given, a temporary directory is created, which is removed
+                again by close().
+            minBytes: int, optional
+                Arrays with fewer bytes are allocated in memory.
+        """
+        self._ownsDirectory = directory is None
+        self.directory = tempfile.mkdtemp(prefix="primo2-") \
+                            if directory is None else directory
+        self.minBytes = minBytes
+        self.files = []
+        
+    def allocate(self, shape, dtype=np.float64):
+        """
+            Allocates an uninitialised array of the given shape and dtype.
+            
+            Parameters
+            ----------
+            shape: tuple(int,)
+                The shape of the array.
+            dtype: np.dtype, optional
+                The dtype of the array.
+                
+            Returns
+            -------
+                np.ndarray
+                Either a np.memmap backed by a new file in the scratch 
+                directory or, for small arrays, a regular array.
+        """
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        if len(shape) == 0 or size == 0 or size * dtype.itemsize < self.minBytes:
+            return np.empty(shape, dtype=dtype)
+        fd, filename = tempfile.mkstemp(suffix=".dat", dir=self.directory)
+        os.close(fd)
+        self.files.append(filename)
+        return np.memmap(filename, dtype=dtype, mode="w+", shape=shape)
+        
+    def close(self):
+        """
+            Removes all files created by this scratch space. Arrays that were 
+            allocated by it must not be used afterwards.
+        """
+        for filename in self.files:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.files = []
+        if self._ownsDirectory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+class ProductPlan(object):
+    """
+        Compiled description of how the potentials of two factors have to be
+        aligned in order to multiply (and optionally marginalise) them.
+        
+        Plans only depend on the variable orders of the two operands (and the
+        variables that are summed out), so they are compiled once and cached.
+        Repeated products of factors with the same layouts, as they occur
+        during message passing, can then be computed with a single broadcasted
+        multiplication or np.einsum call without any Python-level bookkeeping.
+
+        Batched potentials (see Factor.batchSize) carry an additional leading
+        batch axis, which is handled by align and contract directly.
+    """
+    
+    # Cache of all compiled plans
+    _cache = {}
+    # Upper bound for the number of cached plans to avoid unbounded growth.
+    maxCacheSize = 10000
+    
+    def __init__(self, leftOrder, rightOrder, sumOut=()):
+        leftOrder = tuple(leftOrder)
+        rightOrder = tuple(rightOrder)
+        #Result keeps the order of the left operand, extended by the new 
+        #variables of the right operand in their order of appearance.
+        self.resOrder = leftOrder + tuple(v for v in rightOrder 
+                                            if v not in leftOrder)
+        self.outOrder = tuple(v for v in self.resOrder if v not in sumOut)
+        
+        # Broadcasting indices for the product
+        self.leftIndex = (Ellipsis,) + (np.newaxis,) * (len(self.resOrder)-len(leftOrder))
+        rightPos = [self.resOrder.index(v) for v in rightOrder]
+        perm = sorted(range(len(rightOrder)), key=lambda i: rightPos[i])
+        self.rightPerm = None if perm == list(range(len(rightOrder))) else tuple(perm)
+        self.rightIndex = tuple(slice(None) if v in rightOrder else np.newaxis
+                                for v in self.resOrder)
+        
+        # Einsum subscripts for fused product and summation
+        self.leftSub = [self.resOrder.index(v) for v in leftOrder]
+        self.rightSub = rightPos
+        self.outSub = [self.resOrder.index(v) for v in self.outOrder]
+    
+    @classmethod
+    def get(cls, leftOrder, rightOrder, sumOut=None):
+        """
+            Returns the (cached) plan for the given operand layouts.
+            
+            Parameters
+            ----------
+            leftOrder : [String,]
+                The variable order of the left operand.
+            rightOrder : [String,]
+                The variable order of the right operand.
+            sumOut : iterable, optional
+                Variables that should be summed out of the product.
+                
+            Returns
+            -------
+                ProductPlan
+                The compiled plan for these layouts.
+        """
+        sumOut = frozenset(sumOut) if sumOut else frozenset()
+        key = (tuple(leftOrder), tuple(rightOrder), sumOut)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            if len(cls._cache) >= cls.maxCacheSize:
+                cls._cache.clear()
+            plan = cls(key[0], key[1], sumOut)
+            cls._cache[key] = plan
+            return plan
+    
+    def align(self, left, right, rightBatched=False):
+        """
+            Returns views of both potentials that broadcast against each other
+            in the order of the resulting factor. A leading batch axis of the
+            left potentials is kept as is, the one of the right potentials 
+            has to be indicated with rightBatched.
+        """
+        left = np.asarray(left)
+        right = np.asarray(right)
+        if not rightBatched:
+            if self.rightPerm is not None:
+                right = np.transpose(right, self.rightPerm)
+            return left[self.leftIndex], right[self.rightIndex]
+        if self.rightPerm is not None:
+            right = np.transpose(right, (0,) + tuple(p+1 for p in self.rightPerm))
+        return left[self.leftIndex], right[(slice(None),) + self.rightIndex]
+    
+    def contract(self, left, right, leftBatched=False, rightBatched=False):
+        """
+            Multiplies both potentials and sums out all variables not contained
+            in outOrder in a single np.einsum call. Leading batch axes are 
+            kept in the result.
+        """
+        if not (leftBatched or rightBatched):
+            return np.einsum(left, self.leftSub, right, self.rightSub, self.outSub)
+        batch = [len(self.resOrder)]
+        return np.einsum(left, batch + self.leftSub if leftBatched else self.leftSub,
+                         right, batch + self.rightSub if rightBatched else self.rightSub,
+                         batch + self.outSub)
+    
+    
 class Factor(object):
     """
         Class representing a factor in an inference network.
@@ -39,6 +292,23 @@ class Factor(object):
         self.variableOrder = []
         # Use a dictionary for the values (as tuple) with the variables as keys.
         self.values = {}
+        # If True, the potentials are stored as natural logarithms. Products
+        # then become sums and marginalisation uses logsumexp.
+        self.logspace = False
+        # Number of independent cases stored in this factor. If given, the
+        # potentials have an additional leading axis of this size, which is
+        # broadcast through all operations.
+        self.batchSize = None
+        
+    # Whether the potentials are stored sparsely (see SparseFactor)
+    sparse = False
+    # Factors whose fraction of non-zero potentials is below this threshold
+    # are stored sparsely when sparsify() is called.
+    sparseThreshold = 0.2
+    # Potentials larger than this (in bytes) are multiplied and marginalised
+    # in chunks along their first axis. This bounds the size of temporaries
+    # and streams memory-mapped potentials instead of paging them in at once.
+    chunkBytes = 1 << 26
         
 
     
@@ -85,55 +355,25 @@ class Factor(object):
                 Factor
                 The sum of this (utility) factor and the other factor.
         """
+        if self.logspace or other.logspace:
+            raise TypeError("Factors in log space cannot be added.")
+        self._check_batch(other)
+        batched = self.batchSize is not None or other.batchSize is not None
         # Shortcuts for trivial factors
-        if len(self.variableOrder) == 0:
+        if len(self.variableOrder) == 0 and not batched:
             res = other.copy()
             res.potentials = self.potentials + res.potentials
             return res
             
-        if len(other.variableOrder) == 0:
+        if len(other.variableOrder) == 0 and not batched:
             res = self.copy()
             res.potentials = res.potentials + other.potentials
             return res
         
-        res = Factor()
-        res.variableOrder = list(self.variableOrder)
-        res.values = dict(self.values)
-        extra_vars = set(other.variableOrder) - set(self.variableOrder)
-        #Setup res factor based on self, extended by the missing variables from other
-        if extra_vars:
-            #Create new dimensions for each missing variable
-            slice_ = [slice(None)] * len(self.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            res.potentials = self.potentials[slice_]
-            
-            res.variableOrder.extend(extra_vars)
-            
-            for var in extra_vars:
-                res.values[var] = tuple(other.values[var])
-                
-        else:
-            #This view is ok, since we will overwrite res.potentials below 
-            #when we compute the actual multiplication!
-            res.potentials = self.potentials[:]
-            
-        #modify other
-        f2 = other.copy()
-        extra_vars = set(res.variableOrder) - set(f2.variableOrder)
-        if extra_vars:
-            slice_ = [slice(None)] * len(f2.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            f2.potentials = f2.potentials[slice_]
-            f2.variableOrder.extend(extra_vars)
-            
-        #Rearrange f2 potentials so that dimensions align to the order in res
-        swaparray = [f2.variableOrder.index(var) for var in res.variableOrder]
-        f2.potentials = np.transpose(f2.potentials, swaparray)
-        
-        # Pointwise addition
-        res.potentials = res.potentials + f2.potentials
-        
-        return res
+        plan = ProductPlan.get(self.variableOrder, other.variableOrder)
+        left, right = plan.align(self.potentials, other.potentials, 
+                                 other.batchSize is not None)
+        return self._from_plan(other, plan.resOrder, left + right)
     
     def __truediv__(self, other):
         """
@@ -156,7 +396,7 @@ class Factor(object):
             raise ValueError("The divisor's variable are not a subset of the " \
                              "divident's variables: Divisor: {}, Dividend: {}"
                             .format(other.variableOrder, self.variableOrder))
-        return self.__mul__(other.invert(),useOther=False)        
+        return self.__mul__(other.invert(),useOther=True)        
     
     def __mul__(self, other, useOther=False):
         """
@@ -165,75 +405,228 @@ class Factor(object):
             
             Currently this is NOT commutative!!
             This means that the self-factor is used as base to create the resulting
-            factor and any new variables in the other factor are added afterwards!
+            factor and any new variables in the other factor are added afterwards
+            (in the order they appear in the other factor)!
                         
             Also value order is currently NOT checked between the two factors,
             i.e. if one factor orders the values of some variable as "True", 
             "False" and another sorts them "False", "True" 
             the results will be wrong!
             
+            The required axis bookkeeping is compiled once per pair of variable
+            orders (see ProductPlan), so repeated products of factors with the
+            same layout only perform a single broadcasted multiplication.
+            
             Paramter
             -------
             other : Factor
                 The factor that is multiplied to this factor
+            useOther : bool, optional
+                If True, the other factor may be reused for the result in case
+                self is trivial, avoiding a copy. Only use this for temporary
+                factors.
                 
             Returns
             -------
                 Factor
                 The product of this factor and the other factor.
         """
+        self._check_domain(other)
+        batched = self.batchSize is not None or other.batchSize is not None
+        if self.sparse or other.sparse:
+            if not batched:
+                return _sparse_product(self, other)
+            # Batched factors are always dense
+            left = self.to_dense() if self.sparse else self
+            right = other.to_dense() if other.sparse else other
+            return left.__mul__(right, useOther)
+        # Products of log potentials are sums
+        multiply = np.add if self.logspace else np.multiply
         
         # Shortcuts for trivial factors
-        if len(self.variableOrder) == 0:
+        if len(self.variableOrder) == 0 and not batched:
             res = other if useOther else other.copy()
-            res.potentials = self.potentials * res.potentials
+            res.potentials = multiply(self.potentials, res.potentials)
             return res
             
-        if len(other.variableOrder) == 0:
+        if len(other.variableOrder) == 0 and not batched:
             res = self.copy()
-            res.potentials = res.potentials * other.potentials
+            res.potentials = multiply(res.potentials, other.potentials)
             return res
         
-        res = Factor()
-        res.variableOrder = list(self.variableOrder)
-        res.values = dict(self.values)
-        extra_vars = set(other.variableOrder) - set(self.variableOrder)
-        #Setup res factor based on self, extended by the missing variables from other
-        if extra_vars:
-            #Create new dimensions for each missing variable
-            slice_ = [slice(None)] * len(self.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            res.potentials = self.potentials[slice_]
-            
-            res.variableOrder.extend(extra_vars)
-            
-            for var in extra_vars:
-                res.values[var] = tuple(other.values[var])
-                
-        else:
-            #This view is ok, since we will overwrite res.potentials below 
-            #when we compute the actual multiplication!
-            res.potentials = self.potentials[:]
-            
-        #modify other
-        f2 = other if useOther else other.copy()
-        extra_vars = set(res.variableOrder) - set(f2.variableOrder)
-        if extra_vars:
-            slice_ = [slice(None)] * len(f2.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            f2.potentials = f2.potentials[slice_]
-            f2.variableOrder.extend(extra_vars)
-            
-        #Rearrange f2 potentials so that dimensions align to the order in res
-        swaparray = [f2.variableOrder.index(var) for var in res.variableOrder]
-        f2.potentials = np.transpose(f2.potentials, swaparray)
-        
+        plan = ProductPlan.get(self.variableOrder, other.variableOrder)
+        left, right = plan.align(self.potentials, other.potentials, 
+                                 other.batchSize is not None)
         # Pointwise multiplication which results in a factor where all instantiations
         # are compatible to the instantiations of res and factor2
         # See Definition 6.3 in "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche Chapter 6    
-        res.potentials = res.potentials * f2.potentials
+        return self._from_plan(other, plan.resOrder, multiply(left, right))
+    
+    def multiply_marginalize(self, other, variables):
+        """
+            Computes the product of this factor and the other factor and sums
+            out the given variables in a single contraction, without ever
+            materialising the full product.
+            
+            The result is identical to (self * other).marginalize(variables)
+            but only requires memory for the resulting factor.
+            
+            Parameters
+            ----------
+            other : Factor
+                The factor that is multiplied to this factor.
+            variables: String, RandomNode, [String,], [RandomNode,], set(String,) or set(RandomNode)
+                Either a single variable or a list of variables that are to
+                be summed out of the product.
+                
+            Returns
+            -------
+                Factor
+                A new factor representing the marginalised product.
+        """
+        if not isinstance(variables, (list,set,tuple)):
+            variables = [variables]
+        # Log space requires logsumexp, which cannot be fused by np.einsum
+        if self.logspace or self.sparse or other.sparse \
+                or len(self.variableOrder) == 0 or len(other.variableOrder) == 0:
+            return (self * other).marginalize(variables)
+        
+        self._check_batch(other)
+        plan = ProductPlan.get(self.variableOrder, other.variableOrder, variables)
+        potentials = plan.contract(self.potentials, other.potentials,
+                                   self.batchSize is not None, 
+                                   other.batchSize is not None)
+        return self._from_plan(other, plan.outOrder, potentials)
         
+    def _from_plan(self, other, variableOrder, potentials):
+        """
+            Helper function to create the resulting factor of a binary
+            operation between self and other.
+        """
+        res = Factor()
+        res.variableOrder = list(variableOrder)
+        res.values = {v: self.values[v] if v in self.values else other.values[v] 
+                        for v in variableOrder}
+        res.potentials = potentials
+        res.logspace = self.logspace
+        res.batchSize = self.batchSize if self.batchSize is not None \
+                            else other.batchSize
         return res
+        
+    def _check_domain(self, other):
+        """
+            Helper function to ensure that both factors are represented in the
+            same (linear or log) domain and have compatible batch sizes.
+        """
+        if self.logspace != other.logspace:
+            raise ValueError("Cannot combine a factor in log space with a " \
+                             "factor in linear space.")
+        self._check_batch(other)
+        
+    def _check_batch(self, other):
+        """
+            Helper function to ensure that two batched factors contain the 
+            same number of cases.
+        """
+        if self.batchSize is not None and other.batchSize is not None \
+                and self.batchSize != other.batchSize:
+            raise ValueError("Cannot combine factors with different batch " \
+                             "sizes: {} and {}."
+                             .format(self.batchSize, other.batchSize))
+    
+    def imul(self, other):
+        """
+            Multiplies the other factor into this factor in place. The other
+            factor's variables must be a subset of this factor's variables, 
+            so that the layout of this factor does not change.
+            
+            Parameter
+            ---------
+            other : Factor
+                The factor that is multiplied into this factor.
+                
+            Returns
+            -------
+                Factor
+                This factor, to allow chaining of in-place operations.
+        """
+        self._check_domain(other)
+        multiply = np.add if self.logspace else np.multiply
+        self._apply_inplace(multiply, self._aligned_operand(other))
+        return self
+        
+    def idiv(self, other):
+        """
+            Divides this factor by the other factor in place, while forcing 
+            x/0=0 as in the out-of-place division. The other factor's variables
+            must be a subset of this factor's variables.
+            
+            Parameter
+            ---------
+            other : Factor
+                The factor that this factor is divided with.
+                
+            Returns
+            -------
+                Factor
+                This factor, to allow chaining of in-place operations.
+        """
+        self._check_domain(other)
+        right = self._aligned_operand(other)
+        # Only the (usually small) divisor is inverted into a temporary
+        if self.logspace:
+            inverse = np.negative(right)
+            inverse[inverse == np.inf] = -np.inf
+            multiply = np.add
+        else:
+            inverse = np.zeros(np.shape(right), dtype=_float_dtype(self.potentials))
+            np.divide(1.0, right, out=inverse, where=right != 0)
+            multiply = np.multiply
+        self._apply_inplace(multiply, inverse)
+        return self
+        
+    def _apply_inplace(self, ufunc, right):
+        """
+            Helper function applying the given binary ufunc to this factor's
+            potentials and the aligned operand in place. Large potentials are
+            processed in chunks along their first axis.
+        """
+        if not isinstance(self.potentials, np.ndarray):
+            self.potentials = ufunc(self.potentials, right)
+            return
+        chunks = _chunk_slices(self.potentials)
+        if chunks is None:
+            ufunc(self.potentials, right, out=self.potentials)
+            return
+        right = np.asarray(right)
+        # Operands with fewer dimensions (or a singleton first axis) 
+        # broadcast against every chunk
+        sliced = right.ndim == self.potentials.ndim and right.shape[0] != 1
+        for chunk in chunks:
+            part = self.potentials[chunk]
+            ufunc(part, right[chunk] if sliced else right, out=part)
+        
+    def _aligned_operand(self, other):
+        """
+            Helper function returning a view of the other factor's potentials
+            that broadcasts against this factor's potentials.
+        """
+        if other.batchSize is not None and self.batchSize is None:
+            raise ValueError("A batched factor cannot be combined in place " \
+                             "with an unbatched factor.")
+        if len(other.variableOrder) == 0:
+            if other.batchSize is not None:
+                return np.reshape(other.potentials, 
+                                  (-1,) + (1,) * len(self.variableOrder))
+            return other.potentials
+        if not set(other.variableOrder).issubset(self.values):
+            raise ValueError("In-place operations require the other factor's " \
+                             "variables to be a subset of this factor's " \
+                             "variables: Other: {}, Self: {}"
+                            .format(other.variableOrder, self.variableOrder))
+        plan = ProductPlan.get(self.variableOrder, other.variableOrder)
+        return plan.align(self.potentials, other.potentials, 
+                          other.batchSize is not None)[1]
     
     def copy(self):
         """
@@ -252,6 +645,183 @@ class Factor(object):
         #modification of these lists impossible.
         res.values = dict(self.values)
         res.variableOrder = list(self.variableOrder)
+        res.logspace = self.logspace
+        res.batchSize = self.batchSize
+        return res
+        
+    @property
+    def dtype(self):
+        """
+            The floating point type of the potentials of this factor.
+        """
+        return _float_dtype(self.potentials)
+        
+    def astype(self, dtype):
+        """
+            Creates a copy of this factor whose potentials are converted to
+            the given floating point type.
+            
+            Parameter
+            ---------
+            dtype : np.dtype
+                The floating point type of the resulting potentials.
+                
+            Returns
+            -------
+                Factor
+                The converted factor.
+        """
+        res = self.copy()
+        res.potentials = np.asarray(res.potentials).astype(dtype)
+        return res
+        
+    def expand_batch(self, batchSize):
+        """
+            Creates a batched copy of this factor that contains the potentials
+            of this factor for each of the given number of cases.
+            
+            Parameter
+            ---------
+            batchSize : int
+                The number of cases of the resulting factor.
+                
+            Returns
+            -------
+                Factor
+                The batched factor with potentials of shape 
+                (batchSize,) + shape of this factor's potentials.
+        """
+        if self.batchSize is not None:
+            raise ValueError("The factor is already batched.")
+        res = self.to_dense() if self.sparse else self.copy()
+        potentials = np.asarray(res.potentials)
+        res.potentials = np.empty((batchSize,) + potentials.shape, 
+                                  dtype=_float_dtype(potentials))
+        res.potentials[...] = potentials
+        res.batchSize = batchSize
+        return res
+        
+    @classmethod
+    def stack(cls, factors):
+        """
+            Combines the given factors over the same variables into a single
+            batched factor with one case per factor. The variable order of
+            the first factor is used for all cases.
+            
+            Parameter
+            ---------
+            factors : [Factor,]
+                The (unbatched) factors of all cases.
+                
+            Returns
+            -------
+                Factor
+                The batched factor containing all given factors.
+        """
+        first = factors[0]
+        res = cls()
+        res.variableOrder = list(first.variableOrder)
+        res.values = dict(first.values)
+        res.logspace = first.logspace
+        potentials = []
+        for f in factors:
+            if set(f.variableOrder) != set(first.variableOrder):
+                raise ValueError("Only factors over the same variables can " \
+                                 "be stacked: {} and {}."
+                                 .format(first.variableOrder, f.variableOrder))
+            first._check_domain(f)
+            p = np.asarray(f.potentials)
+            if f.variableOrder != first.variableOrder:
+                p = np.transpose(p, [f.variableOrder.index(v) 
+                                     for v in first.variableOrder])
+            potentials.append(p)
+        res.potentials = np.stack(potentials)
+        res.batchSize = len(factors)
+        return res
+        
+    def get_case(self, index):
+        """
+            Returns the (unbatched) factor of a single case of this batched 
+            factor.
+            
+            Parameter
+            ---------
+            index : int
+                The index of the case within the batch.
+                
+            Returns
+            -------
+                Factor
+                A copy of the factor of the given case.
+        """
+        if self.batchSize is None:
+            raise ValueError("The factor is not batched.")
+        res = self.copy()
+        res.potentials = np.copy(self.potentials[index])
+        res.batchSize = None
+        return res
+        
+    def sparsify(self, threshold=None):
+        """
+            Returns a sparse representation of this factor if the fraction of
+            its non-zero potentials is below the given threshold, e.g. for
+            (near-)deterministic CPTs. Factors in log space, batched factors
+            and trivial factors are never stored sparsely.
+            
+            Parameter
+            ---------
+            threshold : float, optional
+                Density below which the sparse representation is chosen.
+                Defaults to Factor.sparseThreshold.
+                
+            Returns
+            -------
+                Factor
+                A SparseFactor or this factor itself.
+        """
+        if threshold is None:
+            threshold = Factor.sparseThreshold
+        if self.logspace or self.batchSize is not None \
+                or np.ndim(self.potentials) == 0 \
+                or np.size(self.potentials) == 0:
+            return self
+        if np.count_nonzero(self.potentials) < threshold * np.size(self.potentials):
+            return SparseFactor.from_dense(self)
+        return self
+        
+    def to_log(self):
+        """
+            Creates a copy of this factor in log space, i.e. with the natural
+            logarithm of all potentials. Zero potentials become -inf.
+            
+            Returns
+            -------
+                Factor
+                The factor in log space (a copy of self if this factor is 
+                already in log space).
+        """
+        res = self.copy()
+        if not self.logspace:
+            with np.errstate(divide="ignore"):
+                res.potentials = np.log(res.potentials)
+            res.logspace = True
+        return res
+        
+    def to_linear(self):
+        """
+            Creates a copy of this factor in linear space, i.e. with the 
+            exponential of all (log) potentials.
+            
+            Returns
+            -------
+                Factor
+                The factor in linear space (a copy of self if this factor is 
+                already in linear space).
+        """
+        res = self.copy()
+        if self.logspace:
+            res.potentials = np.exp(res.potentials)
+            res.logspace = False
         return res
 
     def invert(self):
@@ -267,7 +837,13 @@ class Factor(object):
                 A factor with inverted potentials.
         """
         res = self.copy()
-        if len(res.variableOrder) == 0:
+        if self.logspace:
+            res.potentials = -res.potentials
+            if np.ndim(res.potentials) > 0:
+                res.potentials[res.potentials == np.inf] = -np.inf
+            elif res.potentials == np.inf:
+                res.potentials = -np.inf
+        elif np.ndim(res.potentials) == 0:
             with np.errstate(divide="raise"):
                 try:
                     res.potentials = 1.0/res.potentials
@@ -279,6 +855,30 @@ class Factor(object):
                 res.potentials[res.potentials==np.inf] = 0
         return res
 
+    def iinvert(self):
+        """
+            Inverts all potentials of this factor in place (i.e. each potential 
+            p is replaced by 1/p, while forcing 1/0=0).
+            
+            Returns
+            -------
+                Factor
+                This factor, to allow chaining of in-place operations.
+        """
+        if self.logspace:
+            if isinstance(self.potentials, np.ndarray):
+                np.negative(self.potentials, out=self.potentials)
+                self.potentials[self.potentials == np.inf] = -np.inf
+            else:
+                self.potentials = -self.potentials if self.potentials != -np.inf \
+                                    else -np.inf
+        elif isinstance(self.potentials, np.ndarray):
+            np.divide(1.0, self.potentials, out=self.potentials, 
+                      where=self.potentials != 0)
+        else:
+            self.potentials = 1.0/self.potentials if self.potentials != 0 else 0
+        return self
+
     @classmethod
     def from_samples(cls, samples, variableValues):
         """
@@ -312,40 +912,78 @@ class Factor(object):
 #            res.variables[v] = i
             res.values[v] = tuple(variableValues[v])
             shape.append(len(variableValues[v]))
-        res.potentials = np.zeros(shape)
-        for s in samples:
-            idx = []
-            for v in res.variableOrder:
-                idx.append(res.values[v].index(s[v]))
-            res.potentials[tuple(idx)] += 1
+        lookups = [(v, _value_indices(res.values[v])) for v in res.variableOrder]
+        try:
+            idx = [tuple(lookup[s[v]] for v, lookup in lookups) for s in samples]
+        except KeyError as e:
+            raise ValueError("{} is not a known value of the sampled " \
+                             "variables.".format(e.args[0]))
+        counts = np.zeros(int(np.prod(shape)))
+        if idx:
+            flat = np.ravel_multi_index(tuple(np.array(idx, dtype=np.intp).T), shape) \
+                        if shape else np.zeros(len(idx), dtype=np.intp)
+            counts = np.bincount(flat, minlength=len(counts)).astype(float)
+        res.potentials = counts.reshape(shape)
         res.potentials /= np.sum(res.potentials)
         return res
 
 
     @classmethod
-    def unit_factor(cls, variableOrder, values):
+    def unit_factor(cls, variableOrder, values, logspace=False, dtype=np.float64,
+                    storage=None):
+        """
+            Creates a factor over the given variables whose potentials are
+            all one (zero in log space).
+            
+            Parameters
+            ----------
+            variableOrder: [String,]
+                The variables of the factor, in the order of its axes.
+            values: dict
+                Dictionary containing the values of each variable.
+            logspace: bool, optional
+                If True, the factor is created in log space.
+            dtype: np.dtype, optional
+                The floating point type of the potentials.
+            storage: ScratchSpace, optional
+                If given, the potentials are allocated by this scratch space,
+                e.g. as memory-mapped file.
+                
+            Returns
+            -------
+                Factor
+                The resulting unit factor.
+        """
         res = cls()
         shape = []
         for v in variableOrder:
             res.variableOrder.append(v)
             res.values[v] = tuple(values[v])
             shape.append(len(values[v]))
-        res.potentials = np.ones(shape)
+        if storage is None:
+            res.potentials = np.zeros(shape, dtype=dtype) if logspace \
+                                else np.ones(shape, dtype=dtype)
+        else:
+            res.potentials = storage.allocate(shape, dtype)
+            res.potentials.fill(0 if logspace else 1)
+        res.logspace = logspace
         return res
         
     @classmethod
-    def zero_factor(cls, variableOrder, values):
+    def zero_factor(cls, variableOrder, values, logspace=False, dtype=np.float64):
         res = cls()
         shape = []
         for v in variableOrder:
             res.variableOrder.append(v)
             res.values[v] = tuple(values[v])
             shape.append(len(values[v]))
-        res.potentials = np.zeros(shape)
+        res.potentials = np.full(shape, -np.inf, dtype=dtype) if logspace \
+                            else np.zeros(shape, dtype=dtype)
+        res.logspace = logspace
         return res
 
     @classmethod
-    def get_trivial(cls, potential=1.0):
+    def get_trivial(cls, potential=1.0, logspace=False):
         """
             Helper function to create a trivial factor with a given potential.
             A trivial factor does not represent any variables anymore.
@@ -354,6 +992,9 @@ class Factor(object):
             ---------
             potential : Float, optional
                 The potential this factor should be initialized with.
+            logspace : bool, optional
+                If True, the factor is created in log space (the given
+                potential is still specified in linear space).
 
             Returns
             -------
@@ -361,7 +1002,11 @@ class Factor(object):
                 The resulting trivial factor.
         """
         res = cls()
+        if logspace:
+            with np.errstate(divide="ignore"):
+                potential = np.log(potential)
         res.potentials = potential
+        res.logspace = logspace
         return res
     
     
@@ -392,7 +1037,7 @@ class Factor(object):
         return res
 
     @classmethod
-    def from_node(cls, node):
+    def from_node(cls, node, copy=True, logspace=False):
         """
             Helper function that allows to create a factor from a random node.
             Currently only DiscreteNodes are supported.
@@ -401,6 +1046,13 @@ class Factor(object):
             --------
             node : DiscreteNode
                 The node which is used to create the factor.
+            copy : bool, optional
+                If False, the factor's potentials are a view on the node's cpd
+                instead of a copy. Such factors must never be modified, e.g. 
+                they should only be used as operands. (Default: True)
+            logspace : bool, optional
+                If True, the factor is created in log space. This always 
+                creates new potentials. (Default: False)
 
             Returns
             -------
@@ -413,7 +1065,12 @@ class Factor(object):
 #        res.variables[node.name] = len(res.variables)
         res.variableOrder.append(node.name)
         res.values[node.name] = tuple(node.values) 
-        res.potentials = np.copy(node.cpd)
+        if logspace:
+            with np.errstate(divide="ignore"):
+                res.potentials = np.log(node.cpd)
+            res.logspace = True
+        else:
+            res.potentials = np.copy(node.cpd) if copy else node.cpd
         for p in node.parentOrder:
 #            res.variables[p] = len(res.variables)
             res.variableOrder.append(p)
@@ -421,7 +1078,7 @@ class Factor(object):
         return res
         
     @classmethod
-    def as_evidence(cls, variable, values, evidence, oldMarginals=None):
+    def as_evidence(cls, variable, values, evidence, oldMarginals=None, logspace=False):
         """
             Creates an "evidence factor" which is used to introduce hart and
             soft evidence into the inference algorithms. In case of soft evidence
@@ -455,6 +1112,8 @@ class Factor(object):
                 as "nothing else considered" soft evidence 
                 (cf. pp.41 same book), i.e. the evidence is directly 
                 interpeted as likelihood ratio.
+            logspace: bool, optional
+                If True, the evidence factor is created in log space.
                 
             Returns
             -------
@@ -506,9 +1165,60 @@ class Factor(object):
             else:
                 #Interpet given (soft) evidence as proportion
                 res.potentials = np.copy(evidence)
+        if logspace:
+            with np.errstate(divide="ignore"):
+                res.potentials = np.log(res.potentials)
+            res.logspace = True
+        return res
+        
+    def reduce(self, assignment):
+        """
+            Creates a factor in which the given variables are fixed to the 
+            given values, i.e. the axes of these variables are sliced away. 
+            This is equivalent to multiplying hard evidence for these
+            variables into this factor and summing them out afterwards, but
+            it shrinks the factor instead of zeroing most of its entries. 
+            The potentials of the resulting factor are a view on the 
+            potentials of this factor whenever possible.
+            
+            Parameter
+            ---------
+            assignment : dict
+                Dictionary containing variable names as keys and the observed
+                values as values. Variables not contained in this factor are
+                ignored.
+                
+            Returns
+            -------
+                Factor
+                The reduced factor (self if no variable of this factor is
+                assigned).
+        """
+        if not any(v in self.values for v in assignment):
+            return self
+        index = [] if self.batchSize is None else [slice(None)]
+        for v in self.variableOrder:
+            index.append(self._value_index(v, assignment[v]) if v in assignment
+                            else slice(None))
+        res = Factor()
+        res.variableOrder = [v for v in self.variableOrder if v not in assignment]
+        res.values = {v: self.values[v] for v in res.variableOrder}
+        res.potentials = np.asarray(self.potentials)[tuple(index)]
+        res.logspace = self.logspace
+        res.batchSize = self.batchSize
         return res
         
-   
+    def _value_index(self, variable, value):
+        """
+            Helper function returning the index of the given value of the
+            given variable.
+        """
+        try:
+            return _value_indices(self.values[variable])[value]
+        except (KeyError, TypeError):
+            raise ValueError("Evidence {} is not one of the possible " \
+                             "values ({}) for this variable."
+                            .format(value, list(self.values[variable])))
     
     def marginalize(self, variables):
         """
@@ -528,17 +1238,174 @@ class Factor(object):
                 Factor
                 A new factor where the given variables has been summed out.
         """
+        return self.marginalize_into(variables)
         
-        if not isinstance(variables, (list,set)):
-            variables = [variables]
+    def marginalize_into(self, variables, out=None):
+        """
+            Sums the given variables out of this factor in a single pass and
+            writes the result into the given output factor. This allows to
+            reuse preallocated factors, e.g. for separators in a jointree.
             
-        res = self.copy()
-        for v in variables:
-            res.potentials = np.sum(res.potentials, axis=res.variableOrder.index(v))
-            del res.values[v]
-            res.variableOrder.remove(v)
+            Parameter
+            ---------
+            variables: String, RandomNode, [String,], [RandomNode,], set(String,) or set(RandomNode)
+                Either a single variable or a list of variables that are to
+                be removed.
+            out: Factor, optional
+                Factor over exactly the remaining variables (in any order) 
+                whose potentials are overwritten with the result. If not 
+                given, a new factor is created.
+                
+            Returns
+            ------
+                Factor
+                The factor containing the result (out if it was given).
+        """
+        if self.logspace:
+            return self._reduce_into(variables, out, _logsumexp, np.logaddexp)
+        return self._reduce_into(variables, out, np.sum, np.add)
+        
+    def max_marginalize(self, variables, out=None):
+        """
+            Maximises the given variables out of this factor in a single pass,
+            i.e. each remaining potential is the largest potential over all 
+            assignments of the removed variables. This is the building block
+            of MPE and MAP queries.
             
-        return res
+            Parameter
+            ---------
+            variables: String, RandomNode, [String,], [RandomNode,], set(String,) or set(RandomNode)
+                Either a single variable or a list of variables that are to
+                be removed.
+            out: Factor, optional
+                Factor over exactly the remaining variables (in any order) 
+                whose potentials are overwritten with the result. If not 
+                given, a new factor is created.
+                
+            Returns
+            ------
+                Factor
+                The factor containing the result (out if it was given).
+        """
+        return self._reduce_into(variables, out, np.max, np.maximum)
+        
+    def min_marginalize(self, variables, out=None):
+        """
+            Minimises the given variables out of this factor in a single pass.
+            See max_marginalize for the parameters.
+            
+            Returns
+            ------
+                Factor
+                The factor containing the result (out if it was given).
+        """
+        return self._reduce_into(variables, out, np.min, np.minimum)
+        
+    def argmax_marginalize(self, variables):
+        """
+            Maximises the given variables out of this factor (see 
+            max_marginalize) and additionally returns back pointers to the
+            maximising assignments of the removed variables.
+            
+            Parameter
+            ---------
+            variables: String, RandomNode, [String,], [RandomNode,], set(String,) or set(RandomNode)
+                Either a single variable or a list of variables that are to
+                be removed.
+                
+            Returns
+            ------
+                Factor
+                The factor containing the maximal potentials.
+                dict
+                Dictionary containing the removed variables as keys and 
+                integer arrays as values. Each array has the shape of the 
+                resulting potentials and holds the value index of the 
+                variable in the maximising assignment of each entry.
+        """
+        if not isinstance(variables, (list,set,tuple,frozenset)):
+            variables = [variables]
+        variables = [v for v in self.variableOrder if v in variables]
+        offset = 0 if self.batchSize is None else 1
+        axes = [self.variableOrder.index(v) + offset for v in variables]
+        potentials = np.asarray(self.potentials)
+        kept = [i for i in range(potentials.ndim) if i not in axes]
+        # Move the removed axes to the back and flatten them, so that a 
+        # single argmax finds the maximising joint assignment
+        moved = np.transpose(potentials, kept + axes)
+        shape = moved.shape[:len(kept)]
+        flat = moved.reshape(shape + (-1,))
+        best = np.argmax(flat, axis=-1)
+        
+        res = Factor()
+        res.variableOrder = [v for v in self.variableOrder if v not in variables]
+        res.values = {v: self.values[v] for v in res.variableOrder}
+        res.logspace = self.logspace
+        res.batchSize = self.batchSize
+        res.potentials = np.take_along_axis(flat, best[..., np.newaxis], 
+                                            axis=-1)[..., 0]
+        indices = np.unravel_index(best, moved.shape[len(kept):])
+        return res, dict(zip(variables, indices))
+        
+    def _reduce_into(self, variables, out, reduce_, accumulate):
+        """
+            Helper function removing the given variables from this factor 
+            with the given reduction (e.g. np.sum or np.max) in a single pass.
+            Accumulate combines two partial results of the reduction and is
+            used when large potentials are reduced in chunks.
+            See marginalize_into for the remaining parameters.
+        """
+        if not isinstance(variables, (list,set,tuple,frozenset)):
+            variables = [variables]
+        # Variables are located behind the batch axis of batched factors
+        offset = 0 if self.batchSize is None else 1
+        axes = tuple(self.variableOrder.index(v) + offset for v in variables)
+        remaining = [v for v in self.variableOrder if v not in variables]
+        potentials = self.potentials
+        chunks = _chunk_slices(potentials) if axes else None
+        
+        if out is None:
+            out = Factor()
+            out.variableOrder = remaining
+            out.values = {v: self.values[v] for v in remaining}
+            out.logspace = self.logspace
+            out.batchSize = self.batchSize
+            if chunks is not None:
+                shape = [n for i, n in enumerate(potentials.shape) 
+                            if i not in axes]
+                out.potentials = np.empty(shape, dtype=potentials.dtype)
+                _reduce_chunks(potentials, reduce_, accumulate, axes, chunks, 
+                               out.potentials)
+                return out
+            out.potentials = reduce_(potentials, axis=axes) if axes \
+                                else np.copy(potentials)
+            return out
+        
+        if out.logspace != self.logspace:
+            raise ValueError("The output factor is not in the same domain " \
+                             "as this factor.")
+        if out.batchSize != self.batchSize:
+            raise ValueError("The output factor does not have the same batch " \
+                             "size as this factor.")
+        
+        if len(out.variableOrder) != len(remaining) \
+                or not set(out.variableOrder).issubset(remaining):
+            raise ValueError("The output factor's variables {} do not match " \
+                             "the remaining variables {}."
+                            .format(out.variableOrder, remaining))
+        # Write through a view of out that has the remaining variables in
+        # the order in which the reduction produces them.
+        target = np.transpose(out.potentials, list(range(offset)) +
+                              [out.variableOrder.index(v) + offset for v in remaining])
+        if chunks is not None:
+            _reduce_chunks(potentials, reduce_, accumulate, axes, chunks, target)
+        elif axes and reduce_ is not _logsumexp:
+            reduce_(potentials, axis=axes, out=target)
+        elif axes:
+            np.copyto(target, _logsumexp(potentials, axis=axes))
+        else:
+            np.copyto(target, potentials)
+        return out
         
     def get_potential(self, variables=None):
         """
@@ -550,6 +1417,8 @@ class Factor(object):
             variables.
             
             If variables is not given, will simply return the full potential table.
+            For batched factors, the potentials of all cases are returned 
+            along the leading axis.
             
             Parameter
             ---------
@@ -566,12 +1435,13 @@ class Factor(object):
         if not variables:
             variables = {}
         
-        index = []        
+        index = [] if self.batchSize is None else [range(self.batchSize)]
         for v in self.variableOrder:
             if v in variables:
+                lookup = _value_indices(self.values[v])
                 try:
-                    index.append([self.values[v].index(value) for value in variables[v]])
-                except ValueError:
+                    index.append([lookup[value] for value in variables[v]])
+                except (KeyError, TypeError):
                     raise ValueError("There is no potential for variable {} with values {} in this factor.".format(v, variables[v]))
             else:
                 index.append(range(len(self.values[v])))
@@ -585,10 +1455,58 @@ class Factor(object):
         """
             Normalizes the included potential so that they add up to 1. Should
             mainly be used internally when computing posterior marginals!
+            In log space, the potentials are shifted so that their 
+            exponentials add up to 1. Batched factors are normalized for each
+            case separately.
+            
+            Returns
+            -------
+                Factor
+                This factor, to allow chaining of in-place operations.
         """
+        if self.batchSize is not None:
+            axes = tuple(range(1, np.ndim(self.potentials)))
+            shape = (-1,) + (1,) * len(axes)
+            if self.logspace:
+                logSum = np.reshape(_logsumexp(self.potentials, axis=axes), shape)
+                logSum[logSum == -np.inf] = 0
+                self.potentials -= logSum
+            else:
+                potentialSum = np.sum(self.potentials, axis=axes).reshape(shape)
+                np.divide(self.potentials, potentialSum, out=self.potentials,
+                          where=potentialSum > 0)
+            return self
+        if self.logspace:
+            logSum = _logsumexp(self.potentials)
+            if logSum > -np.inf:
+                self.potentials -= logSum
+            return self
         potentialSum = np.sum(self.potentials)
         if potentialSum > 0:
             self.potentials /= potentialSum
+        return self
+        
+    def log_normalizer(self):
+        """
+            Computes the natural logarithm of the sum of all potentials, i.e.
+            of the constant that normalize divides by. For an unnormalized 
+            joint factor, this is the log probability of the evidence it
+            contains.
+            
+            Returns
+            -------
+                float or np.array
+                The logarithm of the sum (-inf if all potentials are zero).
+                For batched factors, an array containing the logarithm for 
+                each case is returned.
+        """
+        axes = None
+        if self.batchSize is not None:
+            axes = tuple(range(1, np.ndim(self.potentials)))
+        if self.logspace:
+            return _logsumexp(self.potentials, axis=axes)
+        with np.errstate(divide="ignore"):
+            return np.log(np.sum(self.potentials, axis=axes))
             
             
     @classmethod
@@ -614,4 +1532,295 @@ class Factor(object):
         else:
             probFactor = Factor.from_node(node)
             utFactor = Factor.zero_factor(probFactor.variableOrder, probFactor.values)
-        return (probFactor,utFactor)
\ No newline at end of file
+        return (probFactor,utFactor)
+
+
+def _sparse_or_dense(variableOrder, values, shape, indices, data):
+    """
+        Helper function that creates a SparseFactor from the given non-zero
+        entries, unless their density exceeds Factor.sparseThreshold in which
+        case a dense Factor is created.
+    """
+    size = int(np.prod(shape)) if shape else 1
+    if len(shape) == 0:
+        res = Factor()
+        res.potentials = np.sum(data)
+    elif len(data) >= Factor.sparseThreshold * size:
+        res = Factor()
+        res.potentials = np.zeros(shape, dtype=_float_dtype(data))
+        res.potentials[tuple(indices.T)] = data
+    else:
+        res = SparseFactor()
+        res.shape = tuple(shape)
+        res.indices = indices
+        res.data = data
+    res.variableOrder = list(variableOrder)
+    res.values = {v: values[v] for v in variableOrder}
+    return res
+    
+    
+def _sparse_product(left, right):
+    """
+        Multiplies two factors of which at least one is a SparseFactor. Only
+        the non-zero entries of the sparse operand are touched, so the result
+        has at most as many non-zero entries as the sparse operand times the 
+        number of instantiations of the variables only contained in the other 
+        operand.
+        
+        The variable order of the result is the same as for dense products.
+    """
+    if left.logspace or right.logspace:
+        raise ValueError("Sparse factors cannot be combined with factors in " \
+                         "log space.")
+    plan = ProductPlan.get(left.variableOrder, right.variableOrder)
+    values = dict(right.values)
+    values.update(left.values)
+    if left.sparse and right.sparse:
+        # Densify the smaller operand and join the other one against it
+        if np.prod(left.shape) <= np.prod(right.shape):
+            left = left.to_dense()
+        else:
+            right = right.to_dense()
+    sparseF, denseF = (left, right) if left.sparse else (right, left)
+    
+    sVars = sparseF.variableOrder
+    shared = [v for v in sVars if v in denseF.values]
+    extra = [v for v in plan.resOrder if v not in sparseF.values]
+    denseP = np.asarray(denseF.potentials)
+    if denseF.variableOrder:
+        denseP = np.transpose(denseP, [denseF.variableOrder.index(v) 
+                                       for v in shared + extra])
+    nnz = len(sparseF.data)
+    if shared:
+        cols = [sVars.index(v) for v in shared]
+        block = denseP[tuple(sparseF.indices[:, cols].T)]
+    else:
+        block = np.broadcast_to(denseP, (nnz,) + np.shape(denseP))
+    extraShape = block.shape[1:]
+    data = (sparseF.data.reshape((-1,) + (1,)*len(extraShape)) * block).ravel()
+    if extra:
+        numExtra = int(np.prod(extraShape))
+        extraIdx = np.indices(extraShape).reshape(len(extraShape), -1).T
+        indices = np.hstack([np.repeat(sparseF.indices, numExtra, axis=0),
+                             np.tile(extraIdx, (nnz, 1))])
+    else:
+        indices = sparseF.indices
+    resVars = sVars + extra
+    indices = indices[:, [resVars.index(v) for v in plan.resOrder]]
+    # Drop zeros introduced by the other operand
+    keep = data != 0
+    shape = tuple(len(values[v]) for v in plan.resOrder)
+    return _sparse_or_dense(plan.resOrder, values, shape, indices[keep], data[keep])
+
+
+class SparseFactor(Factor):
+    """
+        Factor that only stores its non-zero potentials in coordinate (COO)
+        format, i.e. as an integer index array with one row per non-zero 
+        entry and the corresponding potentials.
+        
+        This pays off for (near-)deterministic CPTs and the clique potentials
+        built from them: products only touch the non-zero entries and zeros
+        stay zero under multiplication and division, so sparse clique 
+        potentials remain sparse during message passing.
+        
+        SparseFactors support the same interface as Factor. The dense 
+        potentials are still available through the potentials attribute, but
+        are created on demand.
+    """
+    
+    sparse = True
+    
+    def __init__(self):
+        self.shape = ()
+        self.indices = np.zeros((0, 0), dtype=np.intp)
+        self.data = np.array([])
+        super(SparseFactor, self).__init__()
+        
+    @property
+    def potentials(self):
+        """
+            The dense potentials of this factor (created on demand).
+        """
+        if len(self.shape) == 0:
+            return np.sum(self.data)
+        res = np.zeros(self.shape, dtype=self.data.dtype)
+        res[tuple(self.indices.T)] = self.data
+        return res
+    
+    @potentials.setter
+    def potentials(self, potentials):
+        potentials = np.asarray(potentials)
+        potentials = potentials.astype(_float_dtype(potentials), copy=False)
+        self.shape = potentials.shape
+        if potentials.ndim == 0:
+            self.indices = np.zeros((1, 0), dtype=np.intp)
+            self.data = potentials.reshape(1)
+        else:
+            nonZero = np.nonzero(potentials)
+            self.indices = np.column_stack(nonZero).astype(np.intp)
+            self.data = potentials[nonZero]
+            
+    @property
+    def density(self):
+        """
+            The fraction of non-zero entries of this factor.
+        """
+        return len(self.data) / max(1, int(np.prod(self.shape)))
+        
+    @classmethod
+    def from_dense(cls, factor):
+        """
+            Creates a sparse copy of the given (dense) factor.
+            
+            Parameter
+            ---------
+            factor : Factor
+                The factor that should be represented sparsely.
+                
+            Returns
+            -------
+                SparseFactor
+                The sparse representation of the given factor.
+        """
+        if factor.logspace:
+            raise ValueError("Factors in log space cannot be stored sparsely.")
+        res = cls()
+        res.variableOrder = list(factor.variableOrder)
+        res.values = dict(factor.values)
+        res.potentials = factor.potentials
+        return res
+        
+    def to_dense(self):
+        """
+            Creates a dense copy of this factor.
+            
+            Returns
+            -------
+                Factor
+                The dense representation of this factor.
+        """
+        res = Factor()
+        res.variableOrder = list(self.variableOrder)
+        res.values = dict(self.values)
+        res.potentials = self.potentials
+        return res
+        
+    def sparsify(self, threshold=None):
+        return self
+        
+    @property
+    def dtype(self):
+        return self.data.dtype
+        
+    def astype(self, dtype):
+        res = self.copy()
+        res.data = res.data.astype(dtype)
+        return res
+        
+    def copy(self):
+        res = SparseFactor()
+        res.shape = self.shape
+        res.indices = np.copy(self.indices)
+        res.data = np.copy(self.data)
+        res.values = dict(self.values)
+        res.variableOrder = list(self.variableOrder)
+        return res
+        
+    def to_log(self):
+        return self.to_dense().to_log()
+        
+    def to_linear(self):
+        return self.copy()
+        
+    def invert(self):
+        res = self.copy()
+        return res.iinvert()
+    
+    def iinvert(self):
+        np.divide(1.0, self.data, out=self.data, where=self.data != 0)
+        return self
+        
+    def imul(self, other):
+        self._check_domain(other)
+        np.multiply(self.data, self._gather(other), out=self.data)
+        return self
+        
+    def idiv(self, other):
+        self._check_domain(other)
+        divisor = self._gather(other)
+        inverse = np.zeros(np.shape(divisor), dtype=self.data.dtype)
+        np.divide(1.0, divisor, out=inverse, where=divisor != 0)
+        np.multiply(self.data, inverse, out=self.data)
+        return self
+        
+    def _gather(self, other):
+        """
+            Helper function returning the other factor's potentials for each
+            non-zero entry of this factor.
+        """
+        if other.batchSize is not None:
+            raise ValueError("Sparse factors cannot be combined in place " \
+                             "with batched factors.")
+        if len(other.variableOrder) == 0:
+            return other.potentials
+        if not set(other.variableOrder).issubset(self.values):
+            raise ValueError("In-place operations require the other factor's " \
+                             "variables to be a subset of this factor's " \
+                             "variables: Other: {}, Self: {}"
+                            .format(other.variableOrder, self.variableOrder))
+        cols = [self.variableOrder.index(v) for v in other.variableOrder]
+        return np.asarray(other.potentials)[tuple(self.indices[:, cols].T)]
+        
+    def reduce(self, assignment):
+        if not any(v in self.values for v in assignment):
+            return self
+        keep = np.ones(len(self.data), dtype=bool)
+        for v in assignment:
+            if v in self.values:
+                col = self.variableOrder.index(v)
+                keep &= self.indices[:, col] == self._value_index(v, assignment[v])
+        remaining = [v for v in self.variableOrder if v not in assignment]
+        cols = [self.variableOrder.index(v) for v in remaining]
+        shape = tuple(self.shape[c] for c in cols)
+        return _sparse_or_dense(remaining, self.values, shape, 
+                                self.indices[keep][:, cols], self.data[keep])
+        
+    def marginalize_into(self, variables, out=None):
+        if not isinstance(variables, (list,set,tuple,frozenset)):
+            variables = [variables]
+        remaining = [v for v in self.variableOrder if v not in variables]
+        cols = [self.variableOrder.index(v) for v in remaining]
+        shape = tuple(self.shape[c] for c in cols)
+        flat = np.ravel_multi_index(tuple(self.indices[:, cols].T), shape) \
+                    if remaining else np.zeros(len(self.data), dtype=np.intp)
+        
+        if out is None:
+            keys, inverse = np.unique(flat, return_inverse=True)
+            sums = np.bincount(inverse.ravel(), weights=self.data, 
+                               minlength=len(keys)).astype(self.data.dtype, copy=False)
+            indices = np.column_stack(np.unravel_index(keys, shape)).astype(np.intp) \
+                        if remaining else np.zeros((len(keys), 0), dtype=np.intp)
+            return _sparse_or_dense(remaining, self.values, shape, indices, sums)
+        
+        if len(out.variableOrder) != len(remaining) \
+                or not set(out.variableOrder).issubset(remaining):
+            raise ValueError("The output factor's variables {} do not match " \
+                             "the remaining variables {}."
+                            .format(out.variableOrder, remaining))
+        sums = np.bincount(flat, weights=self.data, 
+                           minlength=int(np.prod(shape))).reshape(shape)
+        target = np.transpose(out.potentials, 
+                              [out.variableOrder.index(v) for v in remaining])
+        np.copyto(target, sums)
+        return out
+        
+    def normalize(self):
+        potentialSum = np.sum(self.data)
+        if potentialSum > 0:
+            self.data /= potentialSum
+        return self
+        
+    def log_normalizer(self):
+        with np.errstate(divide="ignore"):
+            return np.log(np.sum(self.data))
@@ -21,6 +21,8 @@
 
 import random
 
+import numpy as np
+
 from .factor import Factor
 
 class MCMC(object):
@@ -76,14 +78,103 @@ class MCMC(object):
         if not evidence:
             evidence = {}
         initialState = self.bn.get_sample(evidence)
-        sampleChain = self.sampler.generate_markov_chain(self.bn, self.numSamples, initialState, evidence)
-        # Compute probability for variables given the samples
+        network = EncodedNetwork(self.bn)
+        sampleChain = self.sampler.generate_encoded_chain(network, self.numSamples, 
+                                                          network.symbols.encode(initialState),
+                                                          evidence)
+        # Compute probability for variables given the samples by counting
+        # the encoded instantiations of the variables
         variableValues = {v: self.bn.get_node(v).values for v in variables}
-        res = Factor.from_samples(sampleChain, variableValues)
+        res = Factor.zero_factor(variables, variableValues)
+        columns = [network.symbols.variable_id(v) for v in variables]
+        shape = np.shape(res.potentials)
+        samples = np.array([[state[c] for c in columns] for state in sampleChain], 
+                           dtype=np.intp).reshape(-1, len(columns))
+        if len(samples) > 0:
+            flat = np.ravel_multi_index(tuple(samples.T), shape) if shape \
+                        else np.zeros(len(samples), dtype=np.intp)
+            counts = np.bincount(flat, minlength=res.potentials.size)
+            res.potentials = counts.reshape(shape) / len(samples)
         
         return res
         
         
+class EncodedNetwork(object):
+    """
+        Compiled view on a BayesianNetwork for sampling on integer states 
+        (see SymbolTable). States are represented as lists containing the 
+        value index of each variable at the position of its ID. The cpds are
+        stored as flat lists together with the strides of their variables, 
+        so that the probabilities of a node's markov blanket can be looked up
+        without resolving any value names or creating numpy index arrays.
+    """
+    
+    def __init__(self, bn):
+        """
+            Compiles the given network.
+            
+            Parameters
+            ----------
+            bn : BayesianNetwork
+                The network that should be sampled.
+        """
+        self.bn = bn
+        self.symbols = bn.get_symbol_table()
+        numVars = len(self.symbols)
+        self.cpds = [None] * numVars
+        # Pairs of variable IDs and strides for the axes of each flat cpd
+        self.strides = [None] * numVars
+        self.children = [None] * numVars
+        for varId, name in enumerate(self.symbols.variables):
+            node = bn.get_node(name)
+            cpd = np.asarray(node.cpd, dtype=float)
+            self.cpds[varId] = cpd.ravel().tolist()
+            axes = [varId] + [self.symbols.variable_id(p) for p in node.parentOrder]
+            strides = [1] * len(axes)
+            for i in range(len(axes)-2, -1, -1):
+                strides[i] = strides[i+1] * cpd.shape[i+1]
+            self.strides[varId] = list(zip(axes, strides))
+            self.children[varId] = [self.symbols.variable_id(c) 
+                                    for c in bn.get_children(name)]
+        
+    def markov_prob(self, varId, state, forward=False):
+        """
+            Computes the probability of the value of the given variable in 
+            the given state, given its markov blanket.
+            
+            Parameters
+            ----------
+            varId : int
+                The ID of the variable.
+            state : [int,]
+                The encoded state containing the value indices of all 
+                variables in the markov blanket.
+            forward : bool, optional
+                If True, only the probability given the variable's parents
+                is computed.
+                
+            Returns
+            -------
+                float
+                The (unnormalized) probability of the variable's value.
+        """
+        prob = self._probability(varId, state)
+        if not forward:
+            for child in self.children[varId]:
+                prob *= self._probability(child, state)
+        return prob
+        
+    def _probability(self, varId, state):
+        """
+            Helper function returning the cpd entry of the given variable 
+            for the given state.
+        """
+        idx = 0
+        for axis, stride in self.strides[varId]:
+            idx += state[axis] * stride
+        return self.cpds[varId][idx]
+        
+        
     
     
 class MarkovChainSampler(object):
@@ -142,14 +233,50 @@ class MarkovChainSampler(object):
                 instantiation as values.
         """
         
-        variablesToChange = [node for node in bn.get_all_nodes() if node not in evidence]
+        network = EncodedNetwork(bn)
+        for state in self.generate_encoded_chain(network, numSamples, 
+                                                 network.symbols.encode(initialState), 
+                                                 evidence):
+            yield network.symbols.decode(state)
+            
+    def generate_encoded_chain(self, network, numSamples, initialState, evidence=None):
+        """
+            Generator yielding the given number of encoded samples drawn 
+            from the given network starting from the initialState (see
+            EncodedNetwork).
+            
+            Parameters
+            ----------
+            network : EncodedNetwork
+                The compiled network from which the samples are drawn.
+                
+            numSamples : int
+                The number of samples this generator returns in total
+                
+            initialState : [int,]
+                The encoded initial state of the network.
+                
+            evidence : dict, optional
+                A dictionary containg the evidence variable as keys and their
+                instantiation as values.
+            
+            Yields
+            -------
+                [int,]
+                The current encoded state. The same list is updated in place
+                for each step, so it must be copied if it should be kept.
+        """
+        if not evidence:
+            evidence = {}
+        variablesToChange = [i for i, v in enumerate(network.symbols.variables) 
+                                if v not in evidence]
         curSamples = 0
-        state = dict(initialState)
+        state = [int(i) for i in initialState]
         while curSamples < self.burnIn:
-            state = self.transitionModel.step(state, variablesToChange, bn, self.fullChange)
+            state = self.transitionModel.step_encoded(state, variablesToChange, network, self.fullChange)
             curSamples += 1
         for i in range(numSamples):
-            state = self.transitionModel.step(state, variablesToChange, bn, self.fullChange)
+            state = self.transitionModel.step_encoded(state, variablesToChange, network, self.fullChange)
             yield state
     
 class TransitionModel(object):
@@ -159,6 +286,39 @@ class TransitionModel(object):
     
     def step(self, currentState, variables, bn, fullChange=False):
         raise NotImplementedError("Should be overwritten by inheriting class.")
+        
+    def step_encoded(self, currentState, variablesToChange, network, fullChange=False):
+        """
+            Performs "one" markov step on an encoded state (see 
+            EncodedNetwork). Transition models that do not overwrite this 
+            method are called with the decoded state instead.
+            
+            Parameters
+            ----------
+            currentState : [int,]
+                The encoded current state.
+            
+            variablesToChange : [int,]
+                List containing the IDs of the variables for which a new state
+                needs to be sampled.
+                
+            network : EncodedNetwork
+                The compiled network that is supposed to be sampled.
+            
+            fullChange: Boolean, optional
+                If True, will create a new sample by sampling all non-evidence
+                variables again. Default: False
+                
+            Returns
+            -------
+                [int,]
+                The encoded new state.
+        """
+        symbols = network.symbols
+        state = self.step(symbols.decode(currentState), 
+                          [network.bn.get_node(symbols.variables[v]) for v in variablesToChange],
+                          network.bn, fullChange)
+        return symbols.encode(state).tolist()
     
 class GibbsTransition(TransitionModel):
     
@@ -191,6 +351,33 @@ class GibbsTransition(TransitionModel):
             currentState[varToChange.name] = varToChange.sample_value(currentState, bn.get_children(varToChange.name))
         
         return currentState
+        
+    def step_encoded(self, currentState, variablesToChange, network, fullChange=False):
+        if fullChange:
+            for v in variablesToChange:
+                self._sample_encoded(v, currentState, network)
+        else:
+            self._sample_encoded(random.choice(variablesToChange), currentState, network)
+        return currentState
+        
+    def _sample_encoded(self, varId, state, network):
+        """
+            Helper function to draw a new value for the given variable from
+            its distribution given its markov blanket (cf. 
+            DiscreteNode.sample_value).
+        """
+        weights = []
+        for valueIdx in range(int(network.symbols.cardinalities[varId])):
+            state[varId] = valueIdx
+            weights.append(network.markov_prob(varId, state))
+        #Perform roulette-wheel-sampling:
+        rndVal = random.random()* sum(weights)
+        s = 0
+        for i in range(len(weights)):
+            s += weights[i]
+            if s >= rndVal:
+                state[varId] = i
+                return
 
     
 class MetropolisHastingsTransition(TransitionModel):
@@ -241,4 +428,28 @@ class MetropolisHastingsTransition(TransitionModel):
                 currentState[varToChange.name] = proposedValue
             
         return currentState
+        
+    def step_encoded(self, currentState, variablesToChange, network, fullChange=False):
+        if fullChange:
+            for v in variablesToChange:
+                self._propose_encoded(v, currentState, network)
+        else:
+            self._propose_encoded(random.choice(variablesToChange), currentState, network)
+        return currentState
+        
+    def _propose_encoded(self, varId, state, network):
+        """
+            Helper function to propose a new value for the given variable 
+            and to accept it according to the Metropolis-Hastings rule.
+        """
+        currentValue = state[varId]
+        currentProb = network.markov_prob(varId, state)
+        state[varId] = random.randrange(int(network.symbols.cardinalities[varId]))
+        proposedProb = network.markov_prob(varId, state)
+        
+        # Accept with probability min(1, proposedProb/currentProb) without
+        # dividing, since the initial state can be impossible given the
+        # evidence, in which case any proposal is accepted
+        if random.random() * currentProb > proposedProb:
+            state[varId] = currentValue
             
\ No newline at end of file
@@ -30,7 +30,7 @@ class Orderer(object):
     """
     
     @staticmethod
-    def get_min_degree_order(bn):
+    def get_min_degree_order(bn, variables=None):
         """
             Returns the elimination order according to the min degree order algorithm
             explained in "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche
@@ -40,6 +40,10 @@ class Orderer(object):
             ---------
             bn : BayesianNetwork
                 The network for which the order is to be determined.
+            variables : [String,], optional
+                If given, only these variables are ordered based on the 
+                subgraph of the network induced by them, e.g. the requisite
+                nodes of a query (see relevance.Pruner).
                 
             Returns
             -------
@@ -50,9 +54,12 @@ class Orderer(object):
         if not isinstance(bn, BayesianNetwork):
             raise TypeError("Only Bayesian Networks are currently supported.")
         
-        interactionG = bn.graph.to_undirected()
+        if variables is None:
+            interactionG = bn.graph.to_undirected()
+        else:
+            interactionG = bn.graph.subgraph([bn.get_node(v) for v in variables]).to_undirected()
         res = []        
-        for i in range(len(bn.get_all_node_names())):
+        for i in range(len(interactionG)):
             degrees = dict(interactionG.degree())
             varToElim = sorted(degrees.items(), key=itemgetter(1))[0][0]
             res.append(varToElim.name)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of PRIMO2 -- Probabilistic Inference Modules.
+# Copyright (C) 2013-2017 Social Cognitive Systems Group,
+#                         Faculty of Technology, Bielefeld University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the Lesser GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from ..networks import BayesianNetwork
+
+class Pruner(object):
+    """
+        A "static" class that determines the part of a Bayesian network which
+        is relevant for a query, so that the exact inference algorithms only
+        need to consider this part. See "Modeling and Reasoning with Bayesian
+        Networks" - Adnan Darwiche Chapter 6.9
+    """
+
+    @staticmethod
+    def get_ancestral_nodes(bn, variables):
+        """
+            Returns the given variables together with all of their ancestors.
+            All other nodes are barren, i.e. leaves (after removing other
+            barren nodes) that are neither queried nor observed, and can be
+            removed without changing any marginal over the given variables
+            or the probability of evidence on them.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network containing the variables.
+            variables : [String,]
+                The names of the queried and observed variables.
+
+            Returns
+            -------
+                set(String,)
+                The names of the nodes in the ancestral set.
+        """
+        if not isinstance(bn, BayesianNetwork):
+            raise TypeError("Only Bayesian Networks are currently supported.")
+        res = set()
+        stack = list(variables)
+        while stack:
+            name = stack.pop()
+            if name in res:
+                continue
+            res.add(name)
+            stack.extend(getattr(bn.get_node(name), "parentOrder", []))
+        return res
+
+    @staticmethod
+    def get_requisite_nodes(bn, variables, evidence=None):
+        """
+            Returns the nodes whose cpds are required to compute the
+            posterior marginals of the given variables given the evidence.
+            Barren nodes are removed first (see get_ancestral_nodes). Edges
+            leaving nodes with hard evidence are removed afterwards, since
+            the children's cpds can be reduced to the observed value.
+            Finally, all nodes that are no longer connected to the queried
+            variables are d-separated from them by the evidence and only
+            contribute a constant factor, which is removed when the
+            marginals are normalized.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network that is supposed to be queried.
+            variables : [String,]
+                The names of the queried variables.
+            evidence : dict, optional
+                Dictionary containing the given evidence (see
+                VariableElimination.bucket_marginals). Only hard evidence on
+                variables that are not queried removes edges.
+
+            Returns
+            -------
+                set(String,)
+                The names of the requisite nodes, which always include the
+                queried variables. Observed parents of these nodes are not
+                included if their own cpds are not required.
+        """
+        if not evidence:
+            evidence = {}
+        ancestral = Pruner.get_ancestral_nodes(bn, list(variables) + list(evidence))
+        observed = set(e for e in evidence if not isinstance(evidence[e], np.ndarray)
+                        and e not in variables)
+        neighbors = {name: [] for name in ancestral}
+        for name in ancestral:
+            for parent in getattr(bn.get_node(name), "parentOrder", []):
+                if parent not in observed:
+                    neighbors[name].append(parent)
+                    neighbors[parent].append(name)
+        res = set()
+        stack = list(variables)
+        while stack:
+            name = stack.pop()
+            if name in res:
+                continue
+            res.add(name)
+            stack.extend(neighbors[name])
+        return res
+
+    @staticmethod
+    def prune_barren_nodes(bn, variables):
+        """
+            Creates a subnetwork of the given network without the nodes that
+            are barren for queries and evidence on the given variables (see
+            get_ancestral_nodes). The nodes and cpds are shared with the
+            given network.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network that is supposed to be pruned.
+            variables : [String,]
+                The names of all variables that may be queried or observed.
+
+            Returns
+            -------
+                BayesianNetwork
+                The pruned network.
+        """
+        return bn.get_subnetwork(Pruner.get_ancestral_nodes(bn, variables))
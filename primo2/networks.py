@@ -19,27 +19,171 @@
 # License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
+import os
+
 import networkx as nx
+import numpy as np
 
 from . import exceptions
 from . import nodes
 
 
+class SymbolTable(object):
+    """
+        Maps the variables of a network and their outcomes to dense integer
+        IDs. Inference algorithms can use these IDs to represent states as
+        integer arrays and to resolve names in constant time, while the
+        string based API is only used at the boundary.
+    """
+    
+    def __init__(self, randomNodes):
+        """
+            Creates the symbol table for the given nodes. The IDs correspond
+            to the order of the given nodes.
+            
+            Parameters
+            ----------
+            randomNodes : [RandomNode,]
+                The nodes whose names and values should be interned.
+        """
+        # Variable names by ID
+        self.variables = []
+        # IDs by variable name
+        self.variableIds = {}
+        # Tuple of values for each variable ID
+        self.values = []
+        # Dictionary mapping each value to its index for each variable ID
+        self.valueIds = []
+        for n in randomNodes:
+            self.variableIds[n.name] = len(self.variables)
+            self.variables.append(n.name)
+            values = tuple(getattr(n, "values", ()))
+            self.values.append(values)
+            self.valueIds.append({v: i for i, v in enumerate(values)})
+        self.cardinalities = np.array([len(v) for v in self.values], dtype=np.intp)
+        
+    def __len__(self):
+        return len(self.variables)
+        
+    def variable_id(self, variable):
+        """
+            Returns the ID of the given variable.
+            
+            Parameters
+            ----------
+            variable : String or RandomNode
+                The variable whose ID is requested.
+                
+            Returns
+            -------
+                int
+                The ID of the variable.
+        """
+        try:
+            return self.variableIds[variable]
+        except KeyError:
+            raise ValueError("There is no variable {} in the symbol " \
+                             "table.".format(variable))
+        
+    def value_id(self, variable, value):
+        """
+            Returns the index of the given value of the given variable.
+            
+            Parameters
+            ----------
+            variable : String, RandomNode or int
+                The variable (or its ID) the value belongs to.
+            value : String
+                The value whose index is requested.
+                
+            Returns
+            -------
+                int
+                The index of the value.
+        """
+        if not isinstance(variable, (int, np.integer)):
+            variable = self.variable_id(variable)
+        try:
+            return self.valueIds[variable][value]
+        except (KeyError, TypeError):
+            raise ValueError("Variable {} does not have a value {}."
+                             .format(self.variables[variable], value))
+            
+    def encode(self, state):
+        """
+            Converts a state given as dictionary into an integer array 
+            containing the value index of each variable at the position of 
+            its ID. Variables that are not contained in the state are set 
+            to -1.
+            
+            Parameters
+            ----------
+            state : dict
+                Dictionary containing variables as keys and their values as 
+                values.
+                
+            Returns
+            -------
+                np.array
+                The encoded state.
+        """
+        res = np.full(len(self.variables), -1, dtype=np.intp)
+        for variable, value in state.items():
+            varId = self.variable_id(variable)
+            res[varId] = self.value_id(varId, value)
+        return res
+        
+    def decode(self, encoded):
+        """
+            Converts an encoded state back into a dictionary containing the
+            variable names as keys and their values as values. Variables with
+            a negative index are omitted.
+            
+            Parameters
+            ----------
+            encoded : np.array
+                The encoded state as returned by encode.
+                
+            Returns
+            -------
+                dict
+                The decoded state.
+        """
+        return {self.variables[i]: self.values[i][idx] 
+                    for i, idx in enumerate(encoded) if idx >= 0}
+
+
 class BayesianNetwork(object):
 
-    def __init__(self):
+    def __init__(self, dtype=np.float64):
         self.graph = nx.DiGraph()
         self.node_lookup = {}
         self.name = ""  # Only used to be compatible with XMLBIF
         self.meta = []  # Used to be compatible with XMLBIF, stores properties 
+        self._symbols = None
+        # Cached structure fingerprint (see get_structure_fingerprint)
+        self._fingerprint = None
+        # Floating point type of all cpds (see set_dtype)
+        self.dtype = np.dtype(dtype).type
+        # Incremented whenever the cpd of any node of this network changes
+        # (see RandomNode.touch), so that inference structures caching the
+        # cpds can detect changes without checking every node
+        self.cpdVersion = 0
 
     def add_node(self, node):
         if isinstance(node, nodes.RandomNode):
             if node.name in self.node_lookup:
                 raise ValueError("The network already contains a node " \
                                  "called '{}'.".format(node.name))
+            node.set_dtype(self.dtype)
             self.node_lookup[node.name] = node
             self.graph.add_node(node)
+            node._networks.add(self)
+            self.cpdVersion += 1
+            self._symbols = None
+            self._fingerprint = None
         else:
             raise TypeError("Only subclasses of RandomNode are valid nodes.")
             
@@ -49,17 +193,22 @@ class BayesianNetwork(object):
             for child in self.graph.succ[node]:
                 child.remove_parent(self.node_lookup[node])
             self.graph.remove_node(node)
-            del self.node_lookup[node]
+            self.node_lookup.pop(node)._networks.discard(self)
+            self.cpdVersion += 1
+            self._symbols = None
+            self._fingerprint = None
     
     def remove_edge(self, from_name, to_name):
         if from_name in self.graph and to_name in self.graph:
             self.node_lookup[to_name].remove_parent(self.node_lookup[from_name])
             self.graph.remove_edge(from_name, to_name)
+            self._fingerprint = None
 
     def add_edge(self, from_name, to_name):
         if from_name in self.graph and to_name in self.graph:
             self.graph.add_edge(self.node_lookup[from_name], self.node_lookup[to_name])
             self.node_lookup[to_name].add_parent(self.node_lookup[from_name])
+            self._fingerprint = None
         else:
             raise Exception("Tried to add an Edge between two Nodes of " \
                             "which at least one was not contained in " \
@@ -89,6 +238,8 @@ class BayesianNetwork(object):
             self.node_lookup[node].set_values(new_values)
             for child in self.graph.succ[node]:
                 child._update_dimensions()
+            self._symbols = None
+            self._fingerprint = None
         else:
             raise Exception("There is no node with name {} in " \
                             "the network.".format(node))
@@ -120,6 +271,8 @@ class BayesianNetwork(object):
                 self.graph.add_edge(n, self.node_lookup[child])
             for parent in parents:
                 self.graph.add_edge(self.node_lookup[parent], n)
+            self._symbols = None
+            self._fingerprint = None
             
         else:
             raise Exception("There is no node with name {} in the " \
@@ -128,6 +281,114 @@ class BayesianNetwork(object):
     def get_all_nodes(self):
         return self.graph.nodes()
         
+    def set_dtype(self, dtype):
+        """
+            Sets the floating point type used for the cpds of all nodes in 
+            this network, including nodes that are added later. The factors
+            created from these nodes by the inference algorithms inherit this
+            type, so that e.g. np.float32 halves the memory and bandwidth
+            required during inference.
+            
+            Parameters
+            ----------
+            dtype: np.dtype
+                The floating point type, e.g. np.float32, np.float64 or
+                np.longdouble.
+        """
+        for n in self.graph.nodes():
+            n.set_dtype(dtype)
+        self.dtype = np.dtype(dtype).type
+        
+    def memmap_cpds(self, directory):
+        """
+            Moves the cpds of all nodes of this network into memory-mapped
+            .npy files within the given directory (see RandomNode.memmap_cpd).
+            Together with FactorTree.create_jointree(..., scratchDir=...) 
+            this allows exact inference in networks whose tables exceed the
+            available memory.
+            
+            Parameters
+            ----------
+            directory: String
+                Existing directory in which the files are created. Files are
+                named after the IDs of the variables in the symbol table.
+        """
+        symbols = self.get_symbol_table()
+        for n in self.graph.nodes():
+            if not isinstance(n.cpd, np.ndarray):
+                continue
+            n.memmap_cpd(os.path.join(directory, "cpd_{}.npy"
+                                      .format(symbols.variable_id(n.name))))
+        
+    def get_symbol_table(self):
+        """
+            Returns the symbol table mapping the variables of this network
+            and their values to integer IDs. The table is created lazily and
+            rebuilt after nodes have been added, removed, renamed or their 
+            values have been changed through this network.
+            
+            Returns
+            -------
+                SymbolTable
+                The symbol table of this network.
+        """
+        if self._symbols is None:
+            self._symbols = SymbolTable(self.graph.nodes())
+        return self._symbols
+        
+    def get_structure_fingerprint(self):
+        """
+            Computes a fingerprint of the structure of this network, i.e. of
+            its variables, their values and their parents (in the order of 
+            the cpd axes). Structures compiled from this network (see 
+            FactorTree.save) use it to detect that they became stale. The
+            fingerprint is cached until the structure is changed through 
+            this network.
+            
+            Returns
+            -------
+                String
+                Hexadecimal SHA-1 digest of the structure.
+        """
+        if self._fingerprint is None:
+            structure = sorted([n.name, list(getattr(n, "values", [])), 
+                                list(getattr(n, "parentOrder", []))]
+                               for n in self.graph.nodes())
+            self._fingerprint = hashlib.sha1(json.dumps(structure, default=str)
+                                             .encode("utf-8")).hexdigest()
+        return self._fingerprint
+
+    def get_subnetwork(self, node_names):
+        """
+            Creates a network consisting of the given nodes of this network.
+            The nodes and their cpds are shared and not copied, which is why
+            the given nodes need to contain the parents of all of them, e.g.
+            an ancestral set (see inference.relevance.Pruner).
+
+            Parameter
+            ---------
+            node_names: [String,]
+                The names of the nodes that are part of the subnetwork.
+
+            Returns
+            -------
+                BayesianNetwork
+                The subnetwork sharing the given nodes.
+        """
+        node_names = set(node_names)
+        res = BayesianNetwork(self.dtype)
+        res.name = self.name
+        for name in node_names:
+            node = self.get_node(name)
+            for parent in getattr(node, "parentOrder", []):
+                if parent not in node_names:
+                    raise ValueError("The parent {} of node {} is not part " \
+                                     "of the subnetwork.".format(parent, name))
+            res.node_lookup[name] = node
+            node._networks.add(res)
+        res.graph = self.graph.subgraph(res.node_lookup.values()).copy()
+        return res
+
     def get_all_node_names(self):
         return self.node_lookup.keys()
 
@@ -172,8 +433,13 @@ class BayesianNetwork(object):
     def clear(self):
         """Remove all nodes and edges from the graph.
         This also removes the name, and all graph, node and edge attributes."""
+        for node in self.node_lookup.values():
+            node._networks.discard(self)
         self.graph.clear()
         self.node_lookup.clear()
+        self.cpdVersion += 1
+        self._symbols = None
+        self._fingerprint = None
 
     def number_of_nodes(self):
         """Return the number of nodes in the graph."""
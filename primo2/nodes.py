@@ -20,6 +20,7 @@
 # <http://www.gnu.org/licenses/>.
 
 import random
+import weakref
 
 import numpy as np
 
@@ -31,14 +32,128 @@ class RandomNode(object):
         is underspecied for any inference algorithms.
     """
     
+    # Floating point type used for the cpd of this node
+    dtype = np.float64
+    
     def __init__(self, nodename):
         self.name = nodename
+        # Incremented whenever the cpd changes, so that inference structures
+        # caching it (e.g. the snapshot of a FactorTree) can detect changes
+        self.cpdVersion = 0
+        # Networks containing this node, whose cpdVersion is incremented 
+        # together with the one of this node
+        self._networks = weakref.WeakSet()
         self.cpd = 1
         self.meta = []
         
     def set_cpd(self, cpd):
         raise NotImplementedError("Called unimplemented method.")
         
+    def set_dtype(self, dtype):
+        """
+            Sets the floating point type used to store the cpd of this node
+            and converts the current cpd accordingly. Lower precision types
+            such as np.float32 halve the memory required by the cpd and all
+            factors created from it.
+            
+            Parameters
+            ----------
+            dtype: np.dtype
+                The floating point type, e.g. np.float32, np.float64 or
+                np.longdouble.
+        """
+        dtype = np.dtype(dtype)
+        if not np.issubdtype(dtype, np.floating):
+            raise TypeError("Only floating point types are supported, got {}."
+                            .format(dtype))
+        self.dtype = dtype.type
+        if isinstance(self._cpd, np.ndarray):
+            self.cpd = self._cpd.astype(self.dtype, copy=False)
+            
+    def memmap_cpd(self, filename):
+        """
+            Moves the cpd of this node into a memory-mapped .npy file, so 
+            that large cpds do not need to be kept in memory. Factors 
+            created from this node without copying (see Factor.from_node)
+            are views of the file. Setting a new cpd (e.g. with set_cpd)
+            replaces the memory-mapped cpd with a regular array again.
+            
+            Parameters
+            ----------
+            filename: String
+                Path of the .npy file, which is created or overwritten.
+        """
+        cpd = np.lib.format.open_memmap(filename, mode="w+", 
+                                        dtype=self.cpd.dtype, 
+                                        shape=self.cpd.shape)
+        cpd[...] = self.cpd
+        cpd.flush()
+        self.cpd = cpd
+        
+    @property
+    def cpd(self):
+        """
+            The conditional probability distribution of this node. It is 
+            returned as a read-only view, since inference structures cache 
+            it (e.g. the snapshot of a FactorTree) and only detect changes 
+            through cpdVersion. Replacing it or using the setters (e.g. 
+            set_probability) increments cpdVersion.
+        """
+        if isinstance(self._cpd, np.ndarray):
+            view = self._cpd.view()
+            view.setflags(write=False)
+            return view
+        return self._cpd
+        
+    @cpd.setter
+    def cpd(self, cpd):
+        self._cpd = cpd
+        self.touch()
+        
+    def touch(self):
+        """
+            Marks the cpd of this node as changed by incrementing the 
+            cpdVersion of this node and of all networks containing it. This
+            is done automatically by all methods changing the cpd, but needs
+            to be called after modifying the cpd by other means, e.g. by
+            writing to the file of a memory-mapped cpd (see memmap_cpd).
+        """
+        self.cpdVersion += 1
+        for bn in self._networks:
+            bn.cpdVersion += 1
+        
+    @property
+    def values(self):
+        """
+            The list of outcomes of this node.
+        """
+        return self._values
+        
+    @values.setter
+    def values(self, values):
+        self._values = list(values)
+        # Lookup table for the position of each outcome
+        self._valueIndex = {v: i for i, v in enumerate(self._values)}
+        
+    def value_index(self, value):
+        """
+            Returns the position of the given outcome within the values of 
+            this node in constant time.
+            
+            Parameters
+            ----------
+            value: String
+                The outcome whose index is requested.
+                
+            Returns
+            -------
+                int
+                The index of the given outcome.
+        """
+        try:
+            return self._valueIndex[value]
+        except (KeyError, TypeError):
+            raise ValueError("{} is not in list".format(value))
         
     def __eq__(self, other):
         """
@@ -135,7 +250,7 @@ class DiscreteNode(RandomNode):
         dimensions = [len(self.values)] if self.values else []
         for parentName in self.parentOrder:
             dimensions.append(len(self.parents[parentName].values))
-        self.cpd = np.zeros(dimensions)
+        self.cpd = np.zeros(dimensions, dtype=self.dtype)
         self.valid = False
         
     def remove_parent(self, parentNode):
@@ -166,11 +281,12 @@ class DiscreteNode(RandomNode):
             cpd : np.array
                 Table containing the conditional probabilities. Each variable 
                 is represented by a dimension in the size of the number of its
-                outcomes.
+                outcomes. The table is copied and converted to the dtype of
+                this node (see set_dtype).
         """
         if np.shape(self.cpd) != np.shape(cpd):
             raise ValueError("The dimensions of the given cpd do not match the dependency structure of the node.")
-        self.cpd = np.copy(cpd)
+        self.cpd = np.array(cpd, dtype=self.dtype)
         self.valid = True
         
     def set_probability(self, valueName, prob, parentValues=None):
@@ -199,7 +315,7 @@ class DiscreteNode(RandomNode):
                 Parent names that do not belong to this node will be ignored.
         """
         try:
-            index = [self.values.index(valueName)] if self.values else []
+            index = [self.value_index(valueName)] if self.values else []
         except ValueError:
             raise ValueError("This node as no value {}.".format(valueName))
         
@@ -209,13 +325,14 @@ class DiscreteNode(RandomNode):
         for parentName in self.parentOrder:
             if parentName in parentValues:
                 try:
-                    index.append(self.parents[parentName].values.index(parentValues[parentName]))
+                    index.append(self.parents[parentName].value_index(parentValues[parentName]))
                 except ValueError:
                     raise ValueError("Parent {} does not have values {}.".format(parentName, parentValues[parentName]))
             else:
                 index.append(slice(len(self.parents[parentName].values)))
                 
-        self.cpd[tuple(index)] = prob
+        self._cpd[tuple(index)] = prob
+        self.touch()
         
     def get_probability(self, value, parentValues=None):
         """
@@ -245,7 +362,7 @@ class DiscreteNode(RandomNode):
                 A copy of the specified portion of the cpt (might be only one value).
         """
         try:
-            index = [[self.values.index(value)]] if self.values else []
+            index = [[self.value_index(value)]] if self.values else []
         except ValueError:
             raise ValueError("This node as no value {}.".format(value))
         
@@ -256,12 +373,12 @@ class DiscreteNode(RandomNode):
             if parentName in parentValues:
                 if isinstance(parentValues[parentName], list):
                     try:
-                        index.append([self.parents[parentName].values.index(v) for v in parentValues[parentName]])
+                        index.append([self.parents[parentName].value_index(v) for v in parentValues[parentName]])
                     except ValueError:
                         raise ValueError("There is no conditional probability for parent {}, values {} in node {}.".format(parentName, parentValues[parentName], self.name))
                 else:
                     try:
-                        index.append([self.parents[parentName].values.index(parentValues[parentName])])
+                        index.append([self.parents[parentName].value_index(parentValues[parentName])])
                     except ValueError:
                         raise ValueError("There is no conditional probability for parent {}, value {} in node {}.".format(parentName, parentValues[parentName], self.name))
             else:
@@ -298,7 +415,7 @@ class DiscreteNode(RandomNode):
                 The probability of this value given the parent values.
         """
         try:
-            index = [self.values.index(value)] if self.values else []
+            index = [self.value_index(value)] if self.values else []
         except ValueError:
             raise ValueError("This node as no value {}.".format(value))
             
@@ -307,7 +424,7 @@ class DiscreteNode(RandomNode):
             
         for parentName in self.parentOrder:
             try:
-                index.append(self.parents[parentName].values.index(parentValues[parentName]))
+                index.append(self.parents[parentName].value_index(parentValues[parentName]))
             except KeyError:
                 raise KeyError("parentValues need to specify a value for parent {} of node: {}.".format(parentName, self.name))
             except ValueError:
@@ -448,7 +565,7 @@ class UtilityNode(RandomNode):
         dimensions = []
         for parentName in self.parentOrder:
             dimensions.append(len(self.parents[parentName].values))
-        self.cpd = np.zeros(dimensions)
+        self.cpd = np.zeros(dimensions, dtype=self.dtype)
         self.valid = False
         
     def get_utility(self, parentValues):
@@ -468,7 +585,7 @@ class UtilityNode(RandomNode):
         index = []
         for parentName in self.parentOrder:
             try:
-                index.append(self.parents[parentName].values.index(parentValues[parentName]))
+                index.append(self.parents[parentName].value_index(parentValues[parentName]))
             except KeyError:
                 raise KeyError("parentValues need to specify a value for parent {} of node: {}.".format(parentName, self.name))
             except ValueError:
@@ -492,7 +609,7 @@ class UtilityNode(RandomNode):
         if np.shape(self.cpd) != np.shape(utilities):
             raise ValueError("The dimensions of the given utility table do not " \
                              "match the dependency structure of the node.")
-        self.cpd = np.copy(utilities)
+        self.cpd = np.array(utilities, dtype=self.dtype)
         self.valid = True
         
     def set_utility(self, utility, parentValues):
@@ -513,13 +630,14 @@ class UtilityNode(RandomNode):
         for parentName in self.parentOrder:
             if parentName in parentValues:
                 try:
-                    index.append(self.parents[parentName].values.index(parentValues[parentName]))
+                    index.append(self.parents[parentName].value_index(parentValues[parentName]))
                 except ValueError:
                     raise ValueError("Parent {} does not have values {}.".format(parentName, parentValues[parentName]))
             else:
                 index.append(slice(len(self.parents[parentName].values)))
                 
-        self.cpd[tuple(index)] = utility
+        self._cpd[tuple(index)] = utility
+        self.touch()
 
 class DecisionNode(RandomNode):
     """
@@ -567,7 +685,7 @@ class DecisionNode(RandomNode):
         dimensions = [len(self.values)] if self.values else []
         for parentName in self.parentOrder:
             dimensions.append(len(self.parents[parentName].values))
-        self.cpd = np.zeros(dimensions)
+        self.cpd = np.zeros(dimensions, dtype=self.dtype)
         self.valid = False
         
     def set_decision(self, decision):
@@ -583,17 +701,18 @@ class DecisionNode(RandomNode):
             decision: string
                 The name of the decision this decisionNode should take.
         """
-        self.cpd *= 0
         try:
-            index = [self.values.index(decision)] if self.values else []
+            index = [self.value_index(decision)] if self.values else []
         except ValueError:
             raise ValueError("This node as no value {}.".format(decision))
                 
-        self.cpd[tuple(index)] = 1
+        self._cpd *= 0
+        self._cpd[tuple(index)] = 1
+        self.touch()
         
     def fully_mixed(self):
-        self.cpd = np.ones(self.cpd.shape)
-        self.cpd /= len(self.values)
+        self.cpd = np.full(self._cpd.shape, 1.0 / len(self.values), 
+                           dtype=self.dtype)
         
 
 if __name__ == "__main__":
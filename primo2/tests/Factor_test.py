@@ -22,7 +22,8 @@
 from __future__ import division 
 import unittest
 import numpy as np
-from primo2.inference.factor import Factor
+from primo2.inference import factor
+from primo2.inference.factor import Factor, ProductPlan, ScratchSpace, SparseFactor
 from primo2.nodes import DiscreteNode, DecisionNode, UtilityNode
 
 class FactorTest(unittest.TestCase):
@@ -47,6 +48,19 @@ class FactorTest(unittest.TestCase):
         
         self.un.set_utilities(np.array([100,10]))
         
+    def test_value_indices_bounded(self):
+        size = factor._valueIndicesSize
+        factor._valueIndicesSize = 4
+        try:
+            for i in range(10):
+                values = ("a{}".format(i), "b{}".format(i))
+                self.assertEqual(factor._value_indices(values)[values[1]], 1)
+            self.assertEqual(len(factor._valueIndices), 4)
+            self.assertIn(("a9", "b9"), factor._valueIndices)
+            self.assertNotIn(("a0", "b0"), factor._valueIndices)
+        finally:
+            factor._valueIndicesSize = size
+        
     def test_create_from_discrete_node_error(self):
         with self.assertRaises(TypeError) as cm:
             f = Factor.from_node("Node1")
@@ -254,6 +268,287 @@ class FactorTest(unittest.TestCase):
 #        fRes2 = f3 * f2 
 #        np.testing.assert_array_equal(fRes2.potentials, res)
         
+    def test_multiplication_plan_cached(self):
+        f2 = Factor.from_node(self.n2)
+        f3 = Factor.from_node(self.n3)
+        res1 = f2 * f3
+        plan = ProductPlan.get(f2.variableOrder, f3.variableOrder)
+        self.assertIs(plan, ProductPlan.get(f2.variableOrder, f3.variableOrder))
+        self.assertEqual(list(plan.resOrder), res1.variableOrder)
+        res2 = f2 * f3
+        np.testing.assert_array_almost_equal(res1.potentials, res2.potentials)
+        
+    def test_multiplication_transposed_order(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        fRes = f1 * f2
+        self.assertEqual(fRes.variableOrder, ["Node1", "Node2"])
+        np.testing.assert_array_almost_equal(fRes.potentials, self.n2.cpd.T * self.n1.cpd[:,np.newaxis])
+        
+    def test_multiply_marginalize(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        fRes = f1.multiply_marginalize(f2, "Node1")
+        fExp = (f1 * f2).marginalize("Node1")
+        self.assertEqual(fRes.variableOrder, fExp.variableOrder)
+        np.testing.assert_array_almost_equal(fRes.potentials, fExp.potentials)
+        fRes = f2.multiply_marginalize(f1, ["Node1", "Node2"])
+        self.assertEqual(fRes.variableOrder, [])
+        np.testing.assert_array_almost_equal(fRes.potentials, 1.0)
+        
+    def test_imul(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        potentials = f2.potentials
+        res = f2.imul(f1)
+        self.assertIs(res, f2)
+        self.assertIs(f2.potentials, potentials)
+        np.testing.assert_array_almost_equal(f2.potentials, np.array([[0.06, 0.28], [0.12, 0.07], [0.12, 0.35]]))
+        with self.assertRaises(ValueError):
+            f1.imul(Factor.from_node(self.n3))
+            
+    def test_idiv_with_zeros(self):
+        f1 = Factor()
+        f1.variableOrder = ["a","b"]
+        f1.values = {"a":["a1","a2","a3"], "b":["b1","b2"]}
+        f1.potentials = np.array([[0.5,0.2],[0.1,0.3],[0.3,0.45]])
+        f2 = Factor()
+        f2.variableOrder = ["a"]
+        f2.values = {"a":["a1","a2","a3"]}
+        f2.potentials = np.array([0.8,0,0.6])
+        f1.idiv(f2)
+        np.testing.assert_array_almost_equal(f1.potentials, np.array([[0.625, 0.25],[0,0],[0.5,0.75]]))
+        
+    def test_iinvert(self):
+        f1 = Factor.from_node(self.n1)
+        f1.potentials[0] = 0
+        self.assertIs(f1.iinvert(), f1)
+        np.testing.assert_array_almost_equal(f1.potentials, np.array([0, 10.0/7]))
+        
+    def test_marginalize_into(self):
+        f = Factor.from_node(self.n1) * Factor.from_node(self.n2)
+        out = Factor.zero_factor(["Node2"], {"Node2": self.n2.values})
+        potentials = out.potentials
+        res = f.marginalize_into("Node1", out=out)
+        self.assertIs(res, out)
+        self.assertIs(out.potentials, potentials)
+        np.testing.assert_array_almost_equal(out.potentials, np.array([0.34, 0.19, 0.47]))
+        with self.assertRaises(ValueError):
+            f.marginalize_into("Node2", out=out)
+            
+    def test_marginalize_into_transposed(self):
+        f = Factor.from_node(self.n2) * Factor.from_node(self.n3)
+        out = Factor.zero_factor(["Node3", "Node2"], {"Node2": self.n2.values, "Node3": self.n3.values})
+        f.marginalize_into("Node1", out=out)
+        np.testing.assert_array_almost_equal(out.potentials, np.transpose(f.potentials, (2,0,1)).sum(axis=2))
+        
+    def test_logspace_multiplication(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        fLog = f1.to_log() * Factor.from_node(self.n2, logspace=True)
+        self.assertTrue(fLog.logspace)
+        np.testing.assert_array_almost_equal(fLog.to_linear().potentials, (f1 * f2).potentials)
+        with self.assertRaises(ValueError):
+            f1 * fLog
+            
+    def test_logspace_marginalisation(self):
+        f = Factor.from_node(self.n1) * Factor.from_node(self.n2)
+        fRes = f.to_log().marginalize(self.n1.name)
+        self.assertTrue(fRes.logspace)
+        np.testing.assert_array_almost_equal(np.exp(fRes.potentials), np.array([0.34, 0.19, 0.47]))
+        
+    def test_logspace_division_with_zeros(self):
+        f1 = Factor()
+        f1.variableOrder = ["a","b"]
+        f1.values = {"a":["a1","a2","a3"], "b":["b1","b2"]}
+        f1.potentials = np.array([[0.5,0.2],[0.1,0.3],[0.3,0.45]])
+        f2 = Factor()
+        f2.variableOrder = ["a"]
+        f2.values = {"a":["a1","a2","a3"]}
+        f2.potentials = np.array([0.8,0,0.6])
+        f3 = f1.to_log() / f2.to_log()
+        np.testing.assert_array_almost_equal(f3.to_linear().potentials, np.array([[0.625, 0.25],[0,0],[0.5,0.75]]))
+        f4 = f1.to_log().idiv(f2.to_log())
+        np.testing.assert_array_almost_equal(f4.to_linear().potentials, f3.to_linear().potentials)
+        
+    def test_logspace_normalize(self):
+        f = Factor.from_node(self.n1).to_log()
+        f.potentials -= 1000
+        f.normalize()
+        np.testing.assert_array_almost_equal(f.to_linear().potentials, np.array([0.3, 0.7]))
+        
+    def test_log_normalizer(self):
+        f = Factor.from_node(self.n1)
+        f.potentials *= 4
+        self.assertAlmostEqual(f.log_normalizer(), np.log(4))
+        fLog = f.to_log()
+        fLog.potentials -= 1000
+        self.assertAlmostEqual(fLog.log_normalizer(), np.log(4) - 1000)
+        self.assertAlmostEqual(f.sparsify().log_normalizer(), np.log(4))
+        batched = Factor.stack([f, f.copy().normalize()])
+        np.testing.assert_array_almost_equal(batched.log_normalizer(), np.array([np.log(4), 0]))
+        
+    def test_logspace_as_evidence(self):
+        f = Factor.as_evidence("E", ["True","False"], "True", logspace=True)
+        self.assertTrue(f.logspace)
+        np.testing.assert_array_equal(f.potentials, np.array([0.0, -np.inf]))
+        
+    def test_sparsify(self):
+        f = Factor.as_evidence("E", ["a","b","c","d","e","f"], "b")
+        fSparse = f.sparsify()
+        self.assertTrue(fSparse.sparse)
+        self.assertEqual(len(fSparse.data), 1)
+        np.testing.assert_array_equal(fSparse.potentials, f.potentials)
+        self.assertIs(fSparse.sparsify(), fSparse)
+        self.assertFalse(Factor.from_node(self.n2).sparsify().sparse)
+        
+    def test_sparse_multiplication(self):
+        f2 = Factor.from_node(self.n2)
+        f3 = Factor.from_node(self.n3)
+        fEv = Factor.as_evidence("Node2", self.n2.values, "ValueB")
+        fSparse = SparseFactor.from_dense(fEv)
+        for left, right in [(fSparse, f2), (f2, fSparse), (fSparse, f3), (f3, fSparse)]:
+            fRes = left * right
+            fExp = left.to_dense() * right if left.sparse else left * right.to_dense()
+            self.assertEqual(fRes.variableOrder, fExp.variableOrder)
+            np.testing.assert_array_almost_equal(fRes.potentials, fExp.potentials)
+        fSparse = Factor.as_evidence("E", ["a","b","c","d","e","f"], "b").sparsify()
+        self.assertTrue((fSparse * f3).sparse)
+        
+    def test_sparse_marginalisation(self):
+        f = SparseFactor.from_dense(Factor.from_node(self.n2) * Factor.from_node(self.n1))
+        fExp = Factor.from_node(self.n2) * Factor.from_node(self.n1)
+        np.testing.assert_array_almost_equal(f.marginalize("Node1").potentials, fExp.marginalize("Node1").potentials)
+        np.testing.assert_array_almost_equal(f.marginalize(["Node1", "Node2"]).potentials, 1.0)
+        out = Factor.zero_factor(["Node1"], {"Node1": self.n1.values})
+        f.marginalize_into("Node2", out=out)
+        np.testing.assert_array_almost_equal(out.potentials, np.array([0.3, 0.7]))
+        
+    def test_sparse_inplace_operations(self):
+        f = SparseFactor.from_dense(Factor.as_evidence("Node2", self.n2.values, "ValueC") * Factor.from_node(self.n1))
+        data = f.data
+        f.imul(Factor.from_node(self.n2))
+        self.assertIs(f.data, data)
+        np.testing.assert_array_almost_equal(f.potentials, [[0, 0], [0, 0], [0.12, 0.35]])
+        f.idiv(Factor.from_node(self.n1))
+        np.testing.assert_array_almost_equal(f.potentials, [[0, 0], [0, 0], [0.4, 0.5]])
+        f.normalize()
+        self.assertAlmostEqual(np.sum(f.potentials), 1.0)
+
+    def test_batch_stack(self):
+        e1 = Factor.as_evidence("Node2", self.n2.values, "ValueA")
+        e2 = Factor.as_evidence("Node2", self.n2.values, np.array([0.5, 0.2, 0.3]))
+        batch = Factor.stack([e1, e2])
+        self.assertEqual(batch.batchSize, 2)
+        self.assertEqual(batch.potentials.shape, (2, 3))
+        np.testing.assert_array_almost_equal(batch.get_case(1).potentials, [0.5, 0.2, 0.3])
+
+    def test_batch_multiplication(self):
+        f2 = Factor.from_node(self.n2)
+        cases = [Factor.as_evidence("Node2", self.n2.values, v) for v in self.n2.values]
+        batch = Factor.stack(cases)
+        res = f2 * batch
+        self.assertEqual(res.batchSize, 3)
+        self.assertEqual(res.potentials.shape, (3, 3, 2))
+        for i, c in enumerate(cases):
+            np.testing.assert_array_almost_equal(res.potentials[i], (f2*c).potentials)
+        res = batch * Factor.from_node(self.n1)
+        self.assertEqual(res.variableOrder, ["Node2", "Node1"])
+        np.testing.assert_array_almost_equal(res.potentials[2],
+                                        (cases[2]*Factor.from_node(self.n1)).potentials)
+
+    def test_batch_inplace_operations(self):
+        f2 = Factor.from_node(self.n2)
+        batch = f2.expand_batch(2)
+        batch.imul(Factor.stack([Factor.from_node(self.n1), Factor.get_trivial(0.5) * Factor.from_node(self.n1)]))
+        np.testing.assert_array_almost_equal(batch.potentials[1], 0.5*(f2*Factor.from_node(self.n1)).potentials)
+        batch.idiv(Factor.from_node(self.n1))
+        np.testing.assert_array_almost_equal(batch.potentials[0], f2.potentials)
+        with self.assertRaises(ValueError):
+            f2.imul(batch)
+        with self.assertRaises(ValueError):
+            batch * Factor.from_node(self.n1).expand_batch(3)
+
+    def test_batch_marginalisation(self):
+        f = (Factor.from_node(self.n2) * Factor.from_node(self.n1)).expand_batch(2)
+        f.potentials[1] *= 2
+        res = f.marginalize("Node1")
+        self.assertEqual(res.potentials.shape, (2, 3))
+        np.testing.assert_array_almost_equal(res.potentials[1], [0.68, 0.38, 0.94])
+        f.normalize()
+        np.testing.assert_array_almost_equal(np.sum(f.potentials, axis=(1,2)), [1.0, 1.0])
+        fused = f.multiply_marginalize(Factor.from_node(self.n1), ["Node2"])
+        np.testing.assert_array_almost_equal(fused.potentials[0],
+                                            (f.get_case(0)*Factor.from_node(self.n1)).marginalize("Node2").potentials)
+
+    def test_dtype(self):
+        self.n2.set_dtype(np.float32)
+        f = Factor.from_node(self.n2)
+        self.assertEqual(f.dtype, np.float32)
+        self.assertEqual(f.marginalize("Node2").potentials.dtype, np.float32)
+        self.assertEqual(f.to_log().potentials.dtype, np.float32)
+        self.assertEqual(f.sparsify(0.9).dtype, np.float32)
+        unit = Factor.unit_factor(["Node1"], {"Node1": ["True", "False"]}, dtype=np.float32)
+        self.assertEqual(unit.imul(Factor.from_node(self.n1)).potentials.dtype, np.float32)
+        self.assertEqual(f.astype(np.float64).potentials.dtype, np.float64)
+
+    def test_chunked_operations(self):
+        f = Factor.from_node(self.n2) * Factor.from_node(self.n1)
+        chunkBytes = Factor.chunkBytes
+        Factor.chunkBytes = 8
+        try:
+            for logspace in [False, True]:
+                g = f.to_log() if logspace else f
+                chunked = g.copy().imul(g.marginalize("Node2")).idiv(g.marginalize("Node1"))
+                Factor.chunkBytes = chunkBytes
+                ref = g.copy().imul(g.marginalize("Node2")).idiv(g.marginalize("Node1"))
+                Factor.chunkBytes = 8
+                np.testing.assert_array_almost_equal(chunked.potentials, ref.potentials)
+                for variables in [[g.variableOrder[0]], [g.variableOrder[1]], g.variableOrder]:
+                    res = chunked.marginalize(variables)
+                    Factor.chunkBytes = chunkBytes
+                    np.testing.assert_array_almost_equal(res.potentials, 
+                                                         ref.marginalize(variables).potentials)
+                    Factor.chunkBytes = 8
+        finally:
+            Factor.chunkBytes = chunkBytes
+            
+    def test_scratch_space(self):
+        storage = ScratchSpace(minBytes=0)
+        try:
+            unit = Factor.unit_factor(["Node1", "Node2"], 
+                                      {"Node1": self.n1.values, "Node2": self.n2.values},
+                                      storage=storage)
+            self.assertIsInstance(unit.potentials, np.memmap)
+            self.assertEqual(len(storage.files), 1)
+            unit.imul(Factor.from_node(self.n2))
+            np.testing.assert_array_almost_equal(unit.marginalize("Node1").potentials,
+                                                 Factor.from_node(self.n2).marginalize("Node1").potentials)
+        finally:
+            storage.close()
+        self.assertEqual(storage.files, [])
+        self.assertIsInstance(ScratchSpace().allocate((2, 3)), np.ndarray)
+
+    def test_reduce(self):
+        f = Factor.from_node(self.n2)
+        res = f.reduce({"Node1": "False", "Node3": "High"})
+        self.assertEqual(res.variableOrder, ["Node2"])
+        np.testing.assert_array_almost_equal(res.potentials, [0.4, 0.1, 0.5])
+        self.assertTrue(np.shares_memory(res.potentials, f.potentials))
+        res = f.reduce({"Node1": "True", "Node2": "ValueB"})
+        self.assertEqual(res.variableOrder, [])
+        self.assertAlmostEqual(res.potentials, 0.4)
+        self.assertIs(f.reduce({"Node3": "High"}), f)
+        with self.assertRaises(ValueError) as cm:
+            f.reduce({"Node1": "Maybe"})
+        self.assertEqual(str(cm.exception), "Evidence Maybe is not one of the possible values (['True', 'False']) for this variable.")
+
+    def test_reduce_sparse(self):
+        f = Factor.as_evidence("Node2", self.n2.values, "ValueC") * Factor.from_node(self.n2)
+        sparse = SparseFactor.from_dense(f)
+        for assignment in [{"Node1": "False"}, {"Node2": "ValueA"}, {"Node1": "True", "Node2": "ValueC"}]:
+            np.testing.assert_array_almost_equal(sparse.reduce(assignment).potentials, f.reduce(assignment).potentials)
+
     def test_marginalisation(self):
         f1 = Factor.from_node(self.n1)
         f2 = Factor.from_node(self.n2)
@@ -273,6 +568,35 @@ class FactorTest(unittest.TestCase):
         res = np.array([1.0])
         np.testing.assert_array_almost_equal(fRes.potentials, res)
 
+    def test_max_marginalisation(self):
+        f = Factor.from_node(self.n1) * Factor.from_node(self.n2)
+        np.testing.assert_array_almost_equal(f.max_marginalize("Node1").get_potential(), 
+                                             [0.28, 0.12, 0.35])
+        np.testing.assert_array_almost_equal(f.min_marginalize("Node1").get_potential(), 
+                                             [0.06, 0.07, 0.12])
+        self.assertAlmostEqual(f.max_marginalize(["Node1", "Node2"]).potentials, 0.35)
+        out = Factor.unit_factor(["Node2"], {"Node2": self.n2.values})
+        res = f.max_marginalize("Node1", out=out)
+        self.assertIs(res, out)
+        np.testing.assert_array_almost_equal(out.potentials, [0.28, 0.12, 0.35])
+        logRes = f.to_log().max_marginalize("Node1").to_linear()
+        np.testing.assert_array_almost_equal(logRes.get_potential(), [0.28, 0.12, 0.35])
+        
+    def test_argmax_marginalisation(self):
+        f = Factor.from_node(self.n1) * Factor.from_node(self.n2)
+        res, pointers = f.argmax_marginalize("Node1")
+        np.testing.assert_array_almost_equal(res.get_potential(), [0.28, 0.12, 0.35])
+        np.testing.assert_array_equal(pointers["Node1"], [1, 0, 1])
+        res, pointers = f.argmax_marginalize(["Node2", "Node1"])
+        self.assertAlmostEqual(res.potentials, 0.35)
+        self.assertEqual(self.n1.values[pointers["Node1"]], "False")
+        self.assertEqual(self.n2.values[pointers["Node2"]], "ValueC")
+        batch = f.expand_batch(2)
+        batch.potentials[1] = f.potentials[::-1]
+        res, pointers = batch.argmax_marginalize(["Node2"])
+        self.assertEqual(res.potentials.shape, (2, 2))
+        np.testing.assert_array_almost_equal(res.potentials[0], f.max_marginalize("Node2").potentials)
+        np.testing.assert_array_equal(pointers["Node2"][0], np.argmax(f.potentials, axis=f.variableOrder.index("Node2")))
             
     def test_marginalisation_with_node(self):
         """
@@ -323,7 +647,7 @@ class FactorTest(unittest.TestCase):
         # Disturb the potentials
         f1.potentials *= 2
         self.assertNotEqual(np.sum(f1.potentials), 1.0)
-        f1.normalize()
+        self.assertIs(f1.normalize(), f1)
         self.assertEqual(np.sum(f1.potentials), 1.0)
     
     
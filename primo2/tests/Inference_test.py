@@ -19,14 +19,133 @@
 # License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 import numpy as np
+from primo2.exceptions import StructureError, MemoryBudgetError
 from primo2.networks import BayesianNetwork
 from primo2.nodes import DiscreteNode
 from primo2.io import XMLBIFParser
 from primo2.inference.order import Orderer
 from primo2.inference.exact import VariableElimination
 from primo2.inference.exact import FactorTree
+from primo2.inference.factor import Factor, ScratchSpace
+from primo2.inference.relevance import Pruner
+from primo2.inference.conditioning import RecursiveConditioning
+
+def _underflow_network(numChildren=200):
+    """
+        Creates a network whose joint probability of the evidence underflows
+        in linear space.
+    """
+    bn = BayesianNetwork()
+    a = DiscreteNode("A")
+    bn.add_node(a)
+    a.set_cpd(np.array([0.5, 0.5]))
+    for i in range(numChildren):
+        c = DiscreteNode("C{}".format(i))
+        bn.add_node(c)
+        bn.add_edge("A", c.name)
+        c.set_cpd(np.array([[0.01, 0.0101], [0.99, 0.9899]]))
+    return bn
+
+def _deterministic_network():
+    """
+        Creates a network containing a deterministic parity node over three
+        noisy inputs, whose CPT is stored sparsely.
+    """
+    bn = BayesianNetwork()
+    inputs = []
+    for i, p in enumerate([0.2, 0.6, 0.7]):
+        n = DiscreteNode("I{}".format(i))
+        bn.add_node(n)
+        n.set_cpd(np.array([p, 1-p]))
+        inputs.append(n)
+    parity = DiscreteNode("parity", ["even", "odd"])
+    bn.add_node(parity)
+    for n in inputs:
+        bn.add_edge(n.name, "parity")
+    cpd = np.zeros((2,2,2,2))
+    for idx in np.ndindex(2,2,2):
+        cpd[(sum(idx) % 2,) + idx] = 1
+    parity.set_cpd(cpd)
+    sensor = DiscreteNode("sensor")
+    bn.add_node(sensor)
+    bn.add_edge("parity", "sensor")
+    sensor.set_cpd(np.array([[0.9, 0.2], [0.1, 0.8]]))
+    return bn
+
+def _aligned(factor, reference):
+    """
+        Returns the potentials of the factor with the axes ordered like the
+        ones of the reference factor.
+    """
+    return np.transpose(factor.potentials, 
+                        [factor.variableOrder.index(v) for v in reference.variableOrder])
+
+def _ranked_assignments(bn, evidence, variables=None):
+    """
+        Enumerates the assignments of the given variables (all variables 
+        without hard evidence if None) together with their joint probability
+        with the evidence by brute force, sorted by decreasing probability.
+    """
+    names = sorted(bn.get_all_node_names())
+    if variables is None:
+        variables = [n for n in names if not isinstance(evidence.get(n, np.ones(1)), str)]
+    joint = VariableElimination.naive_marginals(bn, names)
+    potentials = np.copy(joint.potentials)
+    for e, value in evidence.items():
+        likelihood = Factor.as_evidence(e, bn.get_node(e).values, value)
+        shape = [1] * potentials.ndim
+        shape[joint.variableOrder.index(e)] = -1
+        potentials = potentials * likelihood.potentials.reshape(shape)
+    summed = tuple(i for i, v in enumerate(joint.variableOrder) if v not in variables)
+    potentials = np.sum(potentials, axis=summed)
+    kept = [v for v in joint.variableOrder if v in variables]
+    res = []
+    for index in np.ndindex(*potentials.shape):
+        if potentials[index] > 0:
+            res.append(({v: joint.values[v][i] for v, i in zip(kept, index)}, 
+                        potentials[index]))
+    return sorted(res, key=lambda r: -r[1])
+
+def _chain_network(length):
+    """
+        Creates a chain of binary nodes X0 -> X1 -> ... whose jointree is a
+        path of length-1 cliques.
+    """
+    bn = BayesianNetwork()
+    for i in range(length):
+        n = DiscreteNode("X{}".format(i))
+        bn.add_node(n)
+        if i == 0:
+            n.set_cpd(np.array([0.5, 0.5]))
+        else:
+            bn.add_edge("X{}".format(i-1), n.name)
+            n.set_cpd(np.array([[0.9, 0.2], [0.1, 0.8]]))
+    return bn
+
+def _grid_network(width, height, seed=0):
+    """
+        Creates a grid of binary nodes, each having its upper and left 
+        neighbours as parents, with random cpds.
+    """
+    rng = np.random.RandomState(seed)
+    bn = BayesianNetwork()
+    for i in range(height):
+        for j in range(width):
+            n = DiscreteNode("X{}_{}".format(i, j))
+            bn.add_node(n)
+            if i > 0:
+                bn.add_edge("X{}_{}".format(i-1, j), n.name)
+            if j > 0:
+                bn.add_edge("X{}_{}".format(i, j-1), n.name)
+            cpd = rng.rand(*[2] * (len(n.parentOrder)+1))
+            n.set_cpd(cpd / np.sum(cpd, axis=0))
+    return bn
 
 class EliminationOderTest(unittest.TestCase):
     
@@ -141,11 +260,219 @@ class VariableEliminationTest(unittest.TestCase):
         resFactor = VariableElimination.bucket_marginals(self.bn, ["wet_grass"], {"winter": "true", "rain": "false"})
         np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
         
+    def test_bucket_marginal_evidence_logspace(self):
+        resFactor = VariableElimination.bucket_marginals(self.bn, ["wet_grass"], {"winter": "true"}, logspace=True)
+        self.assertFalse(resFactor.logspace)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.668, 0.332]))
+        resFactor = VariableElimination.naive_marginals(self.bn, ["wet_grass"], {"winter": "true", "rain": "false"}, logspace=True)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
+        
+    def test_bucket_marginals_logspace_underflow(self):
+        bn = _underflow_network()
+        evidence = {"C{}".format(i): "True" for i in range(200)}
+        resFactor = VariableElimination.bucket_marginals(bn, ["A"], evidence, logspace=True)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.12025, 0.87975]))
+        
+    def test_bucket_marginals_sparse_cpt(self):
+        bn = _deterministic_network()
+        evidence = {"sensor": "True"}
+        resSparse = VariableElimination.bucket_marginals(bn, ["I1"], evidence)
+        resNaive = VariableElimination.naive_marginals(bn, ["I1"], evidence)
+        resLog = VariableElimination.bucket_marginals(bn, ["I1"], evidence, logspace=True)
+        np.testing.assert_array_almost_equal(resSparse.get_potential(), resNaive.get_potential())
+        np.testing.assert_array_almost_equal(resSparse.get_potential(), resLog.get_potential())
+        
+    def test_bucket_marginals_hard_evidence(self):
+        evidence = {"winter": "true", "sprinkler": "false", "wet_grass": np.array([0.2, 0.8])}
+        order = ["slippery_road", "wet_grass", "sprinkler", "winter", "rain"]
+        resFactor = VariableElimination.bucket_marginals(self.bn, ["rain"], evidence, order=order)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), 
+                    VariableElimination.naive_marginals(self.bn, ["rain"], evidence).get_potential())
+        self.assertEqual(order, ["slippery_road", "wet_grass", "sprinkler", "winter", "rain"])
+        resFactor = VariableElimination.bucket_marginals(self.bn, ["winter"], {"winter": "false"})
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.0, 1.0]))
+        
+    def test_bucket_mpe(self):
+        evidence = {"wet_grass": "true", "rain": np.array([0.2, 0.9])}
+        ref = _ranked_assignments(self.bn, evidence)
+        res = VariableElimination.bucket_mpe(self.bn, evidence, k=4)
+        self.assertEqual([r[0] for r in res], [r[0] for r in ref[:4]])
+        np.testing.assert_array_almost_equal([r[1] for r in res], [r[1] for r in ref[:4]])
+        res = VariableElimination.bucket_mpe(self.bn, evidence, k=100, logspace=True, log=True)
+        self.assertEqual(len(res), len(ref))
+        np.testing.assert_array_almost_equal([r[1] for r in res], np.log([r[1] for r in ref]))
+        self.assertEqual(VariableElimination.bucket_mpe(self.bn, {"winter": "true", "rain": np.array([0.0, 0.0])}), [])
+        
+    def test_bucket_marginal_map(self):
+        evidence = {"slippery_road": "false"}
+        ref = _ranked_assignments(self.bn, evidence, ["winter", "rain"])
+        res = VariableElimination.bucket_mpe(self.bn, evidence, ["winter", "rain", "slippery_road"], k=2)
+        self.assertEqual([r[0] for r in res], [r[0] for r in ref[:2]])
+        np.testing.assert_array_almost_equal([r[1] for r in res], [r[1] for r in ref[:2]])
+        
+    def test_bucket_elimination_plan(self):
+        VariableElimination.clear_plans()
+        evidence = {"winter": "true", "wet_grass": np.array([0.2, 0.8])}
+        plan = VariableElimination.get_plan(self.bn, ["rain"], evidence)
+        self.assertIs(VariableElimination.get_plan(self.bn, ["rain"], 
+                        {"winter": "false", "wet_grass": np.array([0.5, 0.5])}), plan)
+        self.assertIsNot(VariableElimination.get_plan(self.bn, ["rain"], {"winter": "true"}), plan)
+        for values in [("true", [0.2, 0.8]), ("false", [0.9, 0.1])]:
+            evidence = {"winter": values[0], "wet_grass": np.array(values[1])}
+            np.testing.assert_array_almost_equal(plan.execute(self.bn, evidence).get_potential(),
+                        VariableElimination.naive_marginals(self.bn, ["rain"], evidence).get_potential())
+        with self.assertRaises(ValueError):
+            plan.execute(self.bn, {"winter": "true"})
+        # Changed cpds are picked up by the cached factors
+        rain = self.bn.get_node("rain")
+        cpd = np.copy(rain.cpd)
+        rain.set_cpd(np.array([[0.5, 0.5], [0.5, 0.5]]))
+        np.testing.assert_array_almost_equal(plan.execute(self.bn, {"winter": "true", 
+                        "wet_grass": np.array([1.0, 1.0])}).get_potential(), np.array([0.5, 0.5]))
+        rain.set_cpd(cpd)
+        # The cache is bounded and evicts the least recently used plan
+        planCacheSize = VariableElimination.planCacheSize
+        VariableElimination.planCacheSize = 2
+        try:
+            VariableElimination.bucket_marginals(self.bn, ["winter"])
+            VariableElimination.bucket_marginals(self.bn, ["sprinkler"])
+            self.assertEqual(len(VariableElimination._plans), 2)
+            self.assertIsNot(VariableElimination.get_plan(self.bn, ["rain"], evidence), plan)
+        finally:
+            VariableElimination.planCacheSize = planCacheSize
+            
+    def test_memory_budget(self):
+        cost = VariableElimination.estimate_naive_cost(self.bn, ["rain"])
+        self.assertEqual(cost.largestTable, 2**5)
+        self.assertLess(VariableElimination.estimate_naive_cost(self.bn, ["rain"], 
+                                                    prune=True).peakBytes, cost.peakBytes)
+        # The naive inference falls back to bucket elimination
+        evidence = {"winter": "true"}
+        res = VariableElimination.naive_marginals(self.bn, ["rain"], evidence, 
+                                                  memoryBudget=cost.peakBytes-1)
+        np.testing.assert_array_almost_equal(res.get_potential(), 
+                    VariableElimination.naive_marginals(self.bn, ["rain"], evidence).get_potential())
+        with self.assertRaises(MemoryBudgetError):
+            VariableElimination.bucket_marginals(self.bn, ["rain"], evidence, memoryBudget=1)
+        memoryBudget = VariableElimination.memoryBudget
+        VariableElimination.memoryBudget = 1
+        try:
+            with self.assertRaises(MemoryBudgetError):
+                VariableElimination.naive_marginals(self.bn, ["rain"])
+        finally:
+            VariableElimination.memoryBudget = memoryBudget
+            
     ### TODO check multiple marginals
 #    def test_bucket_multiple_marginals(self):
 #        resFactor = VariableElimination.bucket_marginals(self.bn, ["wet_grass", "rain"], {"winter": "true", "slippery_road": "false"})
         
         
+class PrunerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        
+    def test_ancestral_nodes(self):
+        self.assertEqual(Pruner.get_ancestral_nodes(self.bn, ["slippery_road"]), 
+                         set(["slippery_road", "rain", "winter"]))
+        with self.assertRaises(TypeError):
+            Pruner.get_ancestral_nodes("Not a Bayesian Network.", ["rain"])
+        
+    def test_requisite_nodes(self):
+        self.assertEqual(Pruner.get_requisite_nodes(self.bn, ["sprinkler"], {"winter": "true"}),
+                         set(["sprinkler"]))
+        self.assertEqual(Pruner.get_requisite_nodes(self.bn, ["slippery_road"], {"winter": "true"}),
+                         set(["slippery_road", "rain"]))
+        # Soft evidence does not d-separate
+        self.assertEqual(Pruner.get_requisite_nodes(self.bn, ["sprinkler"], {"winter": np.array([0.3, 0.7])}),
+                         set(["sprinkler", "winter"]))
+        self.assertEqual(Pruner.get_requisite_nodes(self.bn, ["sprinkler"], {"slippery_road": "true"}),
+                         set(["sprinkler", "winter", "rain", "slippery_road"]))
+        
+    def test_prune_barren_nodes(self):
+        bn = Pruner.prune_barren_nodes(self.bn, ["rain"])
+        self.assertEqual(set(bn.get_all_node_names()), set(["rain", "winter"]))
+        self.assertIs(bn.get_node("rain"), self.bn.get_node("rain"))
+        self.assertEqual(len(self.bn), 5)
+        with self.assertRaises(ValueError):
+            self.bn.get_subnetwork(["rain"])
+            
+    def test_min_degree_order_subset(self):
+        order = Orderer.get_min_degree_order(self.bn, ["rain", "wet_grass", "slippery_road"])
+        self.assertEqual(sorted(order), ["rain", "slippery_road", "wet_grass"])
+        
+    def test_pruned_marginals(self):
+        queries = [(["sprinkler"], {"winter": "true"}),
+                   (["slippery_road"], {"winter": "true", "sprinkler": "false"}),
+                   (["winter"], {"slippery_road": "true", "wet_grass": np.array([0.2, 0.8])}),
+                   (["rain"], {})]
+        for variables, evidence in queries:
+            ref = VariableElimination.naive_marginals(self.bn, variables, evidence).get_potential()
+            np.testing.assert_array_almost_equal(VariableElimination.naive_marginals(
+                        self.bn, variables, evidence, prune=True).get_potential(), ref)
+            np.testing.assert_array_almost_equal(VariableElimination.bucket_marginals(
+                        self.bn, variables, evidence, prune=True).get_potential(), ref)
+        
+        
+class RecursiveConditioningTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        
+    def test_marginals(self):
+        queries = [(["sprinkler"], {"winter": "true"}),
+                   (["slippery_road", "rain"], {"winter": "true", "sprinkler": "false"}),
+                   (["winter"], {"slippery_road": "true", "wet_grass": np.array([0.2, 0.8])}),
+                   (["rain"], {"rain": "false"}),
+                   (["rain"], {})]
+        for cacheSize in [None, 0, 2]:
+            rc = RecursiveConditioning(self.bn, cacheSize=cacheSize)
+            for variables, evidence in queries:
+                ref = VariableElimination.bucket_marginals(self.bn, variables, evidence)
+                np.testing.assert_array_almost_equal(
+                        _aligned(rc.marginals(variables, evidence), ref), ref.potentials)
+        with self.assertRaises(ValueError):
+            RecursiveConditioning(self.bn).marginals(["unknown"])
+        with self.assertRaises(TypeError):
+            RecursiveConditioning("Not a Bayesian Network.")
+            
+    def test_cache_size(self):
+        bn = _grid_network(4, 4)
+        variables = ["X1_1", "X2_0"]
+        evidence = {"X3_3": "True", "X0_3": np.array([0.2, 0.8])}
+        ref = VariableElimination.bucket_marginals(bn, variables, evidence)
+        costs = []
+        for cacheSize in [0, 16, None]:
+            rc = RecursiveConditioning(bn, cacheSize=cacheSize)
+            np.testing.assert_array_almost_equal(
+                    _aligned(rc.marginals(variables, evidence), ref), ref.potentials)
+            costs.append(rc.estimate_cost(variables, evidence))
+        self.assertEqual(costs[0].peakBytes, 0)
+        self.assertLessEqual(costs[1].peakBytes, 16 * 8)
+        # Larger caches trade memory for fewer recursive calls
+        self.assertGreater(costs[0].operations, costs[1].operations)
+        self.assertGreater(costs[1].operations, costs[2].operations)
+        self.assertGreater(costs[2].peakBytes, costs[1].peakBytes)
+        
+    def test_long_chain(self):
+        # Deeper than the recursion limit if the dtree was not balanced
+        bn = _chain_network(1500)
+        order = ["X{}".format(i) for i in range(1500)]
+        evidence = {"X1499": "True", "X20": np.array([0.3, 0.6])}
+        rc = RecursiveConditioning(bn, order=order)
+        depth = 0
+        stack = [(rc.root, 0)]
+        while stack:
+            node, d = stack.pop()
+            depth = max(depth, d)
+            if node.family is None:
+                stack.extend([(node.left, d+1), (node.right, d+1)])
+        self.assertLess(depth, 30)
+        np.testing.assert_array_almost_equal(rc.marginals(["X1000"], evidence).get_potential(),
+                VariableElimination.bucket_marginals(bn, ["X1000"], evidence, order=order).get_potential())
+        self.assertGreater(rc.estimate_cost(["X1000"], evidence).operations, 0)
+        
+        
 class FactorEliminationTest(unittest.TestCase):
     
     
@@ -191,6 +518,29 @@ class FactorEliminationTest(unittest.TestCase):
         for n in ft.tree.nodes(): # was nodes_iter in networkx 1.x
             self.assertTrue(n in desiredCliques)
         
+    def test_jointree_reuses_factors(self):
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({"winter": "false"})
+        cliques = {n: d["factor"].potentials for n, d in ft.tree.nodes(data=True)}
+        ft.set_evidence({"winter": "true"})
+        for n, d in ft.tree.nodes(data=True):
+            self.assertIs(d["factor"].potentials, cliques[n])
+        resFactor = ft.marginals(["wet_grass"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.668, 0.332]))
+        
+    def test_jointree_hard_evidence_reduces_cliques(self):
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({"winter": "true", "rain": "false"})
+        for n, d in ft.tree.nodes(data=True):
+            self.assertNotIn("winter", d["factor"])
+            self.assertNotIn("rain", d["factor"])
+        np.testing.assert_array_almost_equal(ft.marginals(["wet_grass"]).get_potential(), np.array([0.02, 0.98]))
+        np.testing.assert_array_almost_equal(ft.marginals(["rain"]).get_potential(), np.array([0.0, 1.0]))
+        resFactor = ft.marginals(["winter", "rain"])
+        self.assertEqual(resFactor.get_potential({"winter": ["true"], "rain": ["false"]}), 1.0)
+        ft.set_evidence({})
+        np.testing.assert_array_almost_equal(ft.marginals(["winter"]).get_potential(), np.array([0.6, 0.4]))
+        
     def test_jointree_marginals(self):
         ft = FactorTree.create_jointree(self.bn)
         resFactor = ft.marginals(["winter"])
@@ -237,6 +587,496 @@ class FactorEliminationTest(unittest.TestCase):
         resFactor = ft.marginals(["wet_grass"])
         np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
         
+    def test_jointree_marginal_evidence_logspace(self):
+        ft = FactorTree.create_jointree(self.bn, logspace=True)
+        ft.set_evidence({"wet_grass": "false"})
+        resFactor = ft.marginals(["rain"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.158858, 0.841142]))
+        
+    def test_jointree_logspace_underflow(self):
+        bn = _underflow_network()
+        ft = FactorTree.create_jointree(bn, logspace=True)
+        ft.set_evidence({"C{}".format(i): "True" for i in range(200)})
+        np.testing.assert_array_almost_equal(ft.marginals(["A"]).get_potential(), np.array([0.12025, 0.87975]))
+        
+    def test_jointree_sparse_cliques(self):
+        bn = _deterministic_network()
+        ft = FactorTree.create_jointree(bn)
+        self.assertTrue(Factor.from_node(bn.get_node("parity")).sparsify(0.6).sparse)
+        for evidence in [{}, {"sensor": "False"}, {"sensor": "True", "I0": "False"}]:
+            ft.set_evidence(evidence)
+            for v in ["I0", "I1", "I2", "parity"]:
+                np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(), 
+                        VariableElimination.naive_marginals(bn, [v], evidence).get_potential())
+
+    def test_jointree_dtype(self):
+        ft = FactorTree.create_jointree(self.bn, dtype=np.float32)
+        ft.set_evidence({"winter": "true", "wet_grass": np.array([0.3, 0.7])})
+        for n, d in ft.tree.nodes(data=True):
+            self.assertEqual(d["factor"].potentials.dtype, np.float32)
+        for a, b, d in ft.tree.edges(data=True):
+            self.assertEqual(d["factor"].potentials.dtype, np.float32)
+        resFactor = ft.marginals(["rain"])
+        self.assertEqual(resFactor.potentials.dtype, np.float32)
+        errors = ft.compare_precision()
+        self.assertEqual(set(errors), set(self.bn.get_all_node_names()))
+        self.assertLess(max(errors.values()), 1e-6)
+        
+    def test_jointree_compiled_schedule(self):
+        ft = FactorTree.create_jointree(self.bn)
+        compiled = ft.compiled
+        self.assertEqual(len(compiled.cliques), len(ft.tree))
+        self.assertEqual(len(compiled.collectSchedule), len(ft.tree) - 1)
+        for sender, receiver, sep in compiled.collectSchedule:
+            self.assertIs(compiled.separators[sep], 
+                          ft.tree[compiled.cliqueNames[sender]][compiled.cliqueNames[receiver]])
+        # Every clique only sends after it received from all other neighbors
+        received = {i: 0 for i in range(len(compiled.cliques))}
+        for sender, receiver, sep in compiled.collectSchedule:
+            self.assertEqual(received[sender], len(compiled.neighbors[sender]) - 1)
+            received[receiver] += 1
+        self.assertEqual(compiled.distributeSchedule[0][0], compiled.roots[0])
+
+    def test_jointree_relevant_variables(self):
+        evidence = {"winter": "true"}
+        ref = FactorTree.create_jointree(self.bn)
+        ref.set_evidence(evidence)
+        ft = FactorTree.create_jointree(self.bn, relevantVariables=["rain", "winter", "sprinkler"])
+        self.assertEqual(set(ft.bn.get_all_node_names()), set(["rain", "winter", "sprinkler"]))
+        ft.set_evidence(evidence)
+        for v in ["rain", "sprinkler"]:
+            np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(), 
+                                                 ref.marginals([v]).get_potential())
+        self.assertAlmostEqual(ft.get_evidence_probability(), ref.get_evidence_probability())
+        with self.assertRaises(ValueError):
+            ft.set_evidence({"wet_grass": "true"})
+        
+    def test_jointree_memory_budget(self):
+        cost = FactorTree.estimate_cost(self.bn)
+        ft = FactorTree.create_jointree(self.bn, memoryBudget=cost.peakBytes)
+        self.assertEqual(cost.largestTable, 
+                         max(2**len(d["variables"]) for d in ft.compiled.cliques))
+        self.assertEqual(FactorTree.estimate_cost(self.bn, dtype=np.float32).peakBytes, 
+                         cost.peakBytes // 2)
+        self.assertLess(FactorTree.estimate_cost(self.bn, relevantVariables=["winter"]).peakBytes, 
+                        cost.peakBytes)
+        with self.assertRaises(MemoryBudgetError):
+            FactorTree.create_jointree(self.bn, memoryBudget=cost.peakBytes-1)
+        
+    def test_jointree_shafer_shenoy(self):
+        self.assertEqual(FactorTree.create_jointree(self.bn).architecture, "hugin")
+        self.assertEqual(FactorTree.create_jointree(self.bn, lazy=True).architecture, 
+                         "shafer-shenoy")
+        with self.assertRaises(ValueError):
+            FactorTree.create_jointree(self.bn, architecture="lauritzen-spiegelhalter")
+        with self.assertRaises(ValueError):
+            FactorTree.create_jointree(self.bn, incremental=True, architecture="hugin")
+        with self.assertRaises(ValueError):
+            FactorTree.create_jointree(self.bn, architecture="shafer-shenoy", executor=2)
+        # Deterministic cpds and evidence lead to zero separator entries
+        bn = _deterministic_network()
+        ft = FactorTree.create_jointree(bn, architecture="shafer-shenoy")
+        self.assertTrue(ft.incremental)
+        for evidence in [{}, {"parity": "odd", "I0": "True"}, 
+                         {"sensor": "True", "I1": "False", "I2": "False"}]:
+            ft.set_evidence(evidence)
+            for variables in [["I0"], ["parity"], ["I1", "sensor"]]:
+                ref = VariableElimination.naive_marginals(bn, variables, evidence)
+                np.testing.assert_array_almost_equal(_aligned(ft.marginals(variables), ref), 
+                                                     ref.potentials)
+            ref = FactorTree.create_jointree(bn)
+            ref.set_evidence(evidence)
+            self.assertAlmostEqual(ft.get_evidence_probability(), 
+                                   ref.get_evidence_probability())
+        
+    def test_jointree_clique_index(self):
+        ft = FactorTree.create_jointree(self.bn)
+        compiled = ft.compiled
+        for v in self.bn.get_all_node_names():
+            cliques = [i for i, d in enumerate(compiled.cliques) if v in d["variables"]]
+            smallest = min(len(compiled.cliques[i]["variables"]) for i in cliques)
+            self.assertIn(compiled.variable_clique(v), cliques)
+            self.assertEqual(len(compiled.cliques[compiled.variable_clique(v)]["variables"]), smallest)
+        clique = compiled.covering_clique(["wet_grass", "rain"])
+        self.assertTrue(set(["wet_grass", "rain"]).issubset(compiled.cliques[clique]["variables"]))
+        self.assertEqual(compiled.covering_clique(set(["rain", "wet_grass"])), clique)
+        self.assertIn(frozenset(["rain", "wet_grass"]), compiled._coveringCliques)
+        self.assertIsNone(compiled.covering_clique(["winter", "slippery_road"]))
+        self.assertIsNone(compiled.variable_clique("unknown"))
+        # The memoized variable sets are bounded
+        compiled.coveringCacheSize = 2
+        compiled.covering_clique(["winter"])
+        compiled.covering_clique(["sprinkler"])
+        self.assertEqual(len(compiled._coveringCliques), 2)
+        self.assertNotIn(frozenset(["rain", "wet_grass"]), compiled._coveringCliques)
+        self.assertEqual(compiled.covering_clique(["wet_grass", "rain"]), clique)
+
+    def test_jointree_deep_chain(self):
+        # Deeper than the recursion limit of a recursive propagation
+        length = sys.getrecursionlimit() + 10
+        bn = _chain_network(length)
+        ft = FactorTree.create_jointree(bn, order=["X{}".format(i) for i in range(length)])
+        ft.set_evidence({"X0": "True"})
+        np.testing.assert_array_almost_equal(ft.marginals(["X{}".format(length-1)]).get_potential(), 
+                                             np.array([2.0/3, 1.0/3]))
+        ft.pull_messages(ft.tree, ft.compiled.cliqueNames[-1], None)
+        
+    def test_jointree_pull_push_messages(self):
+        evidence = {"winter": "true", "wet_grass": np.array([0.3, 0.7])}
+        ref = FactorTree.create_jointree(self.bn)
+        ref.set_evidence(evidence)
+        for root in range(len(ref.tree)):
+            ft = FactorTree.create_jointree(self.bn)
+            ft.set_evidence(evidence)
+            name = ft.compiled.cliqueNames[root]
+            ft.pull_messages(ft.tree, name, None)
+            ft.push_messages(ft.tree, name, None)
+            ft.tree.graph["messagesValid"] = True
+            for v in self.bn.get_all_node_names():
+                np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(), 
+                                                     ref.marginals([v]).get_potential())
+        
+    def test_jointree_unique_clique_names(self):
+        bn = BayesianNetwork()
+        for name in ["ab", "c", "a", "bc"]:
+            bn.add_node(DiscreteNode(name))
+        bn.add_edge("ab", "c")
+        bn.add_edge("a", "bc")
+        for name in ["ab", "a"]:
+            bn.get_node(name).set_cpd(np.array([0.3, 0.7]))
+        for name in ["c", "bc"]:
+            bn.get_node(name).set_cpd(np.array([[0.2, 0.6], [0.8, 0.4]]))
+        ft = FactorTree.create_jointree(bn)
+        self.assertEqual(len(ft.tree), 2)
+        np.testing.assert_array_almost_equal(ft.marginals(["bc"]).get_potential(), 
+                                             np.array([0.48, 0.52]))
+        
+    def test_jointree_incremental_evidence(self):
+        for logspace in [False, True]:
+            ft = FactorTree.create_jointree(self.bn, logspace=logspace, incremental=True)
+            ref = FactorTree.create_jointree(self.bn, logspace=logspace)
+            for evidence, softPosteriors in [({}, False),
+                                             ({"winter": "true"}, False),
+                                             ({"winter": "true", "slippery_road": "false"}, False),
+                                             ({"winter": "false", "slippery_road": "false"}, False),
+                                             ({"slippery_road": "false", "wet_grass": np.array([0.3, 0.7])}, False),
+                                             ({"slippery_road": "false", "wet_grass": np.array([0.3, 0.7])}, True),
+                                             ({"sprinkler": "true"}, False)]:
+                ft.set_evidence(evidence, softPosteriors)
+                ref.set_evidence(evidence, softPosteriors)
+                for v in self.bn.get_all_node_names():
+                    np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(),
+                                                         ref.marginals([v]).get_potential())
+                    
+    def test_jointree_incremental_messages(self):
+        bn = _chain_network(10)
+        ft = FactorTree.create_jointree(bn, order=["X{}".format(i) for i in range(10)], 
+                                        incremental=True)
+        ft.set_evidence({"X0": "True"})
+        self.assertTrue(all(ft._messageValid))
+        products = []
+        clique_product = ft._clique_product
+        def counting_product(clique, exclude=None):
+            products.append(clique)
+            return clique_product(clique, exclude)
+        ft._clique_product = counting_product
+        # Only the messages sent away from the clique of X9 are recomputed
+        ft.set_evidence({"X0": "True", "X9": "False"})
+        self.assertEqual(len(products), len(ft.tree) - 1)
+        del products[:]
+        ft.set_evidence({"X0": "True"})
+        self.assertEqual(len(products), len(ft.tree) - 1)
+        ref = VariableElimination.naive_marginals(bn, ["X5"], {"X0": "True"})
+        np.testing.assert_array_almost_equal(ft.marginals(["X5"]).get_potential(), ref.get_potential())
+        # Changing the network requires a reset, which rebuilds the state
+        bn.get_node("X0").set_cpd(np.array([0.2, 0.8]))
+        ft.reset_factors()
+        ft.set_evidence({"X9": "False"})
+        ref = VariableElimination.naive_marginals(bn, ["X0"], {"X9": "False"})
+        np.testing.assert_array_almost_equal(ft.marginals(["X0"]).get_potential(), ref.get_potential())
+        
+    def test_jointree_lazy_marginals(self):
+        bn = _chain_network(10)
+        order = ["X{}".format(i) for i in range(10)]
+        ft = FactorTree.create_jointree(bn, order=order, lazy=True)
+        ref = FactorTree.create_jointree(bn, order=order)
+        ft.set_evidence({})
+        self.assertFalse(any(ft._messageValid))
+        ft.calculate_messages()
+        ft.set_evidence({"X9": "False"})
+        ref.set_evidence({"X9": "False"})
+        invalid = ft._messageValid.count(False)
+        self.assertEqual(invalid, len(ft.tree) - 1)
+        np.testing.assert_array_almost_equal(ft.marginals(["X9"]).get_potential(), [0.0, 1.0])
+        self.assertEqual(ft._messageValid.count(False), invalid)
+        np.testing.assert_array_almost_equal(ft.marginals(["X5"]).get_potential(), 
+                                             ref.marginals(["X5"]).get_potential())
+        self.assertLess(0, ft._messageValid.count(False))
+        self.assertLess(ft._messageValid.count(False), invalid)
+        for v in order:
+            np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(), 
+                                                 ref.marginals([v]).get_potential())
+        self.assertTrue(all(ft._messageValid))
+        
+    def test_jointree_lazy_subtree_marginals(self):
+        bn = _chain_network(10)
+        order = ["X{}".format(i) for i in range(10)]
+        ft = FactorTree.create_jointree(bn, order=order, lazy=True)
+        ft.set_evidence({"X9": "False"})
+        ref = VariableElimination.naive_marginals(bn, ["X0", "X2"], {"X9": "False"})
+        np.testing.assert_array_almost_equal(_aligned(ft.marginals(["X0", "X2"]), ref), 
+                                             ref.potentials)
+        # Only the messages from the 6 cliques outside the subtree 
+        # connecting {X0, X1} and {X2, X3} are computed
+        self.assertEqual(ft._messageValid.count(True), 6)
+        
+    def test_jointree_snapshot(self):
+        ft = FactorTree.create_jointree(self.bn)
+        snapshot = ft._snapshot
+        ft.set_evidence({"winter": "true"})
+        ft.set_evidence({"rain": "false"})
+        self.assertIs(ft._snapshot, snapshot)
+        for n, d in ft.tree.nodes(data=True):
+            self.assertFalse(any(d["factor"].potentials is f.potentials for f in snapshot))
+        # Changing a cpd invalidates the snapshot and the current evidence
+        # is set again
+        for incremental in [False, True]:
+            ft = FactorTree.create_jointree(self.bn, incremental=incremental)
+            ft.set_evidence({"winter": "true"})
+            ft.marginals(["rain"])
+            self.bn.get_node("rain").set_probability("true", 0.5, {"winter": "true"})
+            self.bn.get_node("rain").set_probability("false", 0.5, {"winter": "true"})
+            np.testing.assert_array_almost_equal(ft.marginals(["rain"]).get_potential(), [0.5, 0.5])
+            self.assertIsNot(ft._snapshot, snapshot)
+            self.bn.get_node("rain").set_cpd(np.array([[0.8, 0.1], [0.2, 0.9]]))
+            np.testing.assert_array_almost_equal(ft.marginals(["rain"]).get_potential(), [0.8, 0.2])
+        # Changes are also detected through subnetworks sharing the nodes
+        sub = self.bn.get_subnetwork(["winter", "rain"])
+        ft = FactorTree.create_jointree(sub)
+        ft.set_evidence({"winter": "true"})
+        ft.marginals(["rain"])
+        version = sub.cpdVersion
+        self.bn.get_node("rain").set_cpd(np.array([[0.6, 0.1], [0.4, 0.9]]))
+        self.assertGreater(sub.cpdVersion, version)
+        np.testing.assert_array_almost_equal(ft.marginals(["rain"]).get_potential(), [0.6, 0.4])
+        
+    def test_jointree_save_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for bn in [self.bn, _deterministic_network()]:
+                path = os.path.join(directory, "tree")
+                ft = FactorTree.create_jointree(bn)
+                ft.save(path)
+                loaded = FactorTree.load(path, bn)
+                self.assertEqual(sorted(loaded.tree.nodes()), sorted(ft.tree.nodes()))
+                self.assertTrue(any(isinstance(f.potentials, np.memmap) or f.sparse 
+                                    for f in loaded._snapshot))
+                name = sorted(bn.get_all_node_names())[0]
+                evidence = {name: bn.get_node(name).values[0]}
+                ft.set_evidence(evidence)
+                loaded.set_evidence(evidence)
+                for v in bn.get_all_node_names():
+                    np.testing.assert_array_almost_equal(loaded.marginals([v]).get_potential(),
+                                                         ft.marginals([v]).get_potential())
+                shutil.rmtree(path)
+            # Changed cpds are recomputed from the network
+            FactorTree.create_jointree(self.bn).save(path)
+            self.bn.get_node("rain").set_cpd(np.array([[0.5, 0.1], [0.5, 0.9]]))
+            loaded = FactorTree.load(path, self.bn, incremental=True)
+            loaded.set_evidence({"winter": "true"})
+            np.testing.assert_array_almost_equal(loaded.marginals(["rain"]).get_potential(), [0.5, 0.5])
+            # Structural changes are detected
+            self.bn.add_node(DiscreteNode("new"))
+            with self.assertRaises(StructureError):
+                FactorTree.load(path, self.bn)
+        finally:
+            shutil.rmtree(directory)
+        
+    def test_jointree_out_of_clique_marginals(self):
+        evidence = {"winter": "true", "wet_grass": np.array([0.3, 0.7])}
+        for kwargs in [{}, {"logspace": True}, {"incremental": True}, {"lazy": True}]:
+            ft = FactorTree.create_jointree(self.bn, **kwargs)
+            ft.set_evidence(evidence)
+            for variables in [["slippery_road", "sprinkler"], ["slippery_road", "winter", "wet_grass"]]:
+                ref = VariableElimination.naive_marginals(self.bn, variables, evidence)
+                res = ft.marginals(variables)
+                np.testing.assert_array_almost_equal(_aligned(res, ref), ref.potentials)
+                
+    def test_jointree_out_of_clique_chain(self):
+        bn = _chain_network(8)
+        bn.add_node(DiscreteNode("single"))
+        bn.get_node("single").set_cpd(np.array([0.1, 0.9]))
+        ft = FactorTree.create_jointree(bn, order=["X{}".format(i) for i in range(8)] + ["single"])
+        ft.set_evidence({"X3": "False"})
+        variables = ["X0", "X7", "single", "X3"]
+        ref = VariableElimination.naive_marginals(bn, variables, {"X3": "False"})
+        np.testing.assert_array_almost_equal(_aligned(ft.marginals(variables), ref), ref.potentials)
+        with self.assertRaises(ValueError):
+            ft.marginals(["X0", "unknown"])
+        
+    def test_jointree_parallel_messages(self):
+        bn = _underflow_network(12)
+        evidence = {"C{}".format(i): "True" for i in range(0, 12, 3)}
+        ref = FactorTree.create_jointree(bn)
+        ref.set_evidence(evidence)
+        ft = FactorTree.create_jointree(bn, executor=4)
+        collectLevels, distributeLevels = ft.compiled.parallel_schedule()
+        self.assertEqual(sum(len(g) for l in collectLevels for g in l), len(ft.tree) - 1)
+        self.assertEqual(sum(len(g) for l in distributeLevels for g in l), len(ft.tree) - 1)
+        for levels in [collectLevels, distributeLevels]:
+            for level in levels:
+                groups = [set(m[1] for m in g) for g in level]
+                self.assertTrue(all(len(g) == 1 for g in groups))
+                self.assertEqual(len(set.union(*groups)), len(groups))
+        ft.set_evidence(evidence)
+        for v in bn.get_all_node_names():
+            np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(), 
+                                                 ref.marginals([v]).get_potential())
+        ft.close()
+        self.assertIsNone(ft.executor)
+
+    def test_jointree_mpe(self):
+        evidence = {"wet_grass": "true", "rain": np.array([0.2, 0.9])}
+        ref = _ranked_assignments(self.bn, evidence)
+        for kwargs in [{}, {"logspace": True}, {"incremental": True}]:
+            ft = FactorTree.create_jointree(self.bn, **kwargs)
+            ft.set_evidence(evidence)
+            marginals = ft.marginals(["winter"]).get_potential()
+            res = ft.mpe(k=3)
+            self.assertEqual([r[0] for r in res], [r[0] for r in ref[:3]])
+            np.testing.assert_array_almost_equal([r[1] for r in res], [r[1] for r in ref[:3]])
+            # The calibrated jointree is not affected
+            np.testing.assert_array_almost_equal(ft.marginals(["winter"]).get_potential(), marginals)
+        refMap = _ranked_assignments(self.bn, evidence, ["winter", "slippery_road"])
+        res = ft.mpe(["winter", "slippery_road"], k=2, log=True)
+        self.assertEqual([r[0] for r in res], [r[0] for r in refMap[:2]])
+        np.testing.assert_array_almost_equal([r[1] for r in res], np.log([r[1] for r in refMap[:2]]))
+        
+    def test_jointree_mpe_underflow(self):
+        bn = _underflow_network()
+        evidence = {"C{}".format(i): "True" for i in range(200)}
+        ft = FactorTree.create_jointree(bn)
+        ft.set_evidence(evidence)
+        res = ft.mpe(k=2, log=True)
+        self.assertEqual([r[0] for r in res], [{"A": "False"}, {"A": "True"}])
+        np.testing.assert_array_almost_equal([r[1] for r in res], 
+                    [np.log(0.5) + 200 * np.log(0.0101), np.log(0.5) + 200 * np.log(0.01)])
+        
+    def test_jointree_evidence_probability(self):
+        evidence = {"wet_grass": "true", "slippery_road": "false"}
+        joint = VariableElimination.naive_marginals(self.bn, list(evidence))
+        prob = joint.get_potential({k: [v] for k, v in evidence.items()})
+        for kwargs in [{}, {"logspace": True}, {"incremental": True},
+                       {"lazy": True}, {"executor": 2}]:
+            ft = FactorTree.create_jointree(self.bn, **kwargs)
+            ft.set_evidence(evidence)
+            self.assertAlmostEqual(ft.get_evidence_probability(), float(prob))
+            self.assertAlmostEqual(ft.get_evidence_probability(log=True), float(np.log(prob)))
+            ft.set_evidence({})
+            self.assertAlmostEqual(ft.get_evidence_probability(), 1.0)
+            ft.close()
+
+    def test_jointree_logspace_observed_separator(self):
+        ft = FactorTree.create_jointree(self.bn, logspace=True)
+        ref = FactorTree.create_jointree(self.bn)
+        seps = [d["order"] for d in ft.compiled.separators]
+        evidence = {v: self.bn.get_node(v).values[0] for sep in seps for v in sep}
+        ft.set_evidence(evidence)
+        ref.set_evidence(evidence)
+        for v in ["winter", "wet_grass", "slippery_road"]:
+            np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(), 
+                                                 ref.marginals([v]).get_potential())
+        self.assertAlmostEqual(ft.get_evidence_probability(log=True), 
+                               ref.get_evidence_probability(log=True))
+        
+    def test_jointree_evidence_probability_underflow(self):
+        bn = _underflow_network()
+        evidence = {"C{}".format(i): "True" for i in range(200)}
+        ref = np.log(0.5) + 200 * np.log(0.01) + np.log1p(1.01 ** 200)
+        for kwargs in [{}, {"logspace": True}, {"incremental": True}]:
+            ft = FactorTree.create_jointree(bn, **kwargs)
+            ft.set_evidence(evidence)
+            self.assertAlmostEqual(ft.get_evidence_probability(log=True), ref)
+            self.assertEqual(ft.get_evidence_probability(), 0.0)
+
+    def test_jointree_batch_evidence_probability(self):
+        ft = FactorTree.create_jointree(self.bn)
+        evidenceList = [{}, {"winter": "true"}, {"winter": "true", "rain": "false"},
+                        {"wet_grass": "true", "slippery_road": "false"}]
+        ft.set_evidence({"slippery_road": "true"})
+        res = ft.batch_evidence_probability(evidenceList)
+        self.assertEqual(res.shape, (4,))
+        for i, evidence in enumerate(evidenceList):
+            ref = FactorTree.create_jointree(self.bn)
+            ref.set_evidence(evidence)
+            self.assertAlmostEqual(res[i], ref.get_evidence_probability())
+        np.testing.assert_array_almost_equal(ft.batch_evidence_probability(evidenceList, log=True),
+                                             np.log(res))
+        # The evidence set before is not affected
+        self.assertAlmostEqual(ft.get_evidence_probability(),
+                    float(VariableElimination.naive_marginals(self.bn, ["slippery_road"]).get_potential({"slippery_road": ["true"]})))
+
+    def test_jointree_memmap(self):
+        ref = FactorTree.create_jointree(self.bn)
+        evidence = {"winter": "true", "wet_grass": np.array([0.3, 0.7])}
+        ref.set_evidence(evidence)
+        directory = tempfile.mkdtemp()
+        chunkBytes = Factor.chunkBytes
+        Factor.chunkBytes = 16
+        try:
+            self.bn.memmap_cpds(directory)
+            self.assertIsInstance(self.bn.get_node("rain").cpd, np.memmap)
+            ft = FactorTree.create_jointree(self.bn, scratchDir=ScratchSpace(directory, minBytes=0))
+            for n, d in ft.tree.nodes(data=True):
+                self.assertIsInstance(d["factor"].potentials, np.memmap)
+            ft.set_evidence(evidence)
+            for v in self.bn.get_all_node_names():
+                np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(),
+                                                     ref.marginals([v]).get_potential())
+            ft.close()
+            self.assertEqual(ft.storage.files, [])
+        finally:
+            Factor.chunkBytes = chunkBytes
+            shutil.rmtree(directory)
+
+    def test_jointree_batch_marginals(self):
+        ft = FactorTree.create_jointree(self.bn)
+        evidenceList = [{}, {"winter": "true"}, {"winter": "true", "rain": "false"},
+                        {"wet_grass": np.array([0.3, 0.7])}]
+        ft.set_evidence({"slippery_road": "true"})
+        resFactor = ft.batch_marginals(["wet_grass"], evidenceList)
+        self.assertEqual(resFactor.get_potential().shape, (4, 2))
+        np.testing.assert_array_almost_equal(resFactor.get_potential()[1], np.array([0.668, 0.332]))
+        np.testing.assert_array_almost_equal(resFactor.get_potential()[2], np.array([0.02, 0.98]))
+        for i, evidence in enumerate(evidenceList):
+            np.testing.assert_array_almost_equal(resFactor.get_case(i).get_potential(),
+                        VariableElimination.naive_marginals(self.bn, ["wet_grass"], evidence).get_potential())
+        # The evidence set before is not affected
+        np.testing.assert_array_almost_equal(ft.marginals(["wet_grass"]).get_potential(),
+                    VariableElimination.naive_marginals(self.bn, ["wet_grass"], {"slippery_road": "true"}).get_potential())
+        # The batch is expanded from the snapshot, which follows cpd changes
+        snapshot = ft._get_snapshot()
+        ft.batch_marginals(["wet_grass"], evidenceList)
+        self.assertIs(ft._get_snapshot(), snapshot)
+        rain = self.bn.get_node("rain")
+        cpd = np.copy(rain.cpd)
+        rain.set_cpd(np.array([[0.5, 0.5], [0.5, 0.5]]))
+        try:
+            resFactor = ft.batch_marginals(["wet_grass"], evidenceList)
+            for i, evidence in enumerate(evidenceList):
+                np.testing.assert_array_almost_equal(resFactor.get_case(i).get_potential(),
+                        VariableElimination.naive_marginals(self.bn, ["wet_grass"], evidence).get_potential())
+        finally:
+            rain.set_cpd(cpd)
+
+    def test_jointree_batch_marginals_logspace(self):
+        bn = _underflow_network()
+        ft = FactorTree.create_jointree(bn, logspace=True)
+        evidenceList = [{"C{}".format(i): "True" for i in range(200)}, {}]
+        resFactor = ft.batch_marginals(["A"], evidenceList)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(),
+                                             np.array([[0.12025, 0.87975], [0.5, 0.5]]))
+
     def test_jointree_marginal_soft_evidence(self):
         bn = BayesianNetwork()
         cloth = DiscreteNode("cloth", ["green","blue", "red"])
@@ -19,18 +19,63 @@
 # License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+import random
 import unittest
 
+import numpy as np
+
 from primo2.io import XMLBIFParser
+from primo2.networks import BayesianNetwork
+from primo2.nodes import DiscreteNode
 
 from primo2.inference.mcmc import MCMC
 from primo2.inference.mcmc import GibbsTransition
 from primo2.inference.mcmc import MetropolisHastingsTransition
+from primo2.inference.mcmc import MarkovChainSampler
+from primo2.inference.mcmc import TransitionModel
+from primo2.inference.mcmc import EncodedNetwork
 
 class MCMCTest(unittest.TestCase):
     
-    #TODO!
-    pass
+    def setUp(self):
+        self.bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        
+    def test_marginals_with_evidence(self):
+        mcmc = MCMC(self.bn, numSamples=2000, burnIn=100)
+        res = mcmc.marginals(["rain", "winter"], {"winter": "true"})
+        self.assertAlmostEqual(res.get_potential().sum(), 1.0)
+        self.assertEqual(res.get_potential({"winter": ["false"]}).sum(), 0.0)
+        
+    def test_generate_markov_chain(self):
+        sampler = MarkovChainSampler(GibbsTransition(), burnIn=10)
+        evidence = {"wet_grass": "true"}
+        initialState = self.bn.get_sample(evidence)
+        samples = list(sampler.generate_markov_chain(self.bn, 5, initialState, evidence))
+        self.assertEqual(len(samples), 5)
+        for s in samples:
+            self.assertEqual(s["wet_grass"], "true")
+            for var, val in s.items():
+                self.assertTrue(val in self.bn.get_node(var).values)
+                
+    def test_step_encoded_fallback(self):
+        """
+            Transition models that only implement step are called with 
+            decoded states.
+        """
+        class KeepTransition(TransitionModel):
+            def step(self, currentState, variables, bn, fullChange=False):
+                return currentState
+        network = EncodedNetwork(self.bn)
+        state = network.symbols.encode(self.bn.get_sample({})).tolist()
+        self.assertEqual(KeepTransition().step_encoded(list(state), [0], network), state)
+        
+    def test_markov_prob_encoded(self):
+        network = EncodedNetwork(self.bn)
+        state = self.bn.get_sample({})
+        encoded = network.symbols.encode(state).tolist()
+        for node in self.bn.get_all_nodes():
+            self.assertAlmostEqual(network.markov_prob(network.symbols.variable_id(node.name), encoded),
+                                   node.get_markov_prob(state[node.name], self.bn.get_children(node.name), state))
     
 class GibbsTransitionTest(unittest.TestCase):
     
@@ -127,6 +172,26 @@ class MetropolisHastingTransitionTest(unittest.TestCase):
             self.assertTrue(val in var.values)
             if var in evidence:
                 self.assertEqual(val, evidence[var])
+                
+    def test_impossible_initial_state(self):
+        """
+            The initial state samples the evidence variables with their 
+            evidence clamped, so it can be impossible given the evidence.
+        """
+        bn = BayesianNetwork()
+        a = DiscreteNode("A", ["a1", "a2"])
+        b = DiscreteNode("B", ["b", "notB"])
+        bn.add_node(a)
+        bn.add_node(b)
+        bn.add_edge(a, b)
+        a.set_cpd(np.array([0.5, 0.5]))
+        b.set_cpd(np.array([[1.0, 0.0], [0.0, 1.0]]))
+        for seed in range(20):
+            random.seed(seed)
+            np.random.seed(seed)
+            mcmc = MCMC(bn, MetropolisHastingsTransition(), numSamples=200, burnIn=20)
+            res = mcmc.marginals(["A"], {"B": "b"})
+            self.assertAlmostEqual(float(res.get_potential({"A": ["a1"]})), 1.0)
         
         
 if __name__ == "__main__":
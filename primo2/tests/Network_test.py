@@ -20,6 +20,7 @@
 # <http://www.gnu.org/licenses/>.
 
 import unittest
+import numpy as np
 from primo2.networks import BayesianNetwork
 from primo2.nodes import RandomNode, DiscreteNode
 
@@ -117,6 +118,54 @@ class BayesNetTest(unittest.TestCase):
         self.assertEqual(str(cm.exception), "There is no node with name " \
                          "NewName in the BayesianNetwork")
                 
+    def test_set_dtype(self):
+        n1 = DiscreteNode("Node1")
+        self.bn.add_node(n1)
+        self.bn.set_dtype(np.float32)
+        n2 = DiscreteNode("Node2")
+        self.bn.add_node(n2)
+        self.bn.add_edge("Node1", "Node2")
+        self.assertEqual(n1.cpd.dtype, np.float32)
+        self.assertEqual(n2.cpd.dtype, np.float32)
+        bn = BayesianNetwork(dtype=np.longdouble)
+        bn.add_node(DiscreteNode("Node1"))
+        self.assertEqual(bn.get_node("Node1").cpd.dtype, np.longdouble)
+        
+    def test_symbol_table(self):
+        n1 = DiscreteNode("Node1")
+        n2 = DiscreteNode("Node2", ["Value1","Value2","Value3"])
+        self.bn.add_node(n1)
+        self.bn.add_node(n2)
+        symbols = self.bn.get_symbol_table()
+        self.assertIs(self.bn.get_symbol_table(), symbols)
+        self.assertEqual(symbols.variables[symbols.variable_id("Node2")], "Node2")
+        self.assertEqual(symbols.value_id("Node2", "Value3"), 2)
+        self.assertEqual(symbols.value_id(n1, "False"), 1)
+        encoded = symbols.encode({"Node2": "Value2"})
+        self.assertEqual(encoded[symbols.variable_id("Node1")], -1)
+        self.assertEqual(symbols.decode(encoded), {"Node2": "Value2"})
+        with self.assertRaises(ValueError) as cm:
+            symbols.value_id("Node1", "Maybe")
+        self.assertEqual(str(cm.exception), "Variable Node1 does not have a value Maybe.")
+        
+        self.bn.change_node_values(n2, ["Value1","Value2"])
+        self.assertIsNot(self.bn.get_symbol_table(), symbols)
+        with self.assertRaises(ValueError):
+            self.bn.get_symbol_table().value_id("Node2", "Value3")
+            
+    def test_structure_fingerprint(self):
+        self.bn.add_node(DiscreteNode("Node1"))
+        self.bn.add_node(DiscreteNode("Node2"))
+        fingerprint = self.bn.get_structure_fingerprint()
+        self.assertEqual(self.bn.get_structure_fingerprint(), fingerprint)
+        self.bn.add_edge("Node1", "Node2")
+        withEdge = self.bn.get_structure_fingerprint()
+        self.assertNotEqual(withEdge, fingerprint)
+        self.bn.remove_edge("Node1", "Node2")
+        self.assertEqual(self.bn.get_structure_fingerprint(), fingerprint)
+        self.bn.change_node_values(self.bn.get_node("Node1"), ["a", "b", "c"])
+        self.assertNotEqual(self.bn.get_structure_fingerprint(), fingerprint)
+                
 #    def test_addEdge(self):
 #        self.fail("TODO")
                 
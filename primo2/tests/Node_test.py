@@ -73,6 +73,49 @@ class DiscreteNode(unittest.TestCase):
         n = nodes.DiscreteNode("Node")
         self.assertEqual(n.values, ["True", "False"])
 
+    def test_value_index(self):
+        n = nodes.DiscreteNode("Node", ["Value1", "Value2", "Value3"])
+        self.assertEqual(n.value_index("Value3"), 2)
+        n.set_values(["Value3", "Value1"])
+        self.assertEqual(n.value_index("Value3"), 0)
+        with self.assertRaises(ValueError):
+            n.value_index("Value2")
+
+    def test_set_dtype(self):
+        n = nodes.DiscreteNode("Node1", ["Value1", "Value2"])
+        n.set_cpd(np.array([0.2,0.8]))
+        n.set_dtype(np.float32)
+        self.assertEqual(n.cpd.dtype, np.float32)
+        n.set_cpd(np.array([0.3,0.7]))
+        self.assertEqual(n.cpd.dtype, np.float32)
+        with self.assertRaises(TypeError):
+            n.set_dtype(int)
+
+    def test_cpd_version(self):
+        n = nodes.DiscreteNode("Node1", ["Value1", "Value2"])
+        version = n.cpdVersion
+        n.set_cpd(np.array([0.2,0.8]))
+        self.assertGreater(n.cpdVersion, version)
+        version = n.cpdVersion
+        n.set_probability("Value1", 0.3)
+        self.assertGreater(n.cpdVersion, version)
+        version = n.cpdVersion
+        n.get_probability("Value1")
+        self.assertEqual(n.cpdVersion, version)
+        n.touch()
+        self.assertGreater(n.cpdVersion, version)
+
+    def test_cpd_read_only(self):
+        n = nodes.DiscreteNode("Node1", ["Value1", "Value2"])
+        n.set_cpd(np.array([0.2,0.8]))
+        version = n.cpdVersion
+        with self.assertRaises(ValueError):
+            n.cpd[0] = 0.5
+        self.assertEqual(n.cpdVersion, version)
+        np.testing.assert_array_equal(n.cpd, [0.2,0.8])
+        n.set_probability("Value1", 0.5)
+        np.testing.assert_array_equal(n.cpd, [0.5,0.8])
+
     def test_set_cpd(self):
         n = nodes.DiscreteNode("Node1", ["Value1", "Value2"])
         cpd = np.array([0.2,0.8])